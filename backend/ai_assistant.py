@@ -1,10 +1,234 @@
 import google.generativeai as genai
+from cachetools import LRUCache, TTLCache
+from collections import deque
+import contextlib
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import time
+from metrics import Histogram
 
 logger = logging.getLogger(__name__)
 
+FALLBACK_RESPONSE = "Sorry, I couldn't generate a response right now."
+FALLBACK_SMART_REPLIES = ["Got it, thanks!", "Can you explain more?"]
+
+# Gateway priorities, lower is served first
+PRIORITY_CHAT = 0
+PRIORITY_SMART_REPLY = 1
+PRIORITY_BACKGROUND = 2
+
+class CircuitOpenError(Exception):
+    """The model has been failing; calls are rejected until the breaker resets."""
+
+class RateLimitedError(Exception):
+    """The user made too many model calls in the current window."""
+
+class ModelGateway:
+    """
+    Admission control in front of the model: a bounded number of concurrent
+    calls handed out by priority, per-user rate limits, and a circuit breaker
+    that rejects calls outright while the model keeps failing.
+    """
+    def __init__(self, max_concurrency=4, call_timeout=20.0, rate_limit=20, rate_window=60.0,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.max_concurrency = max_concurrency
+        self.call_timeout = call_timeout
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._free_slots = max_concurrency
+        self._waiters = []  # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+        self._user_calls = {}  # username -> deque of call start times
+
+        self.breaker_state = 'closed'
+        self._consecutive_failures = 0
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+
+        self.stats = {
+            'calls': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'rejected_open': 0,
+            'rate_limited': 0
+        }
+        # Time admitted calls spent waiting for a slot
+        self.queue_wait = Histogram()
+        # Duration of admitted calls, from getting a slot to finishing
+        self.latency = Histogram()
+
+    def snapshot(self):
+        """Breaker state, queue length and counters for metrics."""
+        return {
+            **self.stats,
+            'breaker_state': self.breaker_state,
+            'in_flight': self.max_concurrency - self._free_slots,
+            'queued': sum(1 for _, _, waiter in self._waiters if not waiter.done())
+        }
+
+    def _admit(self, user):
+        now = time.monotonic()
+        if self.breaker_state == 'open':
+            if now - self._opened_at < self.reset_timeout:
+                self.stats['rejected_open'] += 1
+                raise CircuitOpenError("AI model circuit breaker is open")
+            self.breaker_state = 'half_open'
+        if self.breaker_state == 'half_open':
+            # Let exactly one trial call through to probe the model
+            if self._trial_in_flight:
+                self.stats['rejected_open'] += 1
+                raise CircuitOpenError("AI model circuit breaker is half-open")
+            self._trial_in_flight = True
+
+        if user is not None and self.rate_limit:
+            calls = self._user_calls.setdefault(user, deque())
+            while calls and now - calls[0] > self.rate_window:
+                calls.popleft()
+            if len(calls) >= self.rate_limit:
+                self._trial_in_flight = False
+                self.stats['rate_limited'] += 1
+                raise RateLimitedError(f"Rate limit exceeded for {user}")
+            calls.append(now)
+
+    async def _acquire(self, priority):
+        # Free slots only exist while nobody is waiting: _release hands slots to waiters first
+        if self._free_slots > 0:
+            self._free_slots -= 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled
+                self._release()
+            else:
+                waiter.cancel()
+            raise
+
+    def _release(self):
+        while self._waiters:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self._free_slots += 1
+
+    def _record(self, success):
+        self._trial_in_flight = False
+        if success:
+            self._consecutive_failures = 0
+            if self.breaker_state != 'closed':
+                logger.info("AI model circuit breaker closed")
+            self.breaker_state = 'closed'
+            return
+        self.stats['failures'] += 1
+        self._consecutive_failures += 1
+        if self.breaker_state == 'half_open' or self._consecutive_failures >= self.failure_threshold:
+            if self.breaker_state != 'open':
+                logger.warning(f"AI model circuit breaker opened after {self._consecutive_failures} failures")
+            self.breaker_state = 'open'
+            self._opened_at = time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, priority, user=None):
+        """
+        Hold a model slot for the duration of the block.
+
+        Raises CircuitOpenError or RateLimitedError without waiting when the
+        call is not allowed. An exception in the block counts as a model failure.
+        """
+        self._admit(user)
+        queued_at = time.monotonic()
+        try:
+            await self._acquire(priority)
+        except BaseException:
+            self._trial_in_flight = False
+            raise
+        self.queue_wait.observe(time.monotonic() - queued_at)
+        self.stats['calls'] += 1
+
+        started = time.perf_counter()
+        recorded = False
+        try:
+            yield
+        except asyncio.TimeoutError:
+            self.stats['timeouts'] += 1
+            self._record(False)
+            recorded = True
+            raise
+        except Exception:
+            self._record(False)
+            recorded = True
+            raise
+        else:
+            self._record(True)
+            recorded = True
+        finally:
+            if not recorded:
+                # Cancelled: neither success nor failure, but free the trial
+                self._trial_in_flight = False
+            self.latency.observe(time.perf_counter() - started)
+            self._release()
+
+    async def call(self, fn, *args, priority=PRIORITY_CHAT, user=None, timeout=None):
+        """
+        Run a blocking model call on a worker thread under admission control
+        and a deadline. The thread itself cannot be interrupted; on timeout it
+        finishes in the background while the caller moves on.
+        """
+        async with self.admit(priority, user):
+            return await asyncio.wait_for(asyncio.to_thread(fn, *args), timeout or self.call_timeout)
+
+class ConversationKeys(LRUCache):
+    """
+    Conversation -> smart reply fingerprints cached for it, bounded like the
+    cache itself. A conversation pushed out of here has its fingerprints
+    dropped from the cache too, so invalidation never misses one.
+    """
+    def __init__(self, maxsize, cache):
+        super().__init__(maxsize=maxsize)
+        self.cache = cache
+
+    def popitem(self):
+        conversation, keys = super().popitem()
+        for key in keys:
+            self.cache.pop(key, None)
+        return conversation, keys
+
 class AIAssistant:
-    def __init__(self, api_key):
+    def __init__(self, api_key, smart_reply_cache_size=2048, smart_reply_cache_ttl=600, gateway=None, model=None,
+                 local_replies=None):
+        self.gateway = gateway or ModelGateway()
+        # Optional reply_index.LocalReplySuggester tried before the model
+        self.local_replies = local_replies
+        if model is not None:
+            # An injected model (e.g. a local fake) skips the Gemini client setup
+            self.model = model
+        else:
+            self._configure_gemini(api_key)
+        # Time from getting a model slot to the first streamed chunk
+        self.time_to_first_token = Histogram()
+
+        # Smart replies by context fingerprint -> (suggestions, model latency)
+        self.smart_reply_cache = TTLCache(maxsize=smart_reply_cache_size, ttl=smart_reply_cache_ttl)
+        self._smart_reply_inflight = {}  # fingerprint -> future shared by identical requests
+        self._smart_reply_joined = {}  # fingerprint -> callers waiting on another caller's model call
+        self._inflight_by_conversation = {}  # conversation -> fingerprint of its model call in flight
+        self._smart_reply_keys = ConversationKeys(smart_reply_cache_size, self.smart_reply_cache)
+        self.smart_reply_stats = {'hits': 0, 'misses': 0, 'shared': 0, 'local': 0, 'saved_latency': 0.0}
+        # Canned answers served instead of a model response, by request kind
+        self.fallback_stats = {'chat': 0, 'smart_replies': 0}
+
+    def _configure_gemini(self, api_key):
         # Prefer v1 REST; fall back if this client version lacks api_version support
         try:
             genai.configure(
@@ -32,25 +256,262 @@ class AIAssistant:
             except Exception:
                 continue
 
-    async def get_response(self, message):
+    @staticmethod
+    def estimate_tokens(text):
+        """
+        Rough token count (about four characters per token), good enough for budgeting.
+        """
+        return len(text) // 4 + 1
+
+    def build_prompt(self, message, turns, summary=None, token_budget=2000):
+        """
+        Build a prompt that gives the model conversation memory within a token budget.
+
+        Args:
+            message (str): The user's new message, always included
+            turns (list): Recent messages, oldest first, each with 'from' and 'content'
+            summary (str): Rolling summary of turns older than the recent ones
+            token_budget (int): Upper bound for the whole prompt
+
+        Returns:
+            str: The prompt to send to the model
+        """
+        if not turns and not summary:
+            return message
+
+        header = "You are a helpful assistant in a chat app. Continue the conversation below."
+        new_turn = f"User: {message}\nAssistant:"
+        remaining = token_budget - self.estimate_tokens(header) - self.estimate_tokens(new_turn)
+
+        summary_block = ''
+        if summary and remaining > 0:
+            # The summary may use at most half of what is left; recent turns get the rest
+            max_chars = (remaining // 2) * 4
+            summary_block = f"Summary of the earlier conversation: {summary[:max_chars]}"
+            remaining -= self.estimate_tokens(summary_block)
+
+        # Keep the most recent turns that fit
+        lines = []
+        for turn in reversed(turns):
+            speaker = 'Assistant' if turn['from'] == "AI Assistant" else 'User'
+            line = f"{speaker}: {turn['content']}"
+            cost = self.estimate_tokens(line)
+            if cost > remaining:
+                break
+            lines.append(line)
+            remaining -= cost
+        lines.reverse()
+
+        return '\n\n'.join(part for part in [header, summary_block, '\n'.join(lines), new_turn] if part)
+
+    async def summarize(self, previous_summary, turns, max_words=150):
+        """
+        Fold older turns into the rolling conversation summary.
+        Returns the new summary, or None if the model call failed.
+        """
+        transcript = '\n'.join(
+            f"{'Assistant' if turn['from'] == 'AI Assistant' else 'User'}: {turn['content']}"
+            for turn in turns
+        )
+        prompt = f"""Update the summary of a conversation between a user and an assistant.
+
+Current summary: {previous_summary or '(none)'}
+
+New messages:
+{transcript}
+
+Write an updated summary in at most {max_words} words. Keep facts, preferences and open questions the assistant should remember."""
         try:
-            response = self.model.generate_content(message)
+            response = await self.gateway.call(self.model.generate_content, prompt, priority=PRIORITY_BACKGROUND)
+            return getattr(response, 'text', '').strip() or None
+        except Exception as e:
+            logger.error(f"Error summarizing conversation: {e}")
+            return None
+
+    async def get_response(self, message, user=None):
+        try:
+            # generate_content blocks for the whole round-trip, the gateway runs it off the event loop
+            response = await self.gateway.call(self.model.generate_content, message, priority=PRIORITY_CHAT, user=user)
             return getattr(response, 'text', '')
         except Exception as e:
             # Fallback response on failure
-            return "Sorry, I couldn't generate a response right now."
+            self.fallback_stats['chat'] += 1
+            return FALLBACK_RESPONSE
+
+    async def stream_response(self, message, user=None):
+        """
+        Stream the model's reply as it is generated.
+
+        The blocking streaming iterator is consumed on a worker thread and
+        chunks are handed back to the event loop through a queue. The whole
+        stream shares one gateway slot and one deadline.
+
+        Yields:
+            str: Partial response text, in order
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+
+        def produce():
+            try:
+                for chunk in self.model.generate_content(message, stream=True):
+                    text = getattr(chunk, 'text', '')
+                    if text:
+                        loop.call_soon_threadsafe(queue.put_nowait, text)
+            except Exception as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(queue.put_nowait, done)
+
+        received_any = False
+        try:
+            async with self.gateway.admit(PRIORITY_CHAT, user):
+                started = time.perf_counter()
+                deadline = loop.time() + self.gateway.call_timeout
+                # Runs to completion in the background even if we stop reading
+                loop.run_in_executor(None, produce)
+                while True:
+                    item = await asyncio.wait_for(queue.get(), deadline - loop.time())
+                    if item is done:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    if not received_any:
+                        received_any = True
+                        self.time_to_first_token.observe(time.perf_counter() - started)
+                    yield item
+        except Exception as e:
+            logger.error(f"Error streaming AI response: {e!r}")
+            if not received_any:
+                # Fallback response on failure
+                self.fallback_stats['chat'] += 1
+                yield FALLBACK_RESPONSE
+
+    @staticmethod
+    def smart_reply_fingerprint(context, num_suggestions):
+        """
+        Cache key for a smart reply request: a hash of the normalized text of
+        the messages the prompt uses, plus the number of suggestions.
+        """
+        last_messages = context.get('messages', [])[-2:]
+        normalized = [' '.join(str(msg.get('content', '')).lower().split()) for msg in last_messages]
+        payload = json.dumps([normalized, num_suggestions])
+        return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+    def invalidate_smart_replies(self, conversation):
+        """
+        Forget cached suggestions for a conversation after a new message lands in it.
+        """
+        for key in self._smart_reply_keys.pop(conversation, ()):
+            self.smart_reply_cache.pop(key, None)
+
+    def smart_replies_awaited(self, conversation):
+        """
+        Whether other callers are waiting on the model call started for a
+        conversation, so cancelling its task would make them start over.
+        """
+        key = self._inflight_by_conversation.get(conversation)
+        return key is not None and self._smart_reply_joined.get(key, 0) > 0
 
-    async def generate_smart_replies(self, context, num_suggestions=2):
+    async def generate_smart_replies(self, context, num_suggestions=2, conversation=None, user=None,
+                                     priority=PRIORITY_SMART_REPLY):
         """
         Generate smart reply suggestions based on chat context.
+
+        Results are cached by context fingerprint. On a miss the local reply
+        index answers if it is confident, otherwise identical requests made
+        while one is in flight share a single model call. If that call is
+        cancelled or ends in a fallback, one of the waiting requests makes
+        the call itself instead.
         
         Args:
             context (dict): Contains recent messages, sender, recipient
             num_suggestions (int): Number of reply suggestions to generate
+            conversation (str): Conversation key used to invalidate cached suggestions
+            user (str): Requesting user, for rate limiting
+            priority (int): Gateway priority of the model call
         
         Returns:
             list: Smart reply suggestions
         """
+        key = self.smart_reply_fingerprint(context, num_suggestions)
+        while True:
+            cached = self.smart_reply_cache.get(key)
+            if cached is not None:
+                suggestions, latency = cached
+                self.smart_reply_stats['hits'] += 1
+                self.smart_reply_stats['saved_latency'] += latency
+                return list(suggestions)
+
+            local = self._local_smart_replies(context, num_suggestions)
+            if local:
+                self.smart_reply_stats['local'] += 1
+                return local
+
+            inflight = self._smart_reply_inflight.get(key)
+            if inflight is None:
+                break
+            self._smart_reply_joined[key] = self._smart_reply_joined.get(key, 0) + 1
+            try:
+                shared = await asyncio.shield(inflight)
+            finally:
+                self._smart_reply_joined[key] -= 1
+                if not self._smart_reply_joined[key]:
+                    del self._smart_reply_joined[key]
+            # None: the call was cancelled or only got a fallback, so try again
+            if shared is not None:
+                self.smart_reply_stats['shared'] += 1
+                return list(shared)
+
+        self.smart_reply_stats['misses'] += 1
+        inflight = asyncio.get_running_loop().create_future()
+        self._smart_reply_inflight[key] = inflight
+        if conversation is not None:
+            self._inflight_by_conversation[conversation] = key
+        shared = None
+        try:
+            started = time.perf_counter()
+            suggestions, cacheable = await self._request_smart_replies(context, num_suggestions, user, priority)
+            # Canned fallbacks are not cached so the next request tries the model again
+            if cacheable:
+                self.smart_reply_cache[key] = (suggestions, time.perf_counter() - started)
+                if conversation is not None:
+                    # Forget fingerprints the cache has already expired or evicted
+                    keys = {k for k in self._smart_reply_keys.get(conversation, ()) if k in self.smart_reply_cache}
+                    keys.add(key)
+                    self._smart_reply_keys[conversation] = keys
+                shared = suggestions
+            return list(suggestions)
+        finally:
+            self._smart_reply_inflight.pop(key, None)
+            if self._inflight_by_conversation.get(conversation) == key:
+                del self._inflight_by_conversation[conversation]
+            inflight.set_result(shared)
+
+    def _local_smart_replies(self, context, num_suggestions):
+        """
+        Suggestions from the local reply index for the latest message, or None
+        when there is no index or it is not confident enough.
+        """
+        last_messages = context.get('messages', [])
+        if self.local_replies is None or not last_messages:
+            return None
+        try:
+            suggestions, _confidence = self.local_replies.suggest(last_messages[-1].get('content', ''), num_suggestions)
+        except Exception as e:
+            logger.error(f"Error querying local reply index: {e}")
+            return None
+        # Partial answers go to the model so the client still gets num_suggestions
+        if len(suggestions) < num_suggestions:
+            return None
+        return suggestions
+
+    async def _request_smart_replies(self, context, num_suggestions, user=None, priority=PRIORITY_SMART_REPLY):
+        """
+        Ask the model for smart replies.
+        Returns (suggestions, cacheable); cacheable is False for fallbacks.
+        """
         try:
             # Extract last few messages from context
             last_messages = context.get('messages', [])
@@ -69,11 +530,13 @@ Please provide short, natural responses that someone might use as a quick reply.
 
 Format your response as a JSON array of strings."""
             
-            response = self.model.generate_content(prompt)
+            response = await self.gateway.call(
+                self.model.generate_content, prompt,
+                priority=priority, user=user
+            )
             
             # Parse the response, handling potential JSON parsing issues
             try:
-                import json
                 suggestions = json.loads(response.text)
                 
                 # Fallback to text parsing if JSON fails
@@ -87,16 +550,18 @@ Format your response as a JSON array of strings."""
                     if suggestion.strip() and len(suggestion) <= 50
                 ]
                 
-                return suggestions[:num_suggestions]
+                return suggestions[:num_suggestions], True
             
             except Exception:
                 # If parsing fails, generate manual suggestions
-                fallback_suggestions = [
-                    "Got it, thanks!",
-                    "Can you explain more?"
-                ]
-                return fallback_suggestions
+                self.fallback_stats['smart_replies'] += 1
+                return list(FALLBACK_SMART_REPLIES), False
 
+        except (CircuitOpenError, RateLimitedError, asyncio.TimeoutError) as e:
+            # Fail fast to the canned suggestions while the model is unavailable
+            logger.warning(f"Smart replies served from fallback: {e!r}")
+            self.fallback_stats['smart_replies'] += 1
+            return list(FALLBACK_SMART_REPLIES), False
         except Exception as e:
-            print(f"Error generating smart replies: {e}")
-            return []
\ No newline at end of file
+            logger.error(f"Error generating smart replies: {e}")
+            return [], False
\ No newline at end of file
@@ -0,0 +1,103 @@
+"""
+Helpers shared by the benchmarks: percentiles, process memory, the
+JSON result files that compare.py diffs between commits, and the
+mongomock workarounds the tests use too.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers, or None if it is empty."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def latency_summary(seconds):
+    """Count and p50/p99/max in milliseconds for a list of durations in seconds."""
+    return {
+        'count': len(seconds),
+        'p50_ms': _ms(percentile(seconds, 50)),
+        'p99_ms': _ms(percentile(seconds, 99)),
+        'max_ms': _ms(max(seconds, default=None))
+    }
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+def rss_bytes(pid='self'):
+    """
+    Current and peak resident memory of a process, from /proc on Linux.
+    Returns (None, None) where /proc is not available.
+    """
+    try:
+        with open(f'/proc/{pid}/status') as status:
+            fields = dict(line.split(':', 1) for line in status if ':' in line)
+    except OSError:
+        return None, None
+    def kib(name):
+        value = fields.get(name)
+        return int(value.split()[0]) * 1024 if value else None
+    return kib('VmRSS'), kib('VmHWM')
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def save_results(name, config, results, path=None):
+    """
+    Write a result file and return its path. Files are named after the
+    benchmark, the commit and the time, so runs from different commits sit
+    side by side in benchmarks/results/.
+    """
+    commit = git_commit()
+    document = {
+        'benchmark': name,
+        'commit': commit,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': config,
+        'results': results
+    }
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f"{name}-{commit or 'nocommit'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    with open(path, 'w') as out:
+        json.dump(document, out, indent=2, default=str)
+    return path
+
+def patch_mongomock():
+    """
+    Work around the mongomock gaps the app runs into, for the benchmark
+    server and the test suite alike.
+    """
+    import mongomock.aggregate
+    import mongomock.collection
+
+    # pymongo 4.11+ passes sort= to bulk updates, which mongomock does not accept yet
+    add_update = mongomock.collection.BulkOperationBuilder.add_update
+    def add_update_without_sort(self, *args, sort=None, **kwargs):
+        return add_update(self, *args, **kwargs)
+    mongomock.collection.BulkOperationBuilder.add_update = add_update_without_sort
+
+    # MongoDB evaluates the items of an array literal as expressions; mongomock
+    # keeps them as-is, so the reaction pipeline would store {'$literal': ...}
+    parse_basic_expression = mongomock.aggregate._Parser._parse_basic_expression
+    def parse_array_items(self, expression):
+        if isinstance(expression, list):
+            return [self.parse(item) for item in expression]
+        return parse_basic_expression(self, expression)
+    mongomock.aggregate._Parser._parse_basic_expression = parse_array_items
@@ -0,0 +1,92 @@
+"""
+Diff two benchmark result files, usually from two commits:
+
+    python -m benchmarks.compare benchmarks/results/load-abc123-....json \\
+        benchmarks/results/load-def456-....json --threshold 10
+
+Every numeric leaf under 'results' is compared. Whether a change is a
+regression depends on the metric: throughput and rates should go up,
+latency, bytes, memory, CPU and frame counts should go down. Anything else
+is listed but never fails the run. Exits with status 1 if any metric got
+worse by more than the threshold.
+"""
+import argparse
+import json
+import sys
+
+HIGHER_IS_BETTER = ('throughput', 'per_sec', 'hit_rate', 'answered')
+LOWER_IS_BETTER = ('latency', 'p50', 'p99', 'max_ms', '_us', '_ms', 'bytes', 'rss', 'cpu', 'frames', 'errors', 'seconds')
+
+def flatten(value, prefix=''):
+    """Yield (dotted.path, number) for every numeric leaf of a result tree."""
+    if isinstance(value, dict):
+        for key, child in value.items():
+            yield from flatten(child, f'{prefix}.{key}' if prefix else str(key))
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+def direction(path):
+    """+1 if higher is better, -1 if lower is better, 0 if unknown."""
+    leaf = path.rsplit('.', 1)[-1]
+    if any(marker in leaf for marker in HIGHER_IS_BETTER):
+        return 1
+    if any(marker in path for marker in LOWER_IS_BETTER):
+        return -1
+    return 0
+
+def compare(baseline, candidate, threshold):
+    """
+    Returns a list of (path, before, after, percent_change, verdict) rows,
+    where verdict is 'regressed', 'improved', 'changed' or ''.
+    """
+    before = dict(flatten(baseline['results']))
+    after = dict(flatten(candidate['results']))
+    rows = []
+    for path in sorted(set(before) & set(after)):
+        old, new = before[path], after[path]
+        if old == 0:
+            change = 0.0 if new == 0 else float('inf')
+        else:
+            change = (new - old) / abs(old) * 100
+        sign = direction(path)
+        verdict = ''
+        if abs(change) > threshold:
+            if sign == 0:
+                verdict = 'changed'
+            elif change * sign < 0:
+                verdict = 'regressed'
+            else:
+                verdict = 'improved'
+        rows.append((path, old, new, change, verdict))
+    return rows
+
+def load(path):
+    with open(path) as result:
+        return json.load(result)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent change that counts (default 10)')
+    parser.add_argument('--all', action='store_true', help='also list metrics within the threshold')
+    options = parser.parse_args()
+
+    baseline, candidate = load(options.baseline), load(options.candidate)
+    if baseline.get('benchmark') != candidate.get('benchmark'):
+        parser.error(f"cannot compare {baseline.get('benchmark')} with {candidate.get('benchmark')}")
+    if baseline.get('config') != candidate.get('config'):
+        print('warning: the two runs used different configurations', file=sys.stderr)
+
+    print(f"{baseline.get('benchmark')}: {baseline.get('commit')} -> {candidate.get('commit')}")
+    rows = compare(baseline, candidate, options.threshold)
+    for path, old, new, change, verdict in rows:
+        if verdict or options.all:
+            print(f'{path:<60} {old:>14g} {new:>14g} {change:>+9.1f}%  {verdict}')
+
+    regressions = [row for row in rows if row[4] == 'regressed']
+    print(f'{len(rows)} metrics compared, {len(regressions)} regressed by more than {options.threshold:g}%')
+    sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,481 @@
+"""
+Load test for the WebSocket server.
+
+Starts the app from main.py in child processes against mongomock (or a
+local mongod with --mongo-uri) and a fake model. Then N simulated clients
+drive it through a mix of frame types for a fixed time. Each client sends
+one request, waits for its response and repeats, so latency is measured
+per request from the client's side.
+
+With --workers above 1, each worker is its own server process and clients
+are spread over them round-robin, so most friends sit on another worker
+and every delivery crosses the broker. The broker is Redis at --broker-url,
+or the stand-in from benchmarks/pubsub.py. Under mongomock every worker has
+a private database: deliveries cross workers, but reads only see what that
+worker wrote. Use --mongo-uri for a shared database.
+
+The large_history mix measures what a whole-conversation load does to
+everyone else: the first --history-loaders clients repeatedly load their
+--large-history message conversation without pagination
+(large_history latency), while the others send messages and typing
+frames. Their message p99 is the impact; compare it with a run using
+--history-loaders 0.
+
+Reported: throughput, messages delivered per second, p50/p99 latency per
+operation, errors, frames received, and the servers' memory and /metrics
+counters (summed over workers). Results are written to benchmarks/results/
+as JSON for compare.py.
+
+Run from the backend directory:
+
+    python -m benchmarks.load_test --clients 200 --duration 30 --mix chat
+    python -m benchmarks.load_test --workers 4 --mix fanout
+    python -m benchmarks.load_test --mix large_history --large-history 10000 --history-loaders 2
+    python -m benchmarks.load_test --mongo-uri mongodb://localhost:27017 --seed-messages 1000000 --mix search
+"""
+import argparse
+import asyncio
+import itertools
+import multiprocessing
+import random
+import socket
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from benchmarks import pubsub, server
+from benchmarks.common import latency_summary, rss_bytes, save_results
+
+# Relative weights of the operations each client picks from
+MIXES = {
+    'chat': {'message': 55, 'typing': 25, 'reaction': 5, 'history': 10, 'smart_replies': 5},
+    'typing_storm': {'typing': 90, 'message': 10},
+    'hot_reactions': {'hot_reaction': 80, 'message': 20},
+    'history': {'history': 70, 'message': 30},
+    'search': {'search': 70, 'message': 30},
+    'ai': {'smart_replies': 60, 'ai_message': 10, 'message': 30},
+    'reconnect': {'reconnect': 20, 'message': 60, 'typing': 20},
+    # Only frames that fan out to another user, for broker and worker scaling runs
+    'fanout': {'message': 80, 'typing': 20},
+    # Clients other than the --history-loaders, while those load whole conversations
+    'large_history': {'message': 70, 'typing': 30},
+}
+
+# Mixes that need a real mongod, and what mongomock gets wrong for them
+MONGOD_ONLY_MIXES = {
+    'search': 'mongomock has no text search',
+}
+
+class BenchClient:
+    """One simulated user: a socket, a reader task and one request in flight at a time."""
+    def __init__(self, index, options, session, stats):
+        self.index = index
+        self.username = server.username(index)
+        self.friends = [server.username(friend) for friend in
+                        server.friend_indexes(index, options.clients, options.friends)]
+        self.options = options
+        self.session = session
+        self.stats = stats
+        self.rng = random.Random(options.seed * 100003 + index)
+        self.binary = options.protocol == 'msgpack'
+        self.websocket = None
+        self.reader = None
+        self.waiter = None  # (predicate, future) for the request in flight
+        self.sent_ids = []  # ids of this client's acknowledged messages
+        self.last_seq = None
+        self.client_ids = itertools.count()
+        self.typing = False
+
+    async def connect(self):
+        protocols = ('msgpack',) if self.binary else ()
+        port = self.options.ports[self.index % len(self.options.ports)]
+        self.websocket = await self.session.ws_connect(
+            f'http://127.0.0.1:{port}/ws', protocols=protocols, max_msg_size=0
+        )
+        self.reader = asyncio.create_task(self._read())
+        register = {'type': 'register', 'username': self.username, 'batch': True}
+        if self.last_seq is not None:
+            register['last_seq'] = self.last_seq
+        # The register handler ends with a presence frame covering every friend
+        await self.request('register', register, lambda frame: (
+            frame.get('type') == 'presence' and len(frame['updates']) == len(self.friends)
+        ))
+
+    async def close(self):
+        if self.websocket is not None:
+            await self.websocket.close()
+        if self.reader is not None:
+            self.reader.cancel()
+
+    async def send(self, frame):
+        if self.binary:
+            await self.websocket.send_bytes(msgpack.packb(frame, use_bin_type=True))
+        else:
+            await self.websocket.send_json(frame)
+
+    async def request(self, operation, frame, predicate):
+        """Send a frame and wait for the response matching predicate, recording latency."""
+        future = asyncio.get_running_loop().create_future()
+        self.waiter = (predicate, future)
+        started = time.perf_counter()
+        await self.send(frame)
+        try:
+            ok = await asyncio.wait_for(future, self.options.timeout)
+        except asyncio.TimeoutError:
+            ok = False
+            self.stats.errors[f'{operation}:timeout'] += 1
+        finally:
+            self.waiter = None
+        if ok:
+            self.stats.latency[operation].append(time.perf_counter() - started)
+        return ok
+
+    async def _read(self):
+        async for message in self.websocket:
+            if message.type == aiohttp.WSMsgType.BINARY:
+                frame = msgpack.unpackb(message.data, raw=False)
+            elif message.type == aiohttp.WSMsgType.TEXT:
+                frame = message.json()
+            else:
+                continue
+            frames = frame['frames'] if frame.get('type') == 'batch' else [frame]
+            for frame in frames:
+                self._handle(frame)
+
+    def _handle(self, frame):
+        frame_type = frame.get('type')
+        self.stats.frames_in[frame_type] += 1
+        if frame_type == 'sync_position':
+            self.last_seq = frame['seq']
+        elif frame_type == 'sync':
+            self.last_seq = frame['seq']
+        elif frame_type == 'ack':
+            self.sent_ids.append(frame['_id'])
+            del self.sent_ids[:-20]
+        if self.waiter is None:
+            return
+        predicate, future = self.waiter
+        if future.done():
+            return
+        if frame_type == 'error':
+            self.stats.errors[frame.get('message', 'error')] += 1
+            future.set_result(False)
+        elif predicate(frame):
+            future.set_result(True)
+
+    def peer(self):
+        return self.rng.choice(self.friends) if self.friends else self.username
+
+    def loads_history(self):
+        return self.options.mix == 'large_history' and self.index < self.options.history_loaders
+
+    async def run(self, deadline):
+        mix = {'large_history': 1} if self.loads_history() else MIXES[self.options.mix]
+        operations, weights = zip(*mix.items())
+        while time.perf_counter() < deadline:
+            operation = self.rng.choices(operations, weights)[0]
+            await getattr(self, f'op_{operation}')()
+            self.stats.operations[operation] += 1
+            if self.options.think_ms:
+                await asyncio.sleep(self.rng.uniform(0, 2 * self.options.think_ms) / 1000)
+
+    async def op_message(self):
+        client_id = f'{self.username}-{next(self.client_ids)}'
+        words = ' '.join(self.rng.choice(server.VOCABULARY) for _ in range(8))
+        await self.request('message', {
+            'type': 'message', 'from': self.username, 'to': self.peer(),
+            'content': words, 'clientId': client_id
+        }, lambda frame: frame.get('type') == 'ack' and frame.get('clientId') == client_id)
+
+    # Typing and hot reactions get no reply addressed to the sender; they count
+    # towards throughput, and their server-side latency is in the /metrics histograms
+
+    async def op_typing(self):
+        self.typing = not self.typing
+        await self.send({'type': 'typing_status', 'from': self.username, 'to': self.peer(), 'isTyping': self.typing})
+
+    async def _react(self, message_id):
+        await self.request('reaction', {
+            'type': 'message_reaction', 'messageId': message_id,
+            'from': self.username, 'emoji': self.rng.choice(['👍', '❤️', '😂'])
+        }, lambda frame: frame.get('type') == 'reaction_update' and frame.get('messageId') == message_id)
+
+    async def op_reaction(self):
+        if not self.sent_ids:
+            return await self.op_message()
+        await self._react(self.rng.choice(self.sent_ids))
+
+    async def op_hot_reaction(self):
+        # Everyone reacts to the same message, the first one client 0 sent;
+        # only its two participants are sent reaction updates
+        if self.stats.hot_message_id is None:
+            return await self.op_message()
+        await self.send({
+            'type': 'message_reaction', 'messageId': self.stats.hot_message_id,
+            'from': self.username, 'emoji': self.rng.choice(['👍', '❤️', '😂'])
+        })
+
+    async def op_history(self):
+        await self.request('history', {
+            'type': 'load_chat_history', 'from': self.username, 'to': self.peer(), 'limit': 50
+        }, lambda frame: frame.get('type') == 'chat_history')
+
+    async def op_large_history(self):
+        # No limit: the server sends the whole conversation seeded with the next client
+        await self.request('large_history', {
+            'type': 'load_chat_history', 'from': self.username,
+            'to': server.username(server.history_peer(self.index, self.options.clients))
+        }, lambda frame: frame.get('type') == 'chat_history')
+
+    async def op_smart_replies(self):
+        context = {'messages': [
+            {'from': self.peer(), 'content': ' '.join(self.rng.choice(server.VOCABULARY) for _ in range(6))}
+        ]}
+        await self.request('smart_replies', {
+            'type': 'get_smart_replies', 'from': self.username, 'to': self.peer(), 'context': context
+        }, lambda frame: frame.get('type') == 'smart_replies')
+
+    async def op_ai_message(self):
+        await self.request('ai_message', {
+            'type': 'message', 'from': self.username, 'to': 'AI Assistant', 'content': 'Plan my weekend'
+        }, lambda frame: frame.get('type') == 'message' and frame.get('from') == 'AI Assistant')
+
+    async def op_search(self):
+        query = self.rng.choice(server.VOCABULARY)
+        await self.request('search', {
+            'type': 'search_messages', 'query': query, 'limit': 20
+        }, lambda frame: frame.get('type') == 'search_results')
+
+    async def op_reconnect(self):
+        await self.close()
+        self.stats.operations['disconnect'] += 1
+        started = time.perf_counter()
+        await self.connect()
+        self.stats.latency['reconnect_total'].append(time.perf_counter() - started)
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.operations = Counter()
+        self.errors = Counter()
+        self.frames_in = Counter()
+        self.hot_message_id = None
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        return probe.getsockname()[1]
+
+def parse_metrics(text):
+    """
+    Split a Prometheus text response into plain samples and histogram
+    buckets: ({series: value}, {series without le: [(le, cumulative count)]}).
+    """
+    samples = {}
+    buckets = defaultdict(list)
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        series, _, value = line.rpartition(' ')
+        if '_bucket{' in series:
+            name, _, labels = series.partition('{')
+            labels, _, bound = labels.rstrip('}').rpartition('le="')
+            key = f"{name[:-len('_bucket')]}{{{labels.rstrip(',')}}}"
+            buckets[key].append((float(bound.rstrip('"')), float(value)))
+        else:
+            samples[series] = float(value)
+    return samples, buckets
+
+def bucket_quantile(buckets, q):
+    """Upper bound in ms of the bucket holding quantile q, like Histogram.quantile."""
+    total = buckets[-1][1] if buckets else 0
+    if not total:
+        return None
+    for bound, count in buckets:
+        if count >= q * total:
+            return bound * 1000
+    return None
+
+def server_latency(buckets):
+    """p50/p99 bucket bounds of the server's handler and database histograms."""
+    return {
+        series: {
+            'count': int(series_buckets[-1][1]),
+            'p50_ms_le': bucket_quantile(series_buckets, 0.5),
+            'p99_ms_le': bucket_quantile(series_buckets, 0.99)
+        }
+        for series, series_buckets in sorted(buckets.items())
+        if series_buckets and series_buckets[-1][1]
+    }
+
+async def drive(options):
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        clients = [BenchClient(index, options, session, stats) for index in range(options.clients)]
+
+        started = time.perf_counter()
+        for start in range(0, len(clients), options.connect_batch):
+            await asyncio.gather(*(client.connect() for client in clients[start:start + options.connect_batch]))
+        connect_time = time.perf_counter() - started
+
+        # One message everyone can react to in the hot_reactions mix
+        await clients[0].op_message()
+        stats.hot_message_id = clients[0].sent_ids[-1] if clients[0].sent_ids else None
+        stats.latency.clear()
+        stats.operations.clear()
+        stats.frames_in.clear()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(client.run(started + options.duration) for client in clients))
+        elapsed = time.perf_counter() - started
+
+        metrics = Counter()
+        buckets = {}
+        for port in options.ports:
+            async with session.get(f'http://127.0.0.1:{port}/metrics') as response:
+                worker_metrics, worker_buckets = parse_metrics(await response.text())
+            metrics.update(worker_metrics)
+            for series, series_buckets in worker_buckets.items():
+                # Every worker uses the same bucket bounds, so counts add up bucket by bucket
+                previous = buckets.get(series)
+                buckets[series] = series_buckets if previous is None else [
+                    (bound, count + other) for (bound, count), (_, other) in zip(previous, series_buckets)
+                ]
+        await asyncio.gather(*(client.close() for client in clients))
+
+    total = sum(stats.operations.values())
+    return {
+        'connect_seconds': round(connect_time, 3),
+        'elapsed_seconds': round(elapsed, 3),
+        'operations': dict(stats.operations),
+        'throughput_per_sec': round(total / elapsed, 1),
+        # Chat messages that reached a recipient's socket
+        'delivered_per_sec': round(stats.frames_in['message'] / elapsed, 1),
+        'latency': {operation: latency_summary(values) for operation, values in sorted(stats.latency.items())},
+        'errors': dict(stats.errors),
+        'frames_in': dict(stats.frames_in),
+        'server_latency': server_latency(buckets),
+        'server_metrics': dict(metrics)
+    }
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=100)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--mix', choices=sorted(MIXES), default='chat')
+    parser.add_argument('--friends', type=int, default=10, help='friends per client')
+    parser.add_argument('--think-ms', type=float, default=0, help='mean pause between requests')
+    parser.add_argument('--protocol', choices=['json', 'msgpack'], default='json')
+    parser.add_argument('--workers', type=int, default=1, help='server processes')
+    parser.add_argument('--broker-url', default=None,
+                        help='Redis for --workers above 1; default is the benchmarks.pubsub stand-in')
+    parser.add_argument('--mongo-uri', default=None, help='local mongod to use instead of mongomock')
+    parser.add_argument('--db-name', default='messenger_bench')
+    parser.add_argument('--seed-messages', type=int, default=5000)
+    parser.add_argument('--large-history', type=int, default=10000,
+                        help='messages in each history loader\'s conversation (large_history mix)')
+    parser.add_argument('--history-loaders', type=int, default=1,
+                        help='clients loading whole conversations in the large_history mix')
+    parser.add_argument('--model-latency', type=float, default=0.2, help='seconds per fake model call')
+    parser.add_argument('--timeout', type=float, default=10)
+    parser.add_argument('--connect-batch', type=int, default=100, help='clients connecting at once')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help='server setting, e.g. --env WRITE_BATCH_SIZE=1; repeatable')
+    parser.add_argument('--out', default=None, help='result file; default benchmarks/results/')
+    return parser
+
+def check_options(parser, options):
+    if options.mix in MONGOD_ONLY_MIXES and not options.mongo_uri:
+        others = ', '.join(sorted(set(MIXES) - set(MONGOD_ONLY_MIXES)))
+        parser.error(f"the {options.mix} mix needs --mongo-uri; {MONGOD_ONLY_MIXES[options.mix]} "
+                     f"(mixes that run on mongomock: {others})")
+    if options.protocol == 'msgpack' and msgpack is None:
+        parser.error("--protocol msgpack needs the msgpack package")
+    if options.workers < 1:
+        parser.error("--workers must be at least 1")
+    if options.mix == 'large_history' and options.history_loaders >= options.clients:
+        parser.error("--history-loaders must leave some clients to measure")
+
+def run(options):
+    """
+    Start the broker stand-in if needed and the server processes, drive
+    them with the clients, stop everything and return the results.
+    """
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    env = dict(setting.split('=', 1) for setting in options.env)
+    try:
+        if options.workers > 1:
+            broker_url = options.broker_url
+            if broker_url is None:
+                ready = context.Queue()
+                pubsub_process = context.Process(target=pubsub.run, args=(free_port(), ready), daemon=True)
+                pubsub_process.start()
+                processes.append(pubsub_process)
+                broker_url = f'redis://127.0.0.1:{ready.get(timeout=60)}'
+            env['BROKER_URL'] = broker_url
+
+        options.ports = [free_port() for _ in range(options.workers)]
+        server_options = {
+            'clients': options.clients,
+            'friends': options.friends,
+            'seed': options.seed,
+            'seed_messages': options.seed_messages,
+            'large_history': options.large_history,
+            'history_loaders': options.history_loaders if options.mix == 'large_history' else 0,
+            'model_latency': options.model_latency,
+            'mongo_uri': options.mongo_uri,
+            'db_name': options.db_name,
+            'env': env
+        }
+        pids = []
+        for worker, port in enumerate(options.ports):
+            ready = context.Queue()
+            worker_options = {**server_options, 'seed_db': worker == 0 or not options.mongo_uri}
+            process = context.Process(target=server.serve, args=(worker_options, port, ready), daemon=True)
+            process.start()
+            processes.append(process)
+            # A shared database must be seeded before the other workers read it
+            pids.append(ready.get(timeout=600))
+
+        results = asyncio.run(drive(options))
+        memory = [rss_bytes(pid) for pid in pids]
+        results['workers'] = options.workers
+        results['server_rss_bytes'] = sum(rss or 0 for rss, _ in memory) or None
+        results['server_peak_rss_bytes'] = sum(peak or 0 for _, peak in memory) or None
+        return results
+    finally:
+        # Servers first: they still publish while shutting down
+        for process in reversed(processes):
+            process.terminate()
+            process.join(30)
+
+def main():
+    parser = build_parser()
+    options = parser.parse_args()
+    check_options(parser, options)
+
+    results = run(options)
+    config = {key: value for key, value in vars(options).items() if key not in ('ports', 'out')}
+    path = save_results(f'load-{options.mix}', config, results, options.out)
+
+    workers = f" on {options.workers} workers" if options.workers > 1 else ''
+    print(f"{options.mix}: {results['throughput_per_sec']} ops/s, {results['delivered_per_sec']} deliveries/s "
+          f"with {options.clients} clients{workers}, "
+          f"server RSS {results['server_rss_bytes'] and results['server_rss_bytes'] // 2**20} MiB")
+    for operation, summary in results['latency'].items():
+        print(f"  {operation:16} n={summary['count']:<7} p50={summary['p50_ms']}ms p99={summary['p99_ms']}ms")
+    if results['errors']:
+        print(f"  errors: {results['errors']}")
+    print(f"Results written to {path}")
+
+if __name__ == '__main__':
+    main()
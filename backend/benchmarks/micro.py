@@ -0,0 +1,318 @@
+"""
+Component benchmarks that need neither a server nor a database.
+
+  protocol         bytes and encode time of a 50-message history page and a
+                   10k-message full history as JSON, MessagePack and
+                   columnar MessagePack, raw and deflated
+  coalescing       frames written for a burst of small frames, with and
+                   without batch frames
+  presence         presence frames and CPU for a reconnect storm of simulated
+                   connections, against one frame per (user, friend) pair
+  reply_index      local smart-reply index build time and lookup latency
+  instrumentation  cost of a histogram observation, a timed Database method
+                   and routing one frame
+  message_cache    MessageCache insert and lookup rate and bytes per entry
+
+Run from the backend directory:
+
+    python -m benchmarks.micro
+    python -m benchmarks.micro --only presence --presence-users 10000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+import zlib
+from collections import defaultdict
+
+import protocol
+from benchmarks.common import latency_summary, save_results
+
+WORDS = 'lunch dinner meeting tomorrow tonight weekend project deadline coffee movie flight hotel'.split()
+
+def timed_loop(fn, iterations):
+    """Microseconds per call of fn, over iterations calls."""
+    started = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    return round((time.perf_counter() - started) / iterations * 1e6, 3)
+
+def history_page(size, rng):
+    return [
+        {
+            'type': 'message',
+            '_id': f'{rng.getrandbits(96):024x}',
+            'from': 'alice' if rng.random() < 0.5 else 'bob',
+            'to': 'bob',
+            'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+            'timestamp': '2026-01-01T12:00:00.000000',
+            'read': True,
+            'readAt': None,
+            'reactions': []
+        }
+        for _ in range(size)
+    ]
+
+# A paginated history page, and a whole conversation as unpaginated clients load it
+HISTORY_SIZES = (50, 10000)
+
+def bench_protocol(options):
+    rng = random.Random(options.seed)
+    results = {}
+    for size in HISTORY_SIZES:
+        messages = history_page(size, rng)
+        frames = {'json_rows': ({'type': 'chat_history', 'chat': messages}, protocol.JSON)}
+        if protocol.msgpack is not None:
+            frames['msgpack_rows'] = ({'type': 'chat_history', 'chat': messages}, protocol.MSGPACK)
+            frames['msgpack_columns'] = (
+                {'type': 'chat_history', 'columns': protocol.columnar_history(messages, 'alice', 'bob')},
+                protocol.MSGPACK
+            )
+        # About 100k messages encoded per format, whatever the size
+        iterations = max(10, 100000 // size)
+        results[f'history_{size}'] = sizes = {}
+        for name, (frame, wire) in frames.items():
+            payload = protocol.encode(frame, wire)
+            raw = payload.encode() if isinstance(payload, str) else payload
+            sizes[name] = {
+                'bytes': len(raw),
+                'deflated_bytes': len(zlib.compress(raw)),
+                'encode_us': timed_loop(lambda: protocol.encode(frame, wire), iterations)
+            }
+    return results
+
+class RecordingSocket:
+    """Accepts frames like a WebSocketResponse and remembers their sizes."""
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_str(self, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+    async def send_bytes(self, data):
+        await self.send_str(data)
+
+    async def close(self, **kwargs):
+        pass
+
+async def _coalescing_run(batching, frames):
+    from connection import ClientConnection
+    socket = RecordingSocket()
+    connection = ClientConnection(socket, max_queue=len(frames) + 1, high_water=len(frames) + 1)
+    connection.batching = batching
+    for frame in frames:
+        connection.send(frame)
+    while connection.depth:
+        await asyncio.sleep(0.001)
+    await asyncio.sleep(0.02)
+    await connection.close()
+    return {'frames_written': socket.frames, 'bytes_written': socket.bytes}
+
+def bench_coalescing(options):
+    rng = random.Random(options.seed)
+    frames = []
+    for index in range(1000):
+        sender = f'user{rng.randrange(50)}'
+        if index % 3:
+            frames.append({'type': 'typing_status', 'from': sender, 'to': 'me', 'isTyping': index % 2 == 0})
+        else:
+            frames.append({'type': 'reaction_update', 'messageId': f'{index:024x}',
+                           'reactions': [{'emoji': '👍', 'count': 1, 'users': [sender]}]})
+    return {
+        'frames_sent': len(frames),
+        'unbatched': asyncio.run(_coalescing_run(False, frames)),
+        'batched': asyncio.run(_coalescing_run(True, frames))
+    }
+
+def bench_presence(options):
+    from presence import PresenceTracker
+
+    users = [f'user{index}' for index in range(options.presence_users)]
+    rng = random.Random(options.seed)
+    friends = {user: rng.sample(users, options.presence_friends) for user in users}
+    delivered = {'frames': 0}
+
+    async def deliver(username, frame):
+        delivered['frames'] += 1
+
+    async def get_friends(username):
+        return friends[username]
+
+    async def save_last_seen(last_seen):
+        pass
+
+    async def storm():
+        tracker = PresenceTracker(deliver, get_friends, save_last_seen)
+        started_cpu = time.process_time()
+        for user in users:
+            tracker.connected(user)
+        await tracker.fan_out()
+        # Half the users drop and come straight back within the same tick
+        for user in users[::2]:
+            tracker.disconnected(user)
+        for user in users[::2]:
+            tracker.connected(user)
+        await tracker.fan_out()
+        await tracker.flush_last_seen()
+        return time.process_time() - started_cpu, tracker.stats
+
+    cpu, stats = asyncio.run(storm())
+    return {
+        'users': len(users),
+        'friends_per_user': options.presence_friends,
+        'frames': delivered['frames'],
+        # Every update would have been a frame of its own without batching
+        'frames_one_per_pair': stats['updates'],
+        'cpu_seconds': round(cpu, 3)
+    }
+
+def bench_reply_index(options):
+    from reply_index import LocalReplySuggester, build_reply_index
+
+    rng = random.Random(options.seed)
+    # A vocabulary the size of everyday chat, so postings lists are not all huge
+    vocabulary = WORDS + [f'word{index}' for index in range(1000)]
+    prompts = [' '.join(rng.sample(vocabulary, 4)) + '?' for _ in range(options.reply_prompts)]
+    # Each prompt answered the same way by three different people, the least the index keeps
+    pairs = []
+    for prompt in prompts:
+        reply = rng.choice(['Sure!', 'Sounds good', 'Not today', 'Maybe later'])
+        pairs.extend((prompt, reply, f'user{replier}') for replier in range(3))
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'reply_index.db')
+        started = time.perf_counter()
+        build_reply_index(pairs, path, min_support=3)
+        build_seconds = time.perf_counter() - started
+
+        suggester = LocalReplySuggester(path, min_similarity=0.5)
+        queries = {
+            'exact': prompts[:500],
+            'fuzzy': [prompt.replace('?', ' please') for prompt in prompts[:500]],
+            'miss': ['completely unrelated words here'] * 500
+        }
+        results = {'prompts': len(prompts), 'build_seconds': round(build_seconds, 3)}
+        for name, texts in queries.items():
+            durations = []
+            answered = 0
+            for text in texts:
+                started = time.perf_counter()
+                suggestions, _ = suggester.suggest(text, 2)
+                durations.append(time.perf_counter() - started)
+                answered += bool(suggestions)
+            results[name] = {**latency_summary(durations), 'answered': answered}
+        suggester.close()
+    return results
+
+def bench_instrumentation(options):
+    from metrics import Histogram
+    from routing import FrameRouter
+    import database
+
+    histogram = Histogram()
+    results = {'histogram_observe_us': timed_loop(lambda: histogram.observe(0.003), 200000)}
+
+    class Plain:
+        async def op(self):
+            return None
+
+    class Timed(Plain):
+        def __init__(self):
+            self.latency = defaultdict(Histogram)
+    Timed.op = database._timed('op', Plain.op)
+
+    async def measure(target, iterations=100000):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await target.op()
+        return (time.perf_counter() - started) / iterations * 1e6
+
+    plain_us = asyncio.run(measure(Plain()))
+    timed_us = asyncio.run(measure(Timed()))
+    results['coroutine_plain_us'] = round(plain_us, 3)
+    results['coroutine_timed_us'] = round(timed_us, 3)
+    results['timed_overhead_us'] = round(timed_us - plain_us, 3)
+
+    class NullConnection:
+        def send(self, message):
+            return True
+
+    router = FrameRouter()
+
+    @router.route('typing_status', {'from': str, 'to': str, 'isTyping': bool}, inline=True)
+    async def handle(session, data):
+        return None
+
+    async def dispatch(iterations=50000):
+        session = router.session(NullConnection())
+        frame = {'type': 'typing_status', 'from': 'a', 'to': 'b', 'isTyping': True}
+        started = time.perf_counter()
+        for _ in range(iterations):
+            await session.dispatch(frame)
+        return (time.perf_counter() - started) / iterations * 1e6
+
+    results['dispatch_inline_us'] = round(asyncio.run(dispatch()), 3)
+    return results
+
+def bench_message_cache(options):
+    from bson import ObjectId
+    from database import MessageCache
+
+    cache = MessageCache(max_bytes=4 * 1024 * 1024, ttl=300)
+    ids = [ObjectId() for _ in range(50000)]
+    started = time.perf_counter()
+    for message_id in ids:
+        cache[message_id] = {'_id': message_id, 'from': 'alice', 'to': 'bob', 'collection': 'messages'}
+    insert_seconds = time.perf_counter() - started
+    started = time.perf_counter()
+    for message_id in ids:
+        cache.lookup(message_id)
+    lookup_seconds = time.perf_counter() - started
+    stats = cache.stats()
+    return {
+        'inserts_per_sec': round(len(ids) / insert_seconds),
+        'lookups_per_sec': round(len(ids) / lookup_seconds),
+        'entries_kept': stats['entries'],
+        'bytes_per_entry': round(stats['bytes'] / max(stats['entries'], 1), 1),
+        'hit_rate': round(stats['hit_rate'], 3)
+    }
+
+BENCHMARKS = {
+    'protocol': bench_protocol,
+    'coalescing': bench_coalescing,
+    'presence': bench_presence,
+    'reply_index': bench_reply_index,
+    'instrumentation': bench_instrumentation,
+    'message_cache': bench_message_cache,
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', default=','.join(BENCHMARKS), help='comma-separated benchmark names')
+    parser.add_argument('--presence-users', type=int, default=10000)
+    parser.add_argument('--presence-friends', type=int, default=50)
+    parser.add_argument('--reply-prompts', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=None, help='result file; default benchmarks/results/')
+    options = parser.parse_args()
+
+    names = [name.strip() for name in options.only.split(',') if name.strip()]
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in names:
+        started = time.perf_counter()
+        results[name] = BENCHMARKS[name](options)
+        print(f"{name} ({time.perf_counter() - started:.1f}s): {json.dumps(results[name])}")
+
+    config = {key: value for key, value in vars(options).items() if key != 'out'}
+    print(f"Results written to {save_results('micro', config, results, options.out)}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+"""
+Local stand-in for Redis pub/sub, so several workers can be load tested
+where no Redis server is installed.
+
+It speaks just enough of the Redis protocol (RESP2, or RESP3 after HELLO)
+for RedisBroker: SUBSCRIBE, UNSUBSCRIBE, PUBLISH and PING, the HSET, HDEL,
+HGETALL and EXPIRE calls behind shared presence, plus the
+HELLO/CLIENT/SELECT calls redis-py makes when it connects. Messages go to
+subscribers in the order they were published, like Redis. It is a single asyncio process, so past a few
+workers it becomes the bottleneck; use --broker-url with a real Redis to
+measure beyond that.
+
+    python -m benchmarks.pubsub --port 6390
+"""
+import argparse
+import asyncio
+import time
+from collections import defaultdict
+
+def _bulk(value):
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+def _array(*items, push=False):
+    # RESP3 sends pub/sub frames as out-of-band pushes
+    return (b'>' if push else b'*') + b'%d\r\n' % len(items) + b''.join(items)
+
+def _hello(protocol):
+    fields = [
+        (b'server', _bulk(b'redis')), (b'version', _bulk(b'7.0.0')), (b'proto', b':%d\r\n' % protocol),
+        (b'id', b':1\r\n'), (b'mode', _bulk(b'standalone')), (b'role', _bulk(b'master')), (b'modules', b'*0\r\n')
+    ]
+    if protocol == 2:
+        return _array(*(part for key, value in fields for part in (_bulk(key), value)))
+    return b'%%%d\r\n' % len(fields) + b''.join(_bulk(key) + value for key, value in fields)
+
+class PubSubServer:
+    def __init__(self):
+        self.channels = defaultdict(set)  # channel -> writers subscribed to it
+        self.resp3 = set()  # writers that switched to RESP3 with HELLO
+        self.hashes = {}  # key -> {field: value}
+        self.expires = {}  # key -> monotonic time the key is deleted
+        self.stats = {'published': 0, 'delivered': 0}
+
+    async def handle(self, reader, writer):
+        subscribed = set()
+        push = False
+        try:
+            while True:
+                command = await self._read_command(reader)
+                if command is None:
+                    break
+                name = command[0].upper()
+                if name in (b'SUBSCRIBE', b'UNSUBSCRIBE'):
+                    subscribing = name == b'SUBSCRIBE'
+                    # UNSUBSCRIBE without channels leaves every channel
+                    targets = command[1:] or (sorted(subscribed) if not subscribing else [])
+                    for channel in targets:
+                        if subscribing:
+                            subscribed.add(channel)
+                            self.channels[channel].add(writer)
+                        else:
+                            subscribed.discard(channel)
+                            self._leave(channel, writer)
+                        writer.write(_array(_bulk(name.lower()), _bulk(channel), b':%d\r\n' % len(subscribed), push=push))
+                elif name == b'PUBLISH':
+                    channel, data = command[1], command[2]
+                    receivers = list(self.channels.get(channel, ()))
+                    frame = _array(_bulk(b'message'), _bulk(channel), _bulk(data))
+                    for receiver in receivers:
+                        receiver.write(b'>' + frame[1:] if receiver in self.resp3 else frame)
+                    self.stats['published'] += 1
+                    self.stats['delivered'] += len(receivers)
+                    writer.write(b':%d\r\n' % len(receivers))
+                elif name in (b'HSET', b'HDEL', b'HGETALL', b'EXPIRE'):
+                    writer.write(self._hash_command(name, command[1], command[2:], push))
+                elif name == b'PING':
+                    if subscribed:
+                        writer.write(_array(_bulk(b'pong'), _bulk(command[1] if len(command) > 1 else b''), push=push))
+                    else:
+                        writer.write(b'+PONG\r\n')
+                elif name == b'HELLO':
+                    protocol = int(command[1]) if len(command) > 1 else 2
+                    push = protocol == 3
+                    if push:
+                        self.resp3.add(writer)
+                    writer.write(_hello(protocol))
+                elif name in (b'CLIENT', b'SELECT'):
+                    writer.write(b'+OK\r\n')
+                else:
+                    writer.write(b"-ERR unknown command '%s'\r\n" % name)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            for channel in subscribed:
+                self._leave(channel, writer)
+            self.resp3.discard(writer)
+            writer.close()
+
+    def _hash_command(self, name, key, args, resp3):
+        if key in self.expires and self.expires[key] <= time.monotonic():
+            self.hashes.pop(key, None)
+            del self.expires[key]
+        fields = self.hashes.get(key, {})
+        if name == b'HSET':
+            pairs = dict(zip(args[::2], args[1::2]))
+            added = len(pairs.keys() - fields.keys())
+            self.hashes.setdefault(key, {}).update(pairs)
+            return b':%d\r\n' % added
+        if name == b'HDEL':
+            removed = sum(fields.pop(field, None) is not None for field in args)
+            if key in self.hashes and not fields:
+                del self.hashes[key]
+                self.expires.pop(key, None)
+            return b':%d\r\n' % removed
+        if name == b'HGETALL':
+            items = [_bulk(part) for pair in fields.items() for part in pair]
+            return b'%%%d\r\n' % len(fields) + b''.join(items) if resp3 else _array(*items)
+        if key not in self.hashes:
+            return b':0\r\n'
+        self.expires[key] = time.monotonic() + int(args[0])
+        return b':1\r\n'
+
+    def _leave(self, channel, writer):
+        writers = self.channels.get(channel)
+        if writers is not None:
+            writers.discard(writer)
+            if not writers:
+                del self.channels[channel]
+
+    @staticmethod
+    async def _read_command(reader):
+        """Read one command sent as an array of bulk strings, or None at EOF."""
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        items = []
+        for _ in range(int(line[1:])):
+            size = int((await reader.readline())[1:])
+            items.append((await reader.readexactly(size + 2))[:-2])
+        return items
+
+async def serve(port, ready=None):
+    pubsub = PubSubServer()
+    listener = await asyncio.start_server(pubsub.handle, '127.0.0.1', port)
+    if ready is not None:
+        ready.put(port)
+    async with listener:
+        await listener.serve_forever()
+
+def run(port, ready=None):
+    """Process entry point: serve until terminated."""
+    asyncio.run(serve(port, ready))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=6390)
+    options = parser.parse_args()
+    run(options.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+Delivery throughput against the number of worker processes.
+
+Runs the load test once per worker count with the same clients and mix
+(fanout by default, where every operation is delivered to another user),
+and reports throughput, deliveries per second and message latency for each.
+Takes every load_test option; with more than one worker the broker is the
+benchmarks.pubsub stand-in unless --broker-url points at Redis.
+
+Scaling needs spare cores: every worker, the load generator and the broker
+stand-in are separate processes. On a machine with fewer cores than that,
+the numbers show the cost of the broker hop rather than scaling.
+
+    python -m benchmarks.scaling --worker-counts 1,2,4 --clients 400 --duration 30
+"""
+import os
+
+from benchmarks import load_test
+from benchmarks.common import save_results
+
+def main():
+    parser = load_test.build_parser()
+    parser.description = __doc__
+    parser.set_defaults(mix='fanout')
+    parser.add_argument('--worker-counts', default='1,2,4', help='comma-separated worker counts to run')
+    options = parser.parse_args()
+    load_test.check_options(parser, options)
+    counts = [int(count) for count in options.worker_counts.split(',') if count.strip()]
+
+    results = {}
+    for count in counts:
+        options.workers = count
+        run = load_test.run(options)
+        message = run['latency'].get('message', {})
+        results[f'workers_{count}'] = {
+            'throughput_per_sec': run['throughput_per_sec'],
+            'delivered_per_sec': run['delivered_per_sec'],
+            'message_p50_ms': message.get('p50_ms'),
+            'message_p99_ms': message.get('p99_ms'),
+            'errors': sum(run['errors'].values()),
+            'server_rss_bytes': run['server_rss_bytes']
+        }
+        print(f"{count} worker(s): {run['throughput_per_sec']} ops/s, {run['delivered_per_sec']} deliveries/s, "
+              f"message p99 {message.get('p99_ms')}ms, errors {run['errors'] or 0}")
+
+    config = {key: value for key, value in vars(options).items() if key not in ('ports', 'out', 'workers')}
+    config['cpus'] = os.cpu_count()
+    print(f"Results written to {save_results('scaling', config, results, options.out)}")
+
+if __name__ == '__main__':
+    main()
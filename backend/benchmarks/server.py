@@ -0,0 +1,174 @@
+"""
+Runs the app from main.py in a child process for the load test, with a
+stand-in MongoDB and a model that answers after a fixed delay.
+
+The server gets its own process, so the load generator does not compete
+with it for the event loop. Its memory is also measured on its own.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import signal
+import sys
+import time
+
+from benchmarks.common import patch_mongomock
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Words the seeded messages are made of, so search queries have something to find
+VOCABULARY = (
+    'lunch dinner meeting tomorrow tonight weekend project deadline coffee movie '
+    'flight hotel birthday party game match train ticket report review budget '
+    'invoice design launch release bug deploy server database cache latency'
+).split()
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class FakeModel:
+    """
+    Stands in for GenerativeModel: generate_content blocks for a fixed time,
+    like the real network call, and returns canned text.
+    """
+    def __init__(self, latency=0.2, chunks=5):
+        self.latency = latency
+        self.chunks = chunks
+
+    def _answer(self, prompt):
+        if 'JSON array' in str(prompt):
+            return json.dumps(['Sounds good!', 'On my way'])
+        return 'This is a benchmark reply from the fake model.'
+
+    def generate_content(self, prompt, stream=False):
+        if stream:
+            return self._stream(prompt)
+        time.sleep(self.latency)
+        return FakeResponse(self._answer(prompt))
+
+    def _stream(self, prompt):
+        words = self._answer(prompt).split()
+        step = max(1, len(words) // self.chunks)
+        for start in range(0, len(words), step):
+            time.sleep(self.latency / self.chunks)
+            yield FakeResponse(' '.join(words[start:start + step]) + ' ')
+
+def username(index):
+    return f'bench{index}'
+
+def friend_indexes(index, clients, friends):
+    """Neighbours on a ring, so every client has the same number of friends."""
+    half = max(1, friends // 2)
+    return sorted({(index + offset) % clients for offset in range(-half, half + 1)} - {index})
+
+def history_peer(index, clients):
+    """The friend whose conversation with a history loader is seeded large."""
+    return (index + 1) % clients
+
+def seed(db, options):
+    """
+    Create the benchmark users, their friendships and a message history
+    directly through pymongo, before the server starts.
+    """
+    clients = options['clients']
+    for name in ('users', 'messages', 'ai_messages', 'unread', 'events', 'event_counters', 'ai_summaries'):
+        db.db[name].delete_many({})
+    db.users.insert_many([
+        {
+            'username': username(index),
+            'friends': [username(friend) for friend in friend_indexes(index, clients, options['friends'])],
+            'friend_requests': []
+        }
+        for index in range(clients)
+    ])
+
+    rng = random.Random(options['seed'])
+    remaining = options['seed_messages']
+    while remaining > 0:
+        batch = []
+        for _ in range(min(remaining, 10000)):
+            sender = rng.randrange(clients)
+            recipient = rng.choice(friend_indexes(sender, clients, options['friends']) or [sender])
+            doc = db._new_message_doc(
+                username(sender), username(recipient),
+                ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randint(4, 16)))
+            )
+            doc['read'] = True
+            batch.append(doc)
+        db.messages.insert_many(batch, ordered=False)
+        remaining -= len(batch)
+    # One long conversation per client that loads whole histories
+    for index in range(options.get('history_loaders', 0)):
+        participants = (username(index), username(history_peer(index, clients)))
+        for start in range(0, options['large_history'], 10000):
+            batch = []
+            for offset in range(start, min(start + 10000, options['large_history'])):
+                doc = db._new_message_doc(
+                    participants[offset % 2], participants[1 - offset % 2],
+                    ' '.join(rng.choice(VOCABULARY) for _ in range(rng.randint(4, 16)))
+                )
+                doc['read'] = True
+                batch.append(doc)
+            db.messages.insert_many(batch, ordered=False)
+    # Seeded documents already carry conversation_id
+    for name in ('messages', 'ai_messages'):
+        db.migrations.update_one({'_id': f'conversation_id:{name}'}, {'$set': {'done': True}}, upsert=True)
+        db.conversation_id_ready[name] = True
+    # and are all read, so there are no unread counts to backfill
+    db.migrations.update_one({'_id': 'unread_counts'}, {'$set': {'done': True}}, upsert=True)
+    db.unread_counts_ready = True
+
+def use_mongomock():
+    """Point database.py at an in-memory mongomock client."""
+    import mongomock
+    import database
+
+    patch_mongomock()
+    database.MongoClient = mongomock.MongoClient
+    os.environ['MONGODB_URI'] = 'mongodb://mongomock'
+    # No change streams in mongomock, and every worker has a database of its own anyway
+    os.environ.setdefault('USER_CACHE_CHANGE_STREAM', '0')
+
+def serve(options, port, ready):
+    """
+    Child process entry point. Puts the server's pid on ready once it
+    accepts connections, then serves until SIGTERM.
+    """
+    sys.path.insert(0, BACKEND_DIR)
+    # Offline recipients are expected here; keep the console to real errors
+    logging.basicConfig(level=logging.ERROR)
+    os.environ.update({key: str(value) for key, value in options['env'].items()})
+    os.environ['MONGODB_DB'] = options['db_name']
+    if options['mongo_uri']:
+        os.environ['MONGODB_URI'] = options['mongo_uri']
+
+    # main.py loads .env with override; it must not point the benchmark at a real deployment
+    import dotenv
+    dotenv.load_dotenv = lambda *args, **kwargs: False
+    if not options['mongo_uri']:
+        use_mongomock()
+
+    import main
+    logging.getLogger().setLevel(logging.ERROR)
+    main.ai_assistant.model = FakeModel(options['model_latency'])
+    # Workers sharing a real database leave seeding to the first one
+    if options.get('seed_db', True):
+        seed(main.db, options)
+
+    async def run():
+        tasks = await main.start_background_tasks()
+        runner = main.web.AppRunner(main.create_app())
+        await runner.setup()
+        await main.web.TCPSite(runner, '127.0.0.1', port).start()
+
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        ready.put(os.getpid())
+        await stop.wait()
+        await runner.cleanup()
+        await main.stop_background_tasks(tasks)
+
+    asyncio.run(run())
@@ -0,0 +1,175 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+class MessageBroker:
+    """
+    Fan-out bus between server processes.
+
+    Every worker keeps its own sockets. Events for a user go to the local socket
+    directly and are published on the broker so that workers holding that
+    user's other connections can deliver them too.
+    """
+    # Whether users may be connected to workers other than this one
+    distributed = False
+
+    def __init__(self):
+        self.worker_id = uuid.uuid4().hex
+        self.deliver = None
+
+    async def start(self, deliver):
+        """
+        Begin receiving events. deliver(username, message) is awaited for each
+        event published by another worker to a user subscribed here.
+        """
+        self.deliver = deliver
+
+    async def subscribe(self, username):
+        """Receive events for a user who connected to this worker."""
+
+    async def unsubscribe(self, username):
+        """Stop receiving events for a user who left this worker."""
+
+    async def publish(self, username, message):
+        """
+        Publish an event for a user to the other workers.
+        Returns the number of workers that received it.
+        """
+        return 0
+
+    async def mark_online(self, usernames, ttl):
+        """
+        Record that users have sockets on this worker. The record lapses after
+        ttl seconds unless renewed, so a crashed worker's users go offline.
+        """
+
+    async def mark_offline(self, username):
+        """Record that a user has no socket left on this worker."""
+
+    async def online_elsewhere(self, usernames):
+        """The users among usernames that have a socket on another worker."""
+        return set()
+
+    async def close(self):
+        """Release broker resources."""
+
+class InMemoryBroker(MessageBroker):
+    """
+    Single-process broker. All sockets live in this worker, so there is
+    nobody else to publish to.
+    """
+
+class RedisBroker(MessageBroker):
+    """
+    Redis pub/sub broker with one channel per user. A worker subscribes to a
+    user's channel only while that user has a socket on it, so publishers
+    reach exactly the workers that can deliver.
+    """
+    distributed = True
+
+    def __init__(self, url, channel_prefix='chat:user:'):
+        super().__init__()
+        try:
+            import redis.asyncio as aioredis
+        except ImportError as e:
+            raise RuntimeError("RedisBroker requires the 'redis' package") from e
+
+        self.redis = aioredis.from_url(url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.channel_prefix = channel_prefix
+        self._subscribed = set()
+        self._listener = None
+
+    def _channel(self, username):
+        return f"{self.channel_prefix}{username}"
+
+    def _presence_key(self, username):
+        # Hash of worker id -> time its record for the user lapses
+        return f"{self.channel_prefix}presence:{username}"
+
+    async def start(self, deliver):
+        await super().start(deliver)
+        # A pubsub connection can only be read once it has a subscription
+        await self.pubsub.subscribe(f"{self.channel_prefix}worker:{self.worker_id}")
+        self._listener = asyncio.create_task(self._listen())
+        logger.info(f"Redis broker started for worker {self.worker_id}")
+
+    async def _listen(self):
+        async for item in self.pubsub.listen():
+            if item.get('type') != 'message':
+                continue
+            try:
+                envelope = json.loads(item['data'])
+                # Our own publications were already delivered locally
+                if envelope['origin'] == self.worker_id:
+                    continue
+                await self.deliver(envelope['username'], envelope['message'])
+            except Exception as e:
+                logger.error(f"Error delivering broker event: {e}")
+
+    async def subscribe(self, username):
+        self._subscribed.add(username)
+        await self.pubsub.subscribe(self._channel(username))
+
+    async def unsubscribe(self, username):
+        self._subscribed.discard(username)
+        await self.pubsub.unsubscribe(self._channel(username))
+
+    async def publish(self, username, message):
+        envelope = json.dumps({
+            'origin': self.worker_id,
+            'username': username,
+            'message': message
+        })
+        receivers = await self.redis.publish(self._channel(username), envelope)
+        # Do not count this worker's own subscription
+        return max(receivers - (1 if username in self._subscribed else 0), 0)
+
+    async def mark_online(self, usernames, ttl):
+        if not usernames:
+            return
+        lapses = time.time() + ttl
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for username in usernames:
+                pipe.hset(self._presence_key(username), self.worker_id, lapses)
+                # Removes the hash once no worker renews it any more
+                pipe.expire(self._presence_key(username), int(ttl) + 1)
+            await pipe.execute()
+
+    async def mark_offline(self, username):
+        await self.redis.hdel(self._presence_key(username), self.worker_id)
+
+    async def online_elsewhere(self, usernames):
+        usernames = list(usernames)
+        if not usernames:
+            return set()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for username in usernames:
+                pipe.hgetall(self._presence_key(username))
+            records = await pipe.execute()
+        now = time.time()
+        own = self.worker_id.encode()
+        return {
+            username
+            for username, workers in zip(usernames, records)
+            if any(worker != own and float(lapses) > now for worker, lapses in workers.items())
+        }
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+        await self.pubsub.aclose()
+        await self.redis.aclose()
+
+def create_broker(url=None):
+    """
+    Build the broker selected by url: redis:// or rediss:// for RedisBroker,
+    anything else for the single-process InMemoryBroker.
+    """
+    if url and url.startswith(('redis://', 'rediss://')):
+        return RedisBroker(url)
+    return InMemoryBroker()
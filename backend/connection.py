@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+import weakref
+from collections import Counter, deque
+from aiohttp import WSCloseCode
+import protocol
+
+logger = logging.getLogger(__name__)
+
+# Frames that only carry transient state: a newer one supersedes a queued one,
+# and they are the first to go when a client falls behind
+COALESCED_TYPES = {'typing_status', 'sync_position'}
+
+# Small frames that may be merged into one 'batch' frame for clients that opted in
+BATCHABLE_TYPES = {'typing_status', 'messages_read', 'reaction_update', 'sync_position'}
+MAX_BATCH_FRAMES = 32
+
+# Totals across all connections on this worker
+outbound_metrics = {
+    'queued': 0,
+    'sent': 0,
+    'bytes_sent': 0,
+    'batches': 0,
+    'batched_frames': 0,
+    'coalesced': 0,
+    'dropped': 0,
+    'evicted': 0
+}
+
+# Frames queued per frame type
+frames_out = Counter()
+
+_live_connections = weakref.WeakSet()
+
+def outbound_snapshot():
+    """
+    Current outbound queue state for metrics: the running totals plus the
+    number of open connections and their total and largest queue depth.
+    """
+    depths = [connection.depth for connection in _live_connections if not connection.closed]
+    return {
+        **outbound_metrics,
+        'connections': len(depths),
+        'queue_depth_total': sum(depths),
+        'queue_depth_max': max(depths, default=0)
+    }
+
+class ClientConnection:
+    """
+    A WebSocket with a bounded outbound queue drained by its own writer task,
+    so a slow client never stalls the handler that sends to it.
+    """
+    def __init__(self, websocket, max_queue=256, high_water=128, slow_consumer_timeout=10.0,
+                 coalesce_window=0.005, coalesce_max_bytes=512):
+        self.websocket = websocket
+        # Wire format for outgoing frames; JSON unless the client negotiated MessagePack
+        self.protocol = protocol.JSON
+        # Whether the client understands 'batch' frames; set at register
+        self.batching = False
+        self.max_queue = max_queue
+        self.high_water = high_water
+        self.slow_consumer_timeout = slow_consumer_timeout
+        self.coalesce_window = coalesce_window
+        self.coalesce_max_bytes = coalesce_max_bytes
+
+        self._queue = deque()
+        self._pending = {}  # coalescing key -> queued slot
+        self._wakeup = asyncio.Event()
+        self._over_high_water_since = None
+        self.closed = False
+        self._writer = asyncio.create_task(self._write_loop())
+        _live_connections.add(self)
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    @property
+    def binary(self):
+        return self.protocol == protocol.MSGPACK
+
+    def send(self, message):
+        """
+        Queue a frame for delivery without waiting for the socket.
+        Returns False if the frame was dropped.
+        """
+        if self.closed:
+            return False
+
+        key = None
+        if message.get('type') in COALESCED_TYPES:
+            key = (message['type'], message.get('from'))
+            slot = self._pending.get(key)
+            if slot is not None:
+                # Replace the queued state with the latest one in place
+                slot[1] = message
+                outbound_metrics['coalesced'] += 1
+                return True
+            if self.depth >= self.high_water:
+                outbound_metrics['dropped'] += 1
+                return False
+
+        if self.depth >= self.max_queue:
+            outbound_metrics['dropped'] += 1
+            self._evict(f"outbound queue full ({self.max_queue} frames)")
+            return False
+
+        # Frames are encoded by the writer, in the protocol in effect when they go out
+        slot = [key, message]
+        self._queue.append(slot)
+        if key is not None:
+            self._pending[key] = slot
+        outbound_metrics['queued'] += 1
+        frames_out[message.get('type')] += 1
+        self._check_high_water()
+        self._wakeup.set()
+        return True
+
+    def _check_high_water(self):
+        if self.depth < self.high_water:
+            self._over_high_water_since = None
+            return
+        now = time.monotonic()
+        if self._over_high_water_since is None:
+            self._over_high_water_since = now
+        elif now - self._over_high_water_since > self.slow_consumer_timeout:
+            self._evict(f"over high-water mark for {self.slow_consumer_timeout}s")
+
+    def _evict(self, reason):
+        if self.closed:
+            return
+        logger.warning(f"Disconnecting slow consumer: {reason}")
+        outbound_metrics['evicted'] += 1
+        self.closed = True
+        self._writer.cancel()
+        asyncio.create_task(self.websocket.close(
+            code=WSCloseCode.TRY_AGAIN_LATER,
+            message=b'Slow consumer'
+        ))
+
+    def _pop(self):
+        key, message = slot = self._queue.popleft()
+        if key is not None and self._pending.get(key) is slot:
+            del self._pending[key]
+        return message
+
+    async def _collect_batch(self, message):
+        """
+        Wait one coalescing window and merge the small frames that piled up
+        behind message into a single batch frame. Order is preserved because
+        only consecutive frames at the head of the queue are taken.
+        """
+        await asyncio.sleep(self.coalesce_window)
+        frames = [message]
+        while self._queue and len(frames) < MAX_BATCH_FRAMES:
+            if self._queue[0][1].get('type') not in BATCHABLE_TYPES:
+                break
+            frames.append(self._pop())
+        if len(frames) == 1:
+            return message
+        outbound_metrics['batches'] += 1
+        outbound_metrics['batched_frames'] += len(frames)
+        return {'type': 'batch', 'frames': frames}
+
+    async def _write_loop(self):
+        try:
+            while True:
+                while not self._queue:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                message = self._pop()
+                payload = protocol.encode(message, self.protocol)
+                if (self.batching and message.get('type') in BATCHABLE_TYPES
+                        and len(payload) < self.coalesce_max_bytes):
+                    batched = await self._collect_batch(message)
+                    if batched is not message:
+                        payload = protocol.encode(batched, self.protocol)
+                if isinstance(payload, bytes):
+                    await self.websocket.send_bytes(payload)
+                else:
+                    await self.websocket.send_str(payload)
+                outbound_metrics['sent'] += 1
+                outbound_metrics['bytes_sent'] += len(payload)
+                if self._over_high_water_since is not None:
+                    self._check_high_water()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error writing to websocket: {e}")
+            self.closed = True
+
+    async def close(self):
+        """Stop the writer; queued frames are discarded."""
+        self.closed = True
+        self._writer.cancel()
+        try:
+            await self._writer
+        except (asyncio.CancelledError, Exception):
+            pass
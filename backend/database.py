@@ -2,40 +2,466 @@ from bson import ObjectId
 from pymongo import MongoClient
 import certifi
 from datetime import datetime
+from collections import Counter
 import logging
-from cachetools import TTLCache
+from cachetools import TTLCache, LRUCache
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import functools
+import inspect
 import asyncio
+import json
+import re
+import time
+from collections import defaultdict
+from metrics import Histogram
 
 logger = logging.getLogger(__name__)
 
+# Fields of a user document the app reads; cached entries hold only these
+USER_PROJECTION = {'_id': 0, 'username': 1, 'friends': 1, 'friend_requests': 1, 'joined_date': 1, 'smart_reply_budget': 1}
+
+# Fields needed to route a message lookup; message_cache entries hold only these plus the collection
+MESSAGE_LOOKUP_PROJECTION = {'from': 1, 'to': 1}
+
+# Fields of a search hit, ranked by the text index score
+SEARCH_PROJECTION = {'from': 1, 'to': 1, 'content': 1, 'timestamp': 1, 'score': 1}
+SEARCH_SNIPPET_CHARS = 120
+
+# Public coroutines that are not single operations and so are left out of Database.latency
+UNTIMED_METHODS = {
+    'run_message_writer', 'run_event_writer', 'watch_user_changes', 'migrate_conversation_ids',
+    'migrate_unread_counts', 'wait_until_durable', 'wait_until_events_logged'
+}
+
+class MessageCache(TTLCache):
+    """
+    TTLCache of slim message entries keyed by ObjectId, bounded by an estimate
+    of their size in bytes rather than by count, with hit/miss/eviction counters.
+    """
+    ENTRY_OVERHEAD = 240  # dict, ObjectId and key bookkeeping, measured roughly with sys.getsizeof
+
+    def __init__(self, max_bytes, ttl):
+        super().__init__(maxsize=max_bytes, ttl=ttl, getsizeof=self.entry_size)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @classmethod
+    def entry_size(cls, entry):
+        return cls.ENTRY_OVERHEAD + sum(len(value) for value in entry.values() if isinstance(value, str))
+
+    def popitem(self):
+        # Called by cachetools only when making room for a new entry
+        self.evictions += 1
+        return super().popitem()
+
+    def lookup(self, message_id):
+        entry = self.get(message_id)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'entries': len(self),
+            'bytes': self.currsize,
+            'max_bytes': self.maxsize
+        }
+
 class Database:
-    def __init__(self, uri):
+    def __init__(self, uri, max_workers=16, op_timeout=10.0, user_cache_size=10000, user_cache_ttl=None,
+                 message_cache_bytes=4 * 1024 * 1024, event_ttl=7 * 24 * 3600, db_name='messenger_app',
+                 write_retries=2):
         if not uri:
             raise ValueError("MongoDB URI cannot be empty")
             
-        # Use system CA bundle from certifi to avoid TLS handshake issues on hosts like Render
-        self.client = MongoClient(uri, tlsCAFile=certifi.where())
-        self.db = self.client['messenger_app']
+        # Use system CA bundle from certifi to avoid TLS handshake issues on hosts like Render.
+        # timeoutMS bounds the driver-side work so a timed-out call also frees its worker thread.
+        self.client = MongoClient(uri, tlsCAFile=certifi.where(), timeoutMS=int(op_timeout * 1000))
+        self.db = self.client[db_name]
         self.users = self.db['users']
         self.messages = self.db['messages']
         self.ai_messages = self.db['ai_messages']
+        self.migrations = self.db['migrations']
+        self.unread = self.db['unread']
+        self.ai_summaries = self.db['ai_summaries']
+        self.events = self.db['events']
+        self.event_counters = self.db['event_counters']
 
         # Create indexes
-        self.messages.create_index([("from", 1), ("to", 1)])
-        self.ai_messages.create_index([("from", 1), ("to", 1)])
+        # (from, to, timestamp, _id) serves each direction of a conversation already
+        # in history order; it backs queries until the conversation_id backfill is done
+        self.messages.create_index([("from", 1), ("to", 1), ("timestamp", -1), ("_id", -1)])
+        self.ai_messages.create_index([("from", 1), ("to", 1), ("timestamp", -1), ("_id", -1)])
+        # A whole conversation is a single range on (conversation_id, timestamp, _id)
+        self.messages.create_index([("conversation_id", 1), ("timestamp", -1), ("_id", -1)])
+        self.ai_messages.create_index([("conversation_id", 1), ("timestamp", -1), ("_id", -1)])
         self.users.create_index("username", unique=True)
+        # Only unread messages are indexed, so read receipts touch just what is still unread
+        self.messages.create_index([("to", 1), ("from", 1)], partialFilterExpression={'read': False}, name='unread_to_from')
+        self.ai_messages.create_index([("to", 1), ("from", 1)], partialFilterExpression={'read': False}, name='unread_to_from')
+        # Full-text search over message content; Mongo maintains it on every insert
+        self.messages.create_index([("content", "text")], name='content_text')
+        self.ai_messages.create_index([("content", "text")], name='content_text')
+        # One unread counter per (reader, sender) pair
+        self.unread.create_index([("user", 1), ("peer", 1)], unique=True)
+        # Per-user event log read by catch-up sync; old events expire
+        self.events.create_index([("user", 1), ("seq", 1)], unique=True)
+        self.events.create_index("created_at", expireAfterSeconds=event_ttl)
+
+        # Collections whose documents all carry conversation_id and can be queried by it
+        self.conversation_id_ready = {
+            name: bool(self.migrations.find_one({'_id': f'conversation_id:{name}', 'done': True}))
+            for name in ('messages', 'ai_messages')
+        }
+        # Whether the unread counters cover messages that were unread before they existed
+        self.unread_counts_ready = bool(self.migrations.find_one({'_id': 'unread_counts', 'done': True}))
+        # Held by the backfill while it counts and writes a batch of counters, and by
+        # live counter updates until the backfill is done, so neither overwrites the other
+        self._unread_backfill_lock = asyncio.Lock()
         
         # Initialize message cache
-        self.message_cache = TTLCache(maxsize=1000, ttl=300)  # Cache up to 1000 messages for 5 minutes
+        # Slim message entries (participants and collection) for up to 5 minutes
+        self.message_cache = MessageCache(max_bytes=message_cache_bytes, ttl=300)
+
+        # User documents (friends, friend requests) by username, invalidated on every write.
+        # With a TTL, writes made by other processes show up once the entry expires.
+        self.user_cache_ttl = user_cache_ttl
+        self.user_cache = self._new_user_cache(user_cache_size, user_cache_ttl)
+        self._user_cache_generation = 0
+        self.cache_stats = {'user_hits': 0, 'user_misses': 0}
+
+        # Method name -> latency histogram, filled in by the wrappers installed below the class
+        self.latency = defaultdict(Histogram)
+
+        # pymongo is synchronous; every query runs on this bounded pool so the event loop never blocks
+        self.op_timeout = op_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='mongo')
+
+        # Write-behind queue for chat messages, drained by run_message_writer
+        self._write_queue = asyncio.Queue()
+        self._pending_writes = {}  # message id -> future resolved once durable
+        # Recipients already have a queued message's _id, so a failed batch is retried with the same ids
+        self.write_retries = write_retries
+
+        # Write-behind queue for the event log, drained by run_event_writer
+        self._event_queue = asyncio.Queue()
+        self._pending_events = {}  # username -> future resolved once their queued events are logged
         
         logger.info("Database initialized")
+
+    async def _run(self, fn, *args, timeout=None, **kwargs):
+        """
+        Run a blocking pymongo call on the database executor.
+        Raises asyncio.TimeoutError if it takes longer than the per-operation timeout.
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout or self.op_timeout)
+
+    async def ping(self, timeout=None):
+        """
+        Round trip to the server, for readiness checks.
+        Raises if MongoDB cannot be reached within the timeout.
+        """
+        await self._run(self.client.admin.command, 'ping', timeout=timeout)
+
+    def close(self):
+        """
+        Release the executor threads and the MongoDB connection pool.
+        """
+        self._executor.shutdown(wait=False)
+        self.client.close()
+
+    @staticmethod
+    def conversation_id(user1, user2):
+        """
+        Canonical key for the conversation between two users, independent of direction.
+        """
+        return json.dumps(sorted([user1, user2]), separators=(',', ':'))
+
+    def _cache_message(self, message, collection):
+        """
+        Remember where a message lives and who it is between.
+        Returns the cached entry.
+        """
+        entry = {
+            '_id': message['_id'],
+            'from': message['from'],
+            'to': message['to'],
+            'collection': collection.name
+        }
+        self.message_cache[message['_id']] = entry
+        return entry
+
+    def _collection_for(self, user1, user2):
+        """
+        Collection holding the conversation between two users.
+        """
+        if user1 == "AI Assistant" or user2 == "AI Assistant":
+            return self.ai_messages
+        return self.messages
+
+    def _conversation_filter(self, collection, user1, user2):
+        """
+        Build the query matching every message between two users.
+        Uses conversation_id once the collection has been backfilled.
+        """
+        if self.conversation_id_ready[collection.name]:
+            return {'conversation_id': self.conversation_id(user1, user2)}
+        return {
+            '$or': [
+                {'from': user1, 'to': user2},
+                {'from': user2, 'to': user1}
+            ]
+        }
+
+    async def migrate_conversation_ids(self, batch_size=500, pause=0.1):
+        """
+        Backfill conversation_id on existing messages and ai_messages documents.
+
+        Runs in batches ordered by _id and checkpoints progress in the migrations
+        collection, so an interrupted run resumes where it stopped.
+        """
+        for collection in (self.messages, self.ai_messages):
+            state_id = f'conversation_id:{collection.name}'
+            state = await self._run(self.migrations.find_one, {'_id': state_id}) or {}
+            if state.get('done'):
+                self.conversation_id_ready[collection.name] = True
+                continue
+
+            last_id = state.get('last_id')
+            migrated = 0
+            while True:
+                query = {'conversation_id': {'$exists': False}}
+                if last_id is not None:
+                    query['_id'] = {'$gt': last_id}
+                batch = await self._run(lambda: list(
+                    collection.find(query, {'from': 1, 'to': 1}).sort('_id', 1).limit(batch_size)
+                ))
+                if not batch:
+                    break
+
+                await self._run(collection.bulk_write, [
+                    UpdateOne(
+                        {'_id': doc['_id']},
+                        {'$set': {'conversation_id': self.conversation_id(doc['from'], doc['to'])}}
+                    )
+                    for doc in batch
+                ], ordered=False)
+                last_id = batch[-1]['_id']
+                migrated += len(batch)
+                await self._run(
+                    self.migrations.update_one,
+                    {'_id': state_id},
+                    {'$set': {'last_id': last_id}},
+                    upsert=True
+                )
+                # Leave room for live traffic between batches
+                await asyncio.sleep(pause)
+
+            await self._run(
+                self.migrations.update_one,
+                {'_id': state_id},
+                {'$set': {'done': True, 'completed_at': datetime.utcnow()}},
+                upsert=True
+            )
+            self.conversation_id_ready[collection.name] = True
+            logger.info(f"conversation_id backfill finished for {collection.name} ({migrated} documents)")
+
+    async def migrate_unread_counts(self, batch_size=500, pause=0.1):
+        """
+        Seed the unread counters from messages that were already unread before
+        the counters existed.
+
+        Walks users in username order, counts each batch's unread messages per
+        sender through the partial unread index, and checkpoints the last
+        username in the migrations collection, so an interrupted run resumes
+        where it stopped. Until it is done, get_unread_counts counts unread
+        messages directly instead of trusting the counters.
+        """
+        state_id = 'unread_counts'
+        state = await self._run(self.migrations.find_one, {'_id': state_id}) or {}
+        if state.get('done'):
+            self.unread_counts_ready = True
+            return
+
+        last_reader = state.get('last_reader')
+        seeded = 0
+        while True:
+            query = {} if last_reader is None else {'username': {'$gt': last_reader}}
+            readers = await self._run(lambda: [
+                user['username']
+                for user in self.users.find(query, {'_id': 0, 'username': 1}).sort('username', 1).limit(batch_size)
+            ])
+            if not readers:
+                break
+
+            async with self._unread_backfill_lock:
+                counts = await self._count_unread(readers)
+                if counts:
+                    # $set rather than $inc: messages stored and counted live are part of
+                    # the count, and none can be stored between the count and this write
+                    await self._run(self.unread.bulk_write, [
+                        UpdateOne({'user': reader, 'peer': sender}, {'$set': {'count': count}}, upsert=True)
+                        for (reader, sender), count in counts.items()
+                    ], ordered=False)
+            last_reader = readers[-1]
+            seeded += len(counts)
+            await self._run(
+                self.migrations.update_one,
+                {'_id': state_id},
+                {'$set': {'last_reader': last_reader}},
+                upsert=True
+            )
+            # Leave room for live traffic between batches
+            await asyncio.sleep(pause)
+
+        await self._run(
+            self.migrations.update_one,
+            {'_id': state_id},
+            {'$set': {'done': True, 'completed_at': datetime.utcnow()}},
+            upsert=True
+        )
+        self.unread_counts_ready = True
+        logger.info(f"Unread counter backfill finished ({seeded} counters)")
+
+    def _unread_writes(self):
+        """
+        Context for storing messages or resetting counters: waits out a
+        backfill batch while the backfill runs, and costs nothing after.
+        """
+        return contextlib.nullcontext() if self.unread_counts_ready else self._unread_backfill_lock
+
+    async def _count_unread(self, readers):
+        """
+        Count unread messages per (reader, sender) for the given readers
+        straight from the messages and ai_messages collections.
+        """
+        pipeline = [
+            {'$match': {'to': {'$in': list(readers)}, 'read': False}},
+            {'$group': {'_id': {'reader': '$to', 'sender': '$from'}, 'count': {'$sum': 1}}}
+        ]
+        results = await asyncio.gather(*(
+            self._run(lambda collection=collection: list(collection.aggregate(pipeline)))
+            for collection in (self.messages, self.ai_messages)
+        ))
+        return Counter({
+            (group['_id']['reader'], group['_id']['sender']): group['count']
+            for groups in results for group in groups
+        })
         
+    async def _get_user(self, username):
+        """
+        Fetch a user document through the user cache.
+        Returns None if the user does not exist.
+        """
+        user = self.user_cache.get(username)
+        if user is not None:
+            self.cache_stats['user_hits'] += 1
+            return user
+        self.cache_stats['user_misses'] += 1
+
+        generation = self._user_cache_generation
+        user = await self._run(self.users.find_one, {'username': username}, USER_PROJECTION)
+        # Skip caching if an invalidation happened while the query was in flight
+        if user is not None and generation == self._user_cache_generation:
+            self.user_cache[username] = user
+        return user
+
+    def invalidate_users(self, *usernames):
+        """
+        Drop cached user documents after they were modified.
+        """
+        self._user_cache_generation += 1
+        for username in usernames:
+            self.user_cache.pop(username, None)
+
+    @staticmethod
+    def _new_user_cache(maxsize, ttl):
+        return LRUCache(maxsize=maxsize) if ttl is None else TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def set_user_cache_ttl(self, ttl):
+        """
+        Start over with an empty user cache whose entries expire after ttl
+        seconds, or never when ttl is None.
+        """
+        if ttl == self.user_cache_ttl:
+            return
+        self.user_cache = self._new_user_cache(self.user_cache.maxsize, ttl)
+        self.user_cache_ttl = ttl
+        self._user_cache_generation += 1
+
+    async def watch_user_changes(self, fallback_ttl=30.0, retry_delay=1.0, max_retry_delay=60.0):
+        """
+        Invalidate cached users modified by other processes, using a change stream
+        on the users collection. Runs until cancelled.
+
+        Cached users only stay valid indefinitely while the stream is open.
+        Until it opens, and whenever it fails, they expire after fallback_ttl
+        seconds. A failed stream is resumed with backoff; on a deployment
+        without change streams (a standalone mongod) the TTL stays for good.
+        """
+        loop = asyncio.get_running_loop()
+        resume_token = None
+        opened = False
+        delay = retry_delay
+
+        def on_open():
+            nonlocal delay
+            # Invalidations from here on are complete; earlier entries may be stale
+            self.set_user_cache_ttl(None)
+            delay = retry_delay
+
+        def watch():
+            nonlocal resume_token, opened
+            opened = False
+            with self.users.watch(full_document='updateLookup', resume_after=resume_token) as stream:
+                opened = True
+                loop.call_soon_threadsafe(on_open)
+                for change in stream:
+                    resume_token = stream.resume_token
+                    document = change.get('fullDocument')
+                    if document and 'username' in document:
+                        loop.call_soon_threadsafe(self.invalidate_users, document['username'])
+                    else:
+                        loop.call_soon_threadsafe(self.user_cache.clear)
+
+        while True:
+            self.set_user_cache_ttl(fallback_ttl)
+            try:
+                # Long-lived blocking iterator: keep it off the bounded query executor
+                await asyncio.to_thread(watch)
+                logger.warning("User change stream closed; resuming")
+            except (NotImplementedError, OperationFailure) as e:
+                if isinstance(e, NotImplementedError) or e.code == 40573:
+                    logger.warning(f"Change streams unavailable, cached users expire after {fallback_ttl}s: {e}")
+                    return
+                logger.error(f"User change stream failed, cached users expire after {fallback_ttl}s: {e}")
+                if not opened:
+                    # The resume token may have aged out of the oplog
+                    resume_token = None
+            except Exception as e:
+                logger.error(f"User change stream failed, cached users expire after {fallback_ttl}s: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, max_retry_delay)
+
     async def add_user(self, username):
         """
         Add a new user to the database if they don't already exist.
         Returns True if user was added, False if username already exists.
         """
-        existing_user = self.users.find_one({'username': username})
+        existing_user = await self._get_user(username)
         if existing_user:
             return False
             
@@ -45,9 +471,42 @@ class Database:
             'friend_requests': [],
             'joined_date': datetime.utcnow()
         }
-        self.users.insert_one(user_doc)
+        await self._run(self.users.insert_one, user_doc)
+        self.invalidate_users(username)
         return True
 
+    async def register_user(self, username):
+        """
+        Create the user if needed and return its document, in a single round-trip.
+        Used at register time in place of add_user, get_friends and get_friend_requests.
+        """
+        generation = self._user_cache_generation
+        user = await self._run(
+            self.users.find_one_and_update,
+            {'username': username},
+            {'$setOnInsert': {
+                'friends': [],
+                'friend_requests': [],
+                'joined_date': datetime.utcnow()
+            }},
+            projection=USER_PROJECTION,
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        if generation == self._user_cache_generation:
+            self.user_cache[username] = user
+        return user
+
+    async def get_smart_reply_budget(self, username, default):
+        """
+        Hourly budget of speculative smart-reply generations for a user.
+        Users without a smart_reply_budget field get the default.
+        """
+        user = await self._get_user(username)
+        if user and user.get('smart_reply_budget') is not None:
+            return user['smart_reply_budget']
+        return default
+
     async def can_add_friend(self, from_user, to_user):
         """
         Check if a friend request can be sent between users.
@@ -59,8 +518,8 @@ class Database:
             return False, "Cannot send friend request to yourself"
 
         # Check if both users exist
-        from_user_doc = self.users.find_one({'username': from_user})
-        to_user_doc = self.users.find_one({'username': to_user})
+        from_user_doc = await self._get_user(from_user)
+        to_user_doc = await self._get_user(to_user)
         
         if not from_user_doc or not to_user_doc:
             return False, "One or both users do not exist"
@@ -84,9 +543,10 @@ class Database:
         Get the list of friends for a given user.
         Returns empty list if user not found.
         """
-        user = self.users.find_one({'username': username})
+        user = await self._get_user(username)
         if user and 'friends' in user:
-            return user['friends']
+            # Copy so callers can't modify the cached document
+            return list(user['friends'])
         return []
 
     async def get_friend_requests(self, username):
@@ -94,7 +554,7 @@ class Database:
         Get the list of pending friend requests for a user.
         Returns empty list if user not found.
         """
-        user = self.users.find_one({'username': username})
+        user = await self._get_user(username)
         if user and 'friend_requests' in user:
             # Convert ObjectId to string if needed
             requests = list(user['friend_requests'])
@@ -121,10 +581,12 @@ class Database:
             }
 
         # Add friend request
-        self.users.update_one(
+        await self._run(
+            self.users.update_one,
             {'username': to_user},
             {'$addToSet': {'friend_requests': from_user}}
         )
+        self.invalidate_users(to_user)
         
         return {
             'type': 'friend_request_response',
@@ -134,73 +596,112 @@ class Database:
             'to': to_user
         }
 
+    @staticmethod
+    def _reaction_pipeline(from_user, emoji, timestamp):
+        """
+        Update pipeline that replaces a user's reaction and keeps the per-emoji
+        summary in reaction_counts in step, all inside one atomic update.
+        """
+        user = {'$literal': from_user}
+        emoji = {'$literal': emoji}
+        reactions = {'$ifNull': ['$reactions', []]}
+        # Messages that predate reaction_counts get it built from their reactions
+        seed_counts = {'$map': {
+            'input': {'$setUnion': [{'$ifNull': ['$reactions.emoji', []]}]},
+            'as': 'emoji',
+            'in': {
+                'emoji': '$$emoji',
+                'users': {'$map': {
+                    'input': {'$filter': {'input': reactions, 'cond': {'$eq': ['$$this.emoji', '$$emoji']}}},
+                    'in': '$$this.user'
+                }}
+            }
+        }}
+        # Groups with the user's previous reaction removed
+        without_user = {'$map': {
+            'input': '$reaction_counts',
+            'as': 'group',
+            'in': {
+                'emoji': '$$group.emoji',
+                'users': {'$filter': {'input': '$$group.users', 'cond': {'$ne': ['$$this', user]}}}
+            }
+        }}
+        with_user = {'$let': {
+            'vars': {'groups': without_user},
+            'in': {'$cond': [
+                {'$in': [emoji, '$$groups.emoji']},
+                {'$map': {
+                    'input': '$$groups',
+                    'as': 'group',
+                    'in': {'$cond': [
+                        {'$eq': ['$$group.emoji', emoji]},
+                        {'emoji': '$$group.emoji', 'users': {'$concatArrays': ['$$group.users', [user]]}},
+                        '$$group'
+                    ]}
+                }},
+                {'$concatArrays': ['$$groups', [{'emoji': emoji, 'users': [user]}]]}
+            ]}
+        }}
+        return [
+            {'$set': {'reaction_counts': {'$ifNull': ['$reaction_counts', seed_counts]}}},
+            {'$set': {
+                'reactions': {'$concatArrays': [
+                    {'$filter': {'input': reactions, 'cond': {'$ne': ['$$this.user', user]}}},
+                    [{'user': user, 'emoji': emoji, 'timestamp': timestamp}]
+                ]},
+                'reaction_counts': with_user
+            }},
+            # Drop emptied groups and refresh the counts
+            {'$set': {'reaction_counts': {'$map': {
+                'input': {'$filter': {'input': '$reaction_counts', 'cond': {'$gt': [{'$size': '$$this.users'}, 0]}}},
+                'in': {'emoji': '$$this.emoji', 'count': {'$size': '$$this.users'}, 'users': '$$this.users'}
+            }}}}
+        ]
+
     async def add_reaction(self, message_id, from_user, emoji):
         """
-        Add or update a reaction to a message.
+        Add or update a reaction to a message in a single atomic round-trip.
+        Returns the message id, its participants and the per-emoji reaction
+        summary, or None if the message does not exist.
         """
         try:
             # Convert string message_id to ObjectId
             message_id = ObjectId(message_id)
-            
-            # Find the message in both regular and AI messages collections
-            message = await self.get_message_by_id(message_id)
-            if not message:
-                logger.error(f"Message with id {message_id} not found in either messages or ai_messages collection")
-                return None
-
-            collection = self.messages if message['to'] != "AI Assistant" and message['from'] != "AI Assistant" else self.ai_messages
-
-            # Initialize reactions array if it doesn't exist and add/update reaction
-            result = collection.update_one(
-                {'_id': message_id},
-                {
-                    '$pull': {
-                        'reactions': {
-                            'user': from_user
-                        }
-                    }
-                }
-            )
 
-            result = collection.update_one(
-                {'_id': message_id},
-                {
-                    '$push': {
-                        'reactions': {
-                            'user': from_user,
-                            'emoji': emoji,
-                            'timestamp': datetime.utcnow().isoformat()
-                        }
-                    }
-                }
-            )
+            # The message may still be in the write-behind queue
+            await self.wait_until_durable(message_id)
 
-            # Get updated message with reactions
-            updated_message = collection.find_one({'_id': message_id})
-            if not updated_message:
-                raise ValueError(f"Failed to retrieve updated message {message_id}")
-            
-            # Update cache
-            self.message_cache[str(message_id)] = updated_message
-                
-            # Group reactions by emoji for the response
-            reaction_counts = {}
-            for reaction in updated_message.get('reactions', []):
-                emoji = reaction['emoji']
-                if emoji in reaction_counts:
-                    reaction_counts[emoji]['count'] += 1
-                    reaction_counts[emoji]['users'].append(reaction['user'])
-                else:
-                    reaction_counts[emoji] = {
-                        'emoji': emoji,
-                        'count': 1,
-                        'users': [reaction['user']]
+            pipeline = self._reaction_pipeline(from_user, emoji, datetime.utcnow().isoformat())
+
+            # Use the cached collection when known, otherwise try both at once
+            cached_message = self.message_cache.lookup(message_id)
+            if cached_message is not None:
+                collections = [self.db[cached_message['collection']]]
+            else:
+                collections = [self.messages, self.ai_messages]
+            results = await asyncio.gather(*[
+                self._run(
+                    collection.find_one_and_update,
+                    {'_id': message_id},
+                    pipeline,
+                    projection={'from': 1, 'to': 1, 'reaction_counts': 1},
+                    return_document=ReturnDocument.AFTER
+                )
+                for collection in collections
+            ])
+
+            for collection, updated_message in zip(collections, results):
+                if updated_message:
+                    self._cache_message(updated_message, collection)
+                    return {
+                        'message_id': str(message_id),
+                        'from': updated_message['from'],
+                        'to': updated_message['to'],
+                        'reactions': updated_message.get('reaction_counts', [])
                     }
 
-            return {
-                'message_id': str(message_id),
-                'reactions': list(reaction_counts.values())
-            }
+            logger.error(f"Message with id {message_id} not found in either messages or ai_messages collection")
+            return None
 
         except Exception as e:
             logger.error(f"Error adding reaction: {str(e)}")
@@ -214,12 +715,9 @@ class Database:
         Returns dict with status and message.
         """
         # Verify the friend request exists
-        user_doc = self.users.find_one({
-            'username': user,
-            'friend_requests': friend
-        })
+        user_doc = await self._get_user(user)
         
-        if not user_doc:
+        if not user_doc or friend not in user_doc.get('friend_requests', []):
             return {
                 'type': 'friend_request_response',
                 'status': 'error',
@@ -227,17 +725,20 @@ class Database:
             }
 
         # Add each user to the other's friends list
-        self.users.update_one(
+        await self._run(
+            self.users.update_one,
             {'username': user},
             {
                 '$pull': {'friend_requests': friend},
                 '$addToSet': {'friends': friend}
             }
         )
-        self.users.update_one(
+        await self._run(
+            self.users.update_one,
             {'username': friend},
             {'$addToSet': {'friends': user}}
         )
+        self.invalidate_users(user, friend)
         
         return {
             'type': 'friend_added',
@@ -251,81 +752,365 @@ class Database:
         """
         Reject a friend request by removing it from the requests list.
         """
-        self.users.update_one(
+        await self._run(
+            self.users.update_one,
             {'username': user},
             {'$pull': {'friend_requests': friend}}
         )
+        self.invalidate_users(user)
         return True
 
     async def remove_friend(self, user1, user2):
         """
         Remove two users from each other's friends lists.
         """
-        self.users.update_one(
+        await self._run(
+            self.users.update_one,
             {'username': user1},
             {'$pull': {'friends': user2}}
         )
-        self.users.update_one(
+        await self._run(
+            self.users.update_one,
             {'username': user2},
             {'$pull': {'friends': user1}}
         )
+        self.invalidate_users(user1, user2)
         return True
 
+    def _new_message_doc(self, from_user, to_user, content):
+        return {
+            'from': from_user,
+            'to': to_user,
+            'conversation_id': self.conversation_id(from_user, to_user),
+            'content': content,
+            'timestamp': datetime.utcnow().isoformat(),
+            'read': False,
+            'readAt': None
+        }
+
     async def save_message(self, from_user, to_user, content):
         """
         Save a message to the appropriate collection with read receipt status.
         Returns the inserted message ID.
         """
         try:
-            message_doc = {
-                'from': from_user,
-                'to': to_user,
-                'content': content,
-                'timestamp': datetime.utcnow().isoformat(),
-                'read': False,
-                'readAt': None
-            }
-            
-            if to_user == "AI Assistant" or from_user == "AI Assistant":
-                result = self.ai_messages.insert_one(message_doc)
-                logger.info(f"AI message saved with ID: {result.inserted_id}")
-                collection = self.ai_messages
-            else:
-                result = self.messages.insert_one(message_doc)
-                logger.info(f"User message saved with ID: {result.inserted_id}")
-                collection = self.messages
-            
-            # Add the message to the cache with _id for quick reads and dedupe
-            self.message_cache[str(result.inserted_id)] = {**message_doc, '_id': result.inserted_id}
+            message_doc = self._new_message_doc(from_user, to_user, content)
+            collection = self._collection_for(from_user, to_user)
+            async with self._unread_writes():
+                result = await self._run(collection.insert_one, message_doc)
+                logger.debug(f"Message saved to {collection.name} with ID: {result.inserted_id}")
+
+                # Add the message to the cache with _id for quick reads and dedupe
+                self._cache_message({**message_doc, '_id': result.inserted_id}, collection)
+                await self._increment_unread(Counter([(to_user, from_user)]))
             
             return str(result.inserted_id)
         except Exception as e:
             logger.error(f"Error saving message: {e}")
             raise
 
+    def queue_message(self, from_user, to_user, content):
+        """
+        Queue a message for batched write-behind persistence.
+
+        The ObjectId is assigned here so the message can be delivered before it
+        is stored. Returns (message_id, future); the future resolves to the
+        message id once the message is durable, or raises if the write failed.
+        """
+        message_doc = self._new_message_doc(from_user, to_user, content)
+        message_doc['_id'] = ObjectId()
+        message_id = str(message_doc['_id'])
+
+        durable = asyncio.get_running_loop().create_future()
+        self._pending_writes[message_id] = durable
+        self._cache_message(message_doc, self._collection_for(from_user, to_user))
+        self._write_queue.put_nowait((message_doc, durable))
+        return message_id, durable
+
+    async def run_message_writer(self, batch_size=100, flush_interval=0.05):
+        """
+        Drain the write-behind queue, flushing with insert_many once batch_size
+        messages are waiting or flush_interval seconds after the first one.
+        Returns after stop_message_writer(), once everything queued before it is stored.
+        """
+        await self._drain(self._write_queue, batch_size, flush_interval, self._flush_messages)
+
+    @staticmethod
+    async def _drain(queue, batch_size, flush_interval, flush):
+        """
+        Pass items from queue to flush in batches of up to batch_size, waiting
+        at most flush_interval after the first item of a batch. Stops at None.
+        """
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + flush_interval
+            while len(batch) < batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await flush(batch)
+
+    async def stop_message_writer(self):
+        """
+        Ask run_message_writer to flush what is queued and exit.
+        """
+        await self._write_queue.put(None)
+
+    async def _flush_messages(self, batch):
+        # Stored messages and their counter increments must not straddle a backfill batch
+        async with self._unread_writes():
+            await self._store_messages(batch)
+
+    async def _store_messages(self, batch):
+        by_collection = {}
+        for message_doc, durable in batch:
+            collection = self._collection_for(message_doc['from'], message_doc['to'])
+            by_collection.setdefault(collection.name, (collection, []))[1].append((message_doc, durable))
+
+        stored = Counter()
+        for collection, items in by_collection.values():
+            outcomes = await self._insert_with_retries(collection, [doc for doc, _ in items])
+            for (message_doc, durable), outcome in zip(items, outcomes):
+                message_id = str(message_doc['_id'])
+                self._pending_writes.pop(message_id, None)
+                if durable.done():
+                    continue
+                if isinstance(outcome, Exception):
+                    durable.set_exception(outcome)
+                else:
+                    if outcome:
+                        stored[(message_doc['to'], message_doc['from'])] += 1
+                    durable.set_result(message_id)
+            logger.debug(f"Flushed {len(items)} messages to {collection.name}")
+
+        try:
+            await self._increment_unread(stored)
+        except Exception as e:
+            logger.error(f"Error updating unread counters: {e}")
+
+    async def _insert_with_retries(self, collection, docs):
+        """
+        Insert documents that already carry their _id, retrying the ones that
+        failed up to write_retries times.
+
+        Returns, per document, True if this flush stored it, False if it was
+        already stored, or the exception it finally failed with.
+        """
+        outcomes = [None] * len(docs)
+        pending = list(range(len(docs)))
+        for attempt in range(self.write_retries + 1):
+            if attempt:
+                await asyncio.sleep(0.1 * attempt)
+            failed = {}
+            try:
+                await self._run(collection.insert_many, [docs[index] for index in pending], ordered=False)
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    index = pending[error['index']]
+                    if error.get('code') == 11000:
+                        # A duplicate _id means an earlier attempt stored it; if that was
+                        # a try of this flush that timed out, it has not been counted yet
+                        outcomes[index] = attempt > 0
+                    else:
+                        failed[index] = RuntimeError(error.get('errmsg', 'write failed'))
+            except Exception as e:
+                failed = dict.fromkeys(pending, e)
+            for index in pending:
+                if index not in failed and outcomes[index] is None:
+                    outcomes[index] = True
+            if not failed:
+                break
+            pending = sorted(failed)
+            logger.error(f"Error flushing {len(pending)} messages to {collection.name} "
+                         f"(attempt {attempt + 1} of {self.write_retries + 1}): {next(iter(failed.values()))}")
+        for index, error in failed.items():
+            outcomes[index] = error
+        return outcomes
+
+    async def _increment_unread(self, counts):
+        """
+        Add newly stored messages to the readers' unread counters.
+        counts maps (reader, sender) to the number of new messages.
+        """
+        updates = [
+            UpdateOne({'user': reader, 'peer': sender}, {'$inc': {'count': count}}, upsert=True)
+            for (reader, sender), count in counts.items()
+            if reader != "AI Assistant"
+        ]
+        if updates:
+            await self._run(self.unread.bulk_write, updates, ordered=False)
+
+    async def get_unread_counts(self, username):
+        """
+        Unread message counts per sender for a user, omitting conversations with none.
+        """
+        if not self.unread_counts_ready:
+            # The counters may still miss messages from before they existed
+            counts = await self._count_unread([username])
+            return {sender: count for (_, sender), count in counts.items()}
+        counters = await self._run(lambda: list(self.unread.find(
+            {'user': username, 'count': {'$gt': 0}},
+            {'_id': 0, 'peer': 1, 'count': 1}
+        )))
+        return {counter['peer']: counter['count'] for counter in counters}
+
+    def log_event(self, username, event):
+        """
+        Queue an event for a user's log, so a device that misses it can catch up.
+        Sequence numbers are assigned when the batch is written.
+        """
+        # Batches are written in order, so waiting on the latest event covers the earlier ones
+        logged = self._pending_events[username] = asyncio.get_running_loop().create_future()
+        self._event_queue.put_nowait((username, event, logged))
+
+    async def run_event_writer(self, batch_size=200, flush_interval=0.05, on_logged=None):
+        """
+        Drain the event log queue like run_message_writer. After each batch,
+        on_logged(positions) is awaited with the latest sequence number
+        written per user.
+        """
+        async def flush(batch):
+            positions = await self._flush_events(batch)
+            if on_logged and positions:
+                try:
+                    await on_logged(positions)
+                except Exception as e:
+                    logger.error(f"Error announcing event log positions: {e}")
+
+        await self._drain(self._event_queue, batch_size, flush_interval, flush)
+
+    async def stop_event_writer(self):
+        await self._event_queue.put(None)
+
+    async def _flush_events(self, batch):
+        by_user = {}
+        for username, event, logged in batch:
+            by_user.setdefault(username, []).append((event, logged))
+
+        # Reserve a block of sequence numbers per user with one atomic increment each
+        def reserve(username, count):
+            counter = self.event_counters.find_one_and_update(
+                {'_id': username},
+                {'$inc': {'seq': count}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+            return counter['seq']
+
+        positions = {}
+        try:
+            last_seqs = await asyncio.gather(*(
+                self._run(reserve, username, len(items)) for username, items in by_user.items()
+            ))
+            now = datetime.utcnow()
+            docs = []
+            for (username, items), last_seq in zip(by_user.items(), last_seqs):
+                first_seq = last_seq - len(items) + 1
+                docs.extend(
+                    {'user': username, 'seq': first_seq + offset, 'event': event, 'created_at': now}
+                    for offset, (event, _) in enumerate(items)
+                )
+                positions[username] = last_seq
+            await self._run(self.events.insert_many, docs, ordered=False)
+        except Exception as e:
+            # The reserved sequence numbers are never written; get_events_since
+            # sees the hole and tells the client to reload instead
+            logger.error(f"Error writing {len(batch)} events to the event log: {e}")
+            positions = {}
+
+        for username, items in by_user.items():
+            for _, logged in items:
+                if not logged.done():
+                    logged.set_result(None)
+            if self._pending_events.get(username) is items[-1][1]:
+                del self._pending_events[username]
+        return positions
+
+    async def wait_until_events_logged(self, username):
+        """
+        Wait for events already queued for a user to be written to the log.
+        """
+        logged = self._pending_events.get(username)
+        if logged is not None:
+            await asyncio.shield(logged)
+
+    async def get_events_since(self, username, after_seq, limit=500):
+        """
+        Events logged for a user after a sequence number, oldest first.
+
+        Returns:
+            dict: events, seq (position to resume from), has_more, and reset,
+            which is True when events after after_seq have expired or were
+            lost and the client must reload its conversations instead
+        """
+        events, counter = await asyncio.gather(
+            self._run(lambda: list(
+                self.events.find({'user': username, 'seq': {'$gt': after_seq}}, {'_id': 0, 'seq': 1, 'event': 1})
+                .sort('seq', 1)
+                .limit(limit + 1)
+            )),
+            self._run(self.event_counters.find_one, {'_id': username})
+        )
+        latest = counter['seq'] if counter else 0
+        if events:
+            # A batch that failed to write leaves a hole anywhere in the range
+            complete = all(event['seq'] == after_seq + 1 + index for index, event in enumerate(events))
+        else:
+            complete = after_seq == latest
+        if not complete:
+            return {'events': [], 'seq': latest, 'has_more': False, 'reset': True}
+
+        has_more = len(events) > limit
+        events = events[:limit]
+        return {
+            'events': [event['event'] for event in events],
+            'seq': events[-1]['seq'] if events else after_seq,
+            'has_more': has_more,
+            'reset': False
+        }
+
+    async def wait_until_durable(self, message_id):
+        """
+        Wait for a queued message to reach the database, if it is still pending.
+        """
+        durable = self._pending_writes.get(str(message_id))
+        if durable is not None:
+            await asyncio.shield(durable)
+
     async def get_message_by_id(self, message_id):
         """
-        Retrieve a message by its ID from either messages or ai_messages collection.
+        Look up a message's participants and collection by its ID.
+        Returns a slim dict with _id, from, to and collection, or None.
         """
         try:
+            message_id = ObjectId(message_id)
+
             # Check cache first
-            cached_message = self.message_cache.get(str(message_id))
-            if cached_message:
+            cached_message = self.message_cache.lookup(message_id)
+            if cached_message is not None:
                 return cached_message
 
-            message_id = ObjectId(message_id)
-            
-            # Check regular messages first
-            message = self.messages.find_one({'_id': message_id})
-            if message:
-                self.message_cache[str(message_id)] = message
-                return message
-                
-            # Check AI messages if not found in regular messages
-            message = self.ai_messages.find_one({'_id': message_id})
-            if message:
-                self.message_cache[str(message_id)] = message
-                return message
+            # On a miss, probe both collections at once rather than one after the other
+            found = await asyncio.gather(
+                self._run(self.messages.find_one, {'_id': message_id}, MESSAGE_LOOKUP_PROJECTION),
+                self._run(self.ai_messages.find_one, {'_id': message_id}, MESSAGE_LOOKUP_PROJECTION)
+            )
+            for collection, message in zip((self.messages, self.ai_messages), found):
+                if message:
+                    return self._cache_message(message, collection)
                 
             logger.error(f"Message with id {message_id} not found in either messages or ai_messages collection")
             return None
@@ -342,24 +1127,30 @@ class Database:
            
     async def mark_messages_read(self, reader, sender):
         """
-        Mark all messages from sender to reader as read.
+        Mark all messages from sender to reader as read and reset the unread counter.
         Returns the number of messages marked as read.
         """
         try:
             current_time = datetime.utcnow().isoformat()  # Store as ISO string
-            result = self.messages.update_many(
-                {
-                    'from': sender,
-                    'to': reader,
-                    'read': False
-                },
-                {
-                    '$set': {
-                        'read': True,
-                        'readAt': current_time
+            collection = self._collection_for(reader, sender)
+            async with self._unread_writes():
+                # Reset the counter first: a message landing in between is at worst
+                # counted once too often until the next read, never lost
+                await self._run(
+                    self.unread.update_one,
+                    {'user': reader, 'peer': sender},
+                    {'$set': {'count': 0}}
+                )
+                result = await self._run(
+                    collection.update_many,
+                    {'to': reader, 'from': sender, 'read': False},
+                    {
+                        '$set': {
+                            'read': True,
+                            'readAt': current_time
+                        }
                     }
-                }
-            )
+                )
             return {
                 'modified_count': result.modified_count,
                 'timestamp': current_time
@@ -373,30 +1164,9 @@ class Database:
         Retrieve messages between two users.
         """
         try:
-            if user2 == "AI Assistant" or user1 == "AI Assistant":
-                messages = list(self.ai_messages.find({
-                    '$or': [
-                        {'from': user1, 'to': user2},
-                        {'from': user2, 'to': user1}
-                    ]
-                }).sort('timestamp'))
-                
-                # Convert datetime objects to ISO strings
-                for msg in messages:
-                    if isinstance(msg.get('timestamp'), datetime):
-                        msg['timestamp'] = msg['timestamp'].isoformat()
-                    if isinstance(msg.get('readAt'), datetime):
-                        msg['readAt'] = msg['readAt'].isoformat()
-                        
-                logger.info(f"Retrieved {len(messages)} AI messages")
-                return messages
-                
-            messages = list(self.messages.find({
-                '$or': [
-                    {'from': user1, 'to': user2},
-                    {'from': user2, 'to': user1}
-                ]
-            }).sort('timestamp'))
+            collection = self._collection_for(user1, user2)
+            query = self._conversation_filter(collection, user1, user2)
+            messages = await self._run(lambda: list(collection.find(query).sort('timestamp')))
             
             # Convert datetime objects to ISO strings
             for msg in messages:
@@ -405,19 +1175,296 @@ class Database:
                 if isinstance(msg.get('readAt'), datetime):
                     msg['readAt'] = msg['readAt'].isoformat()
                     
-            logger.info(f"Retrieved {len(messages)} user messages")
+            logger.debug(f"Retrieved {len(messages)} {'AI' if collection is self.ai_messages else 'user'} messages")
             return messages
         except Exception as e:
             logger.error(f"Error retrieving messages: {e}")
             raise
-    
+
+    async def get_messages_page(self, user1, user2, before=None, limit=50):
+        """
+        Retrieve one page of messages between two users, newest page first.
+
+        Args:
+            before (str): Cursor returned as next_cursor by the previous page,
+                or None for the most recent messages
+            limit (int): Maximum number of messages to return
+
+        Returns:
+            dict: messages (oldest first), has_more and next_cursor
+        """
+        try:
+            collection = self._collection_for(user1, user2)
+
+            query = self._conversation_filter(collection, user1, user2)
+            if before is not None:
+                timestamp, message_id = self.decode_history_cursor(before)
+                older = [
+                    {'timestamp': {'$lt': timestamp}},
+                    {'timestamp': timestamp, '_id': {'$lt': message_id}}
+                ]
+                if 'conversation_id' in query:
+                    query['$or'] = older
+                else:
+                    # Expand per direction so every branch stays a bounded index range
+                    query = {'$or': [
+                        {**direction, **bound}
+                        for direction in query['$or']
+                        for bound in older
+                    ]}
+
+            # Fetch one extra document to learn whether an older page exists
+            messages = await self._run(lambda: list(
+                collection.find(query)
+                .sort([('timestamp', -1), ('_id', -1)])
+                .limit(limit + 1)
+            ))
+            has_more = len(messages) > limit
+            messages = messages[:limit]
+            messages.reverse()
+
+            next_cursor = None
+            if has_more and messages:
+                next_cursor = self.encode_history_cursor(messages[0])
+
+            # Convert datetime objects to ISO strings
+            for msg in messages:
+                if isinstance(msg.get('timestamp'), datetime):
+                    msg['timestamp'] = msg['timestamp'].isoformat()
+                if isinstance(msg.get('readAt'), datetime):
+                    msg['readAt'] = msg['readAt'].isoformat()
+
+            return {
+                'messages': messages,
+                'has_more': has_more,
+                'next_cursor': next_cursor
+            }
+        except Exception as e:
+            logger.error(f"Error retrieving message page: {e}")
+            raise
+
+    @staticmethod
+    def encode_history_cursor(message):
+        """
+        Build an opaque pagination cursor from a message's (timestamp, _id).
+        """
+        timestamp = message['timestamp']
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.isoformat()
+        return f"{timestamp}|{message['_id']}"
+
+    @staticmethod
+    def decode_history_cursor(cursor):
+        """
+        Split a pagination cursor back into (timestamp, ObjectId).
+        Raises ValueError if the cursor is malformed.
+        """
+        timestamp, sep, message_id = str(cursor).rpartition('|')
+        if not sep or not ObjectId.is_valid(message_id):
+            raise ValueError(f"Invalid history cursor: {cursor}")
+        return timestamp, ObjectId(message_id)
+
+    async def get_messages_between(self, user1, user2, after=None, before=None, limit=200):
+        """
+        Retrieve messages strictly between two history cursors, oldest first.
+        Either bound may be None to leave that side open.
+        """
+        collection = self._collection_for(user1, user2)
+        clauses = [self._conversation_filter(collection, user1, user2)]
+        for cursor, op in ((after, '$gt'), (before, '$lt')):
+            if cursor is None:
+                continue
+            timestamp, message_id = self.decode_history_cursor(cursor)
+            clauses.append({'$or': [
+                {'timestamp': {op: timestamp}},
+                {'timestamp': timestamp, '_id': {op: message_id}}
+            ]})
+        return await self._run(lambda: list(
+            collection.find({'$and': clauses}, {'from': 1, 'to': 1, 'content': 1, 'timestamp': 1})
+            .sort([('timestamp', 1), ('_id', 1)])
+            .limit(limit)
+        ))
+
+    async def search_messages(self, username, query, with_user=None, limit=20, after=None):
+        """
+        Full-text search over a user's conversations, best matches first.
+
+        The content_text index covers every user's messages, and the
+        participant filter is applied to what it matches. A common word
+        therefore costs in proportion to its matches across the whole
+        collection, not to the caller's own messages. Each page reads only
+        limit + 1 hits past its cursor from each collection.
+
+        Args:
+            query (str): Words to search for; quoted phrases and -negations
+                follow MongoDB $text syntax
+            with_user (str): Restrict the search to the conversation with this user
+            limit (int): Maximum number of hits to return
+            after (str): Cursor returned as next_cursor by the previous page,
+                or None for the best matches
+
+        Returns:
+            dict: hits (each with a snippet around the first matched term),
+            has_more and next_cursor
+
+        Raises:
+            ValueError: If the cursor is malformed
+        """
+        cursor_match = None
+        if after is not None:
+            score, message_id = self.decode_search_cursor(after)
+            cursor_match = {'$or': [
+                {'score': {'$lt': score}},
+                {'score': score, '_id': {'$lt': message_id}}
+            ]}
+
+        if with_user is not None:
+            collection = self._collection_for(username, with_user)
+            searches = [(collection, self._conversation_filter(collection, username, with_user))]
+        else:
+            participant = {'$or': [{'from': username}, {'to': username}]}
+            searches = [(self.messages, participant), (self.ai_messages, participant)]
+
+        # Every collection must supply enough hits to fill this page after merging
+        def search(collection, scope):
+            pipeline = [
+                {'$match': {'$text': {'$search': query}, **scope}},
+                {'$addFields': {'score': {'$meta': 'textScore'}}},
+            ]
+            if cursor_match is not None:
+                pipeline.append({'$match': cursor_match})
+            pipeline += [
+                {'$sort': {'score': -1, '_id': -1}},
+                {'$limit': limit + 1},
+                {'$project': SEARCH_PROJECTION},
+            ]
+            return list(collection.aggregate(pipeline))
+
+        try:
+            results = await asyncio.gather(*(
+                self._run(search, collection, scope) for collection, scope in searches
+            ))
+        except Exception as e:
+            logger.error(f"Error searching messages: {e}")
+            raise
+
+        ranked = sorted(
+            (hit for hits in results for hit in hits),
+            key=lambda hit: (hit['score'], hit['_id']),
+            reverse=True
+        )
+        page = ranked[:limit]
+        has_more = len(ranked) > limit
+        next_cursor = self.encode_search_cursor(page[-1]) if has_more else None
+        terms = self._search_terms(query)
+        for hit in page:
+            hit['peer'] = hit['to'] if hit['from'] == username else hit['from']
+            hit['snippet'] = self._snippet(hit.get('content', ''), terms)
+            if isinstance(hit.get('timestamp'), datetime):
+                hit['timestamp'] = hit['timestamp'].isoformat()
+
+        return {
+            'hits': page,
+            'has_more': has_more,
+            'next_cursor': next_cursor
+        }
+
+    @staticmethod
+    def encode_search_cursor(hit):
+        """
+        Build an opaque search cursor from a hit's (score, _id).
+        """
+        return f"{hit['score']!r}|{hit['_id']}"
+
+    @staticmethod
+    def decode_search_cursor(cursor):
+        """
+        Split a search cursor back into (score, ObjectId).
+        Raises ValueError if the cursor is malformed.
+        """
+        score, sep, message_id = str(cursor).rpartition('|')
+        try:
+            score = float(score)
+        except ValueError:
+            sep = ''
+        if not sep or not ObjectId.is_valid(message_id):
+            raise ValueError(f"Invalid search cursor: {cursor}")
+        return score, ObjectId(message_id)
+
+    @staticmethod
+    def _search_terms(query):
+        """
+        Words of a search query that should appear in results, without negated terms.
+        """
+        return [
+            term.strip('"').lower()
+            for term in str(query).split()
+            if not term.startswith('-') and term.strip('"')
+        ]
+
+    @staticmethod
+    def _snippet(content, terms, width=SEARCH_SNIPPET_CHARS):
+        """
+        Cut content down to about width characters around the first matched term.
+        """
+        if len(content) <= width:
+            return content
+        # The text index stems words, so match on term prefixes
+        pattern = '|'.join(re.escape(term[:max(3, len(term) - 2)]) for term in terms)
+        match = re.search(pattern, content, re.IGNORECASE) if pattern else None
+        center = match.start() if match else 0
+        start = max(0, min(center - width // 3, len(content) - width))
+        end = start + width
+        return ('…' if start > 0 else '') + content[start:end] + ('…' if end < len(content) else '')
+
+    async def get_ai_summary(self, username):
+        """
+        Rolling summary of a user's older AI conversation, or None.
+        The document holds the summary text and the history cursor it covers up to.
+        """
+        return await self._run(self.ai_summaries.find_one, {'_id': username})
+
+    async def save_ai_summary(self, username, summary, through):
+        await self._run(
+            self.ai_summaries.update_one,
+            {'_id': username},
+            {'$set': {'summary': summary, 'through': through, 'updated_at': datetime.utcnow()}},
+            upsert=True
+        )
+
+    async def save_last_seen(self, last_seen):
+        """
+        Persist last-seen times for several users in one bulk write.
+
+        Args:
+            last_seen (dict): username -> datetime
+        """
+        # last_seen is not part of USER_PROJECTION, so cached users stay valid
+        await self._run(
+            self.users.bulk_write,
+            [UpdateOne({'username': username}, {'$set': {'last_seen': seen}})
+             for username, seen in last_seen.items()],
+            ordered=False
+        )
+
+    async def get_last_seen(self, usernames):
+        """
+        Last-seen times of the given users as a username -> datetime dict;
+        users who were never seen are left out.
+        """
+        users = await self._run(lambda: list(self.users.find(
+            {'username': {'$in': list(usernames)}, 'last_seen': {'$exists': True}},
+            {'_id': 0, 'username': 1, 'last_seen': 1}
+        )))
+        return {user['username']: user['last_seen'] for user in users}
+
     async def get_user_profile(self, username):
-        user = self.users.find_one({'username': username})
+        user = await self._get_user(username)
         if user:
             return {
                 'username': user['username'],
-                'friends': user['friends'],
-                'friend_requests': user.get('friend_requests', []),
+                'friends': list(user['friends']),
+                'friend_requests': list(user.get('friend_requests', [])),
                 'joined_date': user.get('joined_date', datetime.utcnow())
             }
         return None
@@ -430,11 +1477,27 @@ class Database:
             return False
 
     async def check_message_consistency(self):
-        all_messages = list(self.messages.find({})) + list(self.ai_messages.find({}))
+        all_messages = await self._run(
+            lambda: list(self.messages.find({})) + list(self.ai_messages.find({}))
+        )
         message_ids = set(str(msg['_id']) for msg in all_messages)
         
         for msg in all_messages:
             if 'reactions' in msg:
                 for reaction in msg['reactions']:
                     if 'messageId' in reaction and str(reaction['messageId']) not in message_ids:
-                        logger.error(f"Inconsistency found: Reaction refers to non-existent message {reaction['messageId']}")
\ No newline at end of file
+                        logger.error(f"Inconsistency found: Reaction refers to non-existent message {reaction['messageId']}")
+
+def _timed(name, method):
+    @functools.wraps(method)
+    async def timed(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            self.latency[name].observe(time.perf_counter() - started)
+    return timed
+
+for _name, _method in list(vars(Database).items()):
+    if not _name.startswith('_') and _name not in UNTIMED_METHODS and inspect.iscoroutinefunction(_method):
+        setattr(Database, _name, _timed(_name, _method))
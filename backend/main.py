@@ -1,11 +1,21 @@
 import asyncio
-import json
 import os
 import logging
+import signal
 from aiohttp import web, WSMsgType
 from dotenv import load_dotenv
 from database import Database
-from ai_assistant import AIAssistant
+from ai_assistant import AIAssistant, ModelGateway, PRIORITY_BACKGROUND
+from cachetools import LRUCache
+from collections import deque
+import time
+from broker import create_broker
+from reply_index import LocalReplySuggester
+from connection import ClientConnection, outbound_snapshot, frames_out
+from metrics import LoopLagMonitor, PrometheusWriter
+from presence import PresenceTracker, ONLINE, OFFLINE
+from routing import FrameRouter
+import protocol
 from bson import ObjectId
 from datetime import datetime
 
@@ -20,12 +30,119 @@ mongodb_uri = os.getenv('MONGODB_URI')
 if not mongodb_uri:
     raise ValueError("MONGODB_URI environment variable is not set")
 
-db = Database(mongodb_uri)
-ai_assistant = AIAssistant(os.getenv('GEMINI_API_KEY'))
+# With several workers another process may change a cached user. A change stream
+# evicts such entries (see start_background_tasks); without one they expire.
+USER_CACHE_CHANGE_STREAM = os.getenv('USER_CACHE_CHANGE_STREAM', '1' if os.getenv('BROKER_URL') else '0') == '1'
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '30'))
 
-# Store connected clients
+db = Database(
+    mongodb_uri,
+    max_workers=int(os.getenv('DB_MAX_WORKERS', '16')),
+    op_timeout=float(os.getenv('DB_OP_TIMEOUT', '10')),
+    user_cache_size=int(os.getenv('USER_CACHE_SIZE', '10000')),
+    user_cache_ttl=USER_CACHE_TTL if os.getenv('BROKER_URL') else None,
+    message_cache_bytes=int(os.getenv('MESSAGE_CACHE_BYTES', str(4 * 1024 * 1024))),
+    event_ttl=int(float(os.getenv('EVENT_LOG_TTL_DAYS', '7')) * 24 * 3600),
+    db_name=os.getenv('MONGODB_DB', 'messenger_app'),
+    write_retries=int(os.getenv('WRITE_RETRIES', '2')),
+)
+# Offline-built reply index (see reply_index.py) that answers common exchanges locally
+reply_index_path = os.getenv('REPLY_INDEX_PATH', 'reply_index.db')
+local_replies = None
+if os.path.exists(reply_index_path):
+    local_replies = LocalReplySuggester(
+        reply_index_path,
+        min_similarity=float(os.getenv('REPLY_INDEX_MIN_SIMILARITY', '0.8'))
+    )
+    logger.info(f"Using local reply index at {reply_index_path}")
+
+ai_assistant = AIAssistant(
+    os.getenv('GEMINI_API_KEY'),
+    smart_reply_cache_size=int(os.getenv('SMART_REPLY_CACHE_SIZE', '2048')),
+    smart_reply_cache_ttl=float(os.getenv('SMART_REPLY_CACHE_TTL', '600')),
+    gateway=ModelGateway(
+        max_concurrency=int(os.getenv('AI_MAX_CONCURRENCY', '4')),
+        call_timeout=float(os.getenv('AI_CALL_TIMEOUT', '20')),
+        rate_limit=int(os.getenv('AI_RATE_LIMIT', '20')),
+        rate_window=float(os.getenv('AI_RATE_WINDOW', '60')),
+        failure_threshold=int(os.getenv('AI_BREAKER_THRESHOLD', '5')),
+        reset_timeout=float(os.getenv('AI_BREAKER_RESET', '30')),
+    ),
+    local_replies=local_replies,
+)
+
+# Pub/sub bus that carries events to users connected to other workers
+broker = create_broker(os.getenv('BROKER_URL'))
+
+# Store connected clients: username -> set of ClientConnection, one per device/tab
 connected_clients = {}
 
+# Users whose broker channel this worker is subscribed to, reconciled under the lock
+subscribed_users = set()
+subscription_lock = asyncio.Lock()
+
+# Chat history page sizes for clients that paginate
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '50'))
+MAX_HISTORY_PAGE_SIZE = 200
+
+# Message search page sizes
+SEARCH_PAGE_SIZE = int(os.getenv('SEARCH_PAGE_SIZE', '20'))
+MAX_SEARCH_PAGE_SIZE = 100
+
+# Per-socket outbound queue limits
+SEND_QUEUE_SIZE = int(os.getenv('SEND_QUEUE_SIZE', '256'))
+SEND_QUEUE_HIGH_WATER = int(os.getenv('SEND_QUEUE_HIGH_WATER', '128'))
+SLOW_CONSUMER_TIMEOUT = float(os.getenv('SLOW_CONSUMER_TIMEOUT', '10'))
+
+# permessage-deflate and small-frame coalescing
+WS_COMPRESS = os.getenv('WS_COMPRESS', '1') not in ('0', 'false', 'False')
+COALESCE_WINDOW_MS = float(os.getenv('COALESCE_WINDOW_MS', '5'))
+COALESCE_MAX_BYTES = int(os.getenv('COALESCE_MAX_BYTES', '512'))
+
+# Read events from one reader for one sender within this window become one update
+READ_RECEIPT_DEBOUNCE_MS = float(os.getenv('READ_RECEIPT_DEBOUNCE_MS', '250'))
+pending_read_receipts = {}
+
+# AI conversation memory: recent turns verbatim plus a rolling summary of older ones
+AI_CONTEXT_TURNS = int(os.getenv('AI_CONTEXT_TURNS', '12'))
+AI_CONTEXT_TOKEN_BUDGET = int(os.getenv('AI_CONTEXT_TOKEN_BUDGET', '2000'))
+AI_SUMMARY_MIN_TURNS = int(os.getenv('AI_SUMMARY_MIN_TURNS', '10'))
+summary_tasks = {}
+
+# Speculative smart replies for recipients that are online when a message arrives
+SMART_REPLY_PRECOMPUTE = os.getenv('SMART_REPLY_PRECOMPUTE', '0') == '1'
+SMART_REPLY_PRECOMPUTE_PUSH = os.getenv('SMART_REPLY_PRECOMPUTE_PUSH', '0') == '1'
+SMART_REPLY_PRECOMPUTE_BUDGET = int(os.getenv('SMART_REPLY_PRECOMPUTE_BUDGET', '60'))  # per user per hour
+precompute_tasks = {}  # conversation -> running precompute task
+precompute_usage = {}  # username -> deque of precompute start times
+last_message_content = LRUCache(maxsize=10000)  # conversation -> content of its latest message
+
+# Presence: changes reach online friends in one batched frame per tick
+PRESENCE_TICK = float(os.getenv('PRESENCE_TICK', '1'))
+PRESENCE_AWAY_AFTER = float(os.getenv('PRESENCE_AWAY_AFTER', '300'))
+PRESENCE_PERSIST_INTERVAL = float(os.getenv('PRESENCE_PERSIST_INTERVAL', '60'))
+# With a distributed broker, how long a worker's record of its users outlives its last renewal
+PRESENCE_SHARED_TTL = float(os.getenv('PRESENCE_SHARED_TTL', '60'))
+
+# Events kept in each user's log for catch-up sync after reconnecting
+SYNCED_EVENT_TYPES = {'message', 'reaction_update', 'messages_read'}
+SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', '500'))
+
+# Frame handlers running at once per connection, and how often their latency is logged
+HANDLER_CONCURRENCY = int(os.getenv('HANDLER_CONCURRENCY', '8'))
+HANDLER_STATS_INTERVAL = float(os.getenv('HANDLER_STATS_INTERVAL', '60'))
+# Frames that may queue behind one lane, e.g. messages to the same recipient
+HANDLER_LANE_BACKLOG = int(os.getenv('HANDLER_LANE_BACKLOG', '32'))
+
+# Event loop lag sampling for /metrics, and the deadline of the /health?ready=1 Mongo ping
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+HEALTH_PING_TIMEOUT = float(os.getenv('HEALTH_PING_TIMEOUT', '2'))
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
+
+# Write-behind batching for chat messages
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '100'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.05'))
+
 def convert_object_ids_and_datetimes_to_strings(data):
     if isinstance(data, dict):
         return {k: str(v) if isinstance(v, (ObjectId, datetime)) else convert_object_ids_and_datetimes_to_strings(v) 
@@ -34,310 +151,882 @@ def convert_object_ids_and_datetimes_to_strings(data):
         return [convert_object_ids_and_datetimes_to_strings(item) for item in data]
     return data
 
-async def broadcast_to_user(username, message):
+async def deliver_to_local_user(username, message, exclude=None):
+    """Queue an event on every socket the user has on this worker."""
+    connections = connected_clients.get(username)
+    if not connections:
+        return False
+    # send() only enqueues, so every device is served without waiting on the others
+    delivered = [
+        connection.send(message)
+        for connection in list(connections)
+        if connection is not exclude
+    ]
+    if any(delivered):
+        logger.debug(f"Queued message for {username} on {sum(delivered)} connection(s)")
+        return True
+    return False
+
+async def broadcast_to_user(username, message, exclude=None):
     # Skip broadcasting to AI assistant since it's not a websocket client
     if username == "AI Assistant":
         return False
-    if username in connected_clients:
-        try:
-            await connected_clients[username].send_str(json.dumps(message))
-            logger.info(f"Successfully sent message to {username}")
-            return True
-        except Exception as e:
-            logger.error(f"Error broadcasting to user {username}: {e}")
-            return False
-    else:
+    if message.get('type') in SYNCED_EVENT_TYPES:
+        db.log_event(username, message)
+    delivered = await deliver_to_local_user(username, message, exclude)
+    try:
+        remote_workers = await broker.publish(username, message)
+    except Exception as e:
+        logger.error(f"Error publishing to user {username}: {e}")
+        remote_workers = 0
+    if delivered or remote_workers:
+        return True
+    if exclude is None:
         logger.warning(f"User {username} not found in connected clients")
     return False
 
-async def handle_message_to_ai(websocket, user_message_data):
+async def deliver_best_effort(username, frame):
+    """Send a state frame such as presence; unlike broadcast_to_user, missing users are not logged."""
+    await deliver_to_local_user(username, frame)
+    if broker.distributed:
+        try:
+            await broker.publish(username, frame)
+        except Exception as e:
+            logger.error(f"Error publishing {frame.get('type')} to {username}: {e}")
+
+# Friends connected to other workers are not visible here, so with a
+# distributed broker every friend is a candidate recipient, and users who
+# leave this worker stay online while the broker has them on another
+presence = PresenceTracker(
+    deliver_best_effort,
+    db.get_friends,
+    db.save_last_seen,
+    is_online=lambda username: broker.distributed or username in connected_clients,
+    online_elsewhere=broker.online_elsewhere if broker.distributed else None,
+    tick=PRESENCE_TICK,
+    away_after=PRESENCE_AWAY_AFTER,
+    persist_interval=PRESENCE_PERSIST_INTERVAL
+)
+
+async def friend_presence(friends):
+    """Presence updates describing each friend, with last-seen times for offline ones."""
+    updates = [{'username': friend, 'status': presence.get(friend)} for friend in friends]
+    offline = [update['username'] for update in updates if update['status'] == OFFLINE]
+    if offline and broker.distributed:
+        try:
+            elsewhere = await broker.online_elsewhere(offline)
+        except Exception as e:
+            logger.error(f"Error checking presence on other workers: {e}")
+            elsewhere = set()
+        for update in updates:
+            if update['username'] in elsewhere:
+                update['status'] = ONLINE
+        offline = [username for username in offline if username not in elsewhere]
+    if offline:
+        last_seen = await db.get_last_seen(offline)
+        for update in updates:
+            if update['username'] in last_seen:
+                update['last_seen'] = last_seen[update['username']].isoformat()
+    return updates
+
+async def announce_event_positions(positions):
+    """Tell online users how far their event log goes, so a reconnect resumes from there."""
+    await asyncio.gather(*(
+        deliver_best_effort(username, {'type': 'sync_position', 'seq': seq})
+        for username, seq in positions.items()
+    ))
+
+async def send_missed_events(connection, username, last_seq):
+    """
+    Stream the events logged for a user after last_seq as 'sync' frames.
+    A frame with reset set means the log no longer reaches back that far.
+    """
+    await db.wait_until_events_logged(username)
+    after = last_seq
+    while True:
+        page = await db.get_events_since(username, after, SYNC_PAGE_SIZE)
+        connection.send({
+            'type': 'sync',
+            'after': after,
+            **convert_object_ids_and_datetimes_to_strings(page)
+        })
+        if not page['has_more']:
+            return
+        after = page['seq']
+
+async def sync_subscription(username):
+    """
+    Bring the broker subscription for a user in line with connected_clients.
+    Called after every register/unregister, so racing reconnects always
+    converge on the latest state rather than on the order the awaits finish.
+    """
+    async with subscription_lock:
+        wanted = bool(connected_clients.get(username))
+        if wanted and username not in subscribed_users:
+            await broker.subscribe(username)
+            await broker.mark_online([username], PRESENCE_SHARED_TTL)
+            subscribed_users.add(username)
+        elif not wanted and username in subscribed_users:
+            await broker.unsubscribe(username)
+            await broker.mark_offline(username)
+            subscribed_users.discard(username)
+
+async def renew_shared_presence(interval):
+    """
+    Keep renewing the broker's record of the users connected here. If this
+    worker dies, its users drop out of online_elsewhere once the record lapses.
+    """
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await broker.mark_online(list(subscribed_users), PRESENCE_SHARED_TTL)
+        except Exception as e:
+            logger.error(f"Error renewing shared presence: {e}")
+
+async def register_connection(username, connection):
+    if username not in connected_clients:
+        presence.connected(username)
+    connected_clients.setdefault(username, set()).add(connection)
+    await sync_subscription(username)
+
+async def unregister_connection(username, connection):
+    connections = connected_clients.get(username)
+    if connections is None or connection not in connections:
+        return
+    connections.discard(connection)
+    # Only drop the entry if no newer socket for this user took its place
+    if not connections:
+        del connected_clients[username]
+        presence.disconnected(username)
+    await sync_subscription(username)
+    logger.info(f"User {username} disconnected ({len(connections)} connection(s) left)")
+
+def schedule_read_receipt(reader, sender):
+    """Debounce mark_messages_read: one pending flush per (reader, sender) pair."""
+    key = (reader, sender)
+    if key not in pending_read_receipts:
+        pending_read_receipts[key] = asyncio.create_task(flush_read_receipt(reader, sender))
+
+async def flush_read_receipt(reader, sender):
+    await asyncio.sleep(READ_RECEIPT_DEBOUNCE_MS / 1000)
+    # Events arriving from here on schedule a new flush
+    pending_read_receipts.pop((reader, sender), None)
+    try:
+        result = await db.mark_messages_read(reader, sender)
+        if result['modified_count'] > 0:
+            # Notify the sender that their messages were read
+            read_receipt = {
+                'type': 'messages_read',
+                'reader': reader,
+                'sender': sender,
+                'timestamp': result['timestamp']  # result['timestamp'] is already an ISO string
+            }
+            await broadcast_to_user(sender, read_receipt)
+    except Exception as e:
+        logger.error(f"Error handling mark_messages_read: {e}")
+
+def take_precompute_budget(username, budget):
+    """Count a precompute against the user's hourly budget; False if it is used up."""
+    now = time.monotonic()
+    usage = precompute_usage.setdefault(username, deque())
+    while usage and now - usage[0] > 3600:
+        usage.popleft()
+    if len(usage) >= budget:
+        return False
+    usage.append(now)
+    return True
+
+async def precompute_smart_replies(recipient, sender, conversation, previous, content):
+    """
+    Generate the recipient's smart replies for a message they just received,
+    at background priority, so their next get_smart_replies is a cache hit.
+    """
+    try:
+        budget = await db.get_smart_reply_budget(recipient, SMART_REPLY_PRECOMPUTE_BUDGET)
+        if not take_precompute_budget(recipient, budget):
+            return
+        if previous is None:
+            # The new message may not be stored yet, so the latest durable one is the previous
+            page = await db.get_messages_page(recipient, sender, limit=1)
+            previous = page['messages'][-1]['content'] if page['messages'] else None
+        # Same shape as the client's context: its last two messages
+        context = {'messages': [{'content': text} for text in (previous, content) if text is not None]}
+        suggestions = await ai_assistant.generate_smart_replies(
+            context,
+            conversation=conversation,
+            priority=PRIORITY_BACKGROUND
+        )
+        if SMART_REPLY_PRECOMPUTE_PUSH and suggestions:
+            await deliver_to_local_user(recipient, {
+                'type': 'smart_replies',
+                'suggestions': suggestions,
+                'for': sender,
+                'precomputed': True
+            })
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Error precomputing smart replies for {recipient}: {e}")
+    finally:
+        if precompute_tasks.get(conversation) is asyncio.current_task():
+            del precompute_tasks[conversation]
+
+def on_message_queued(sender, recipient, content):
+    """
+    React to a new chat message: drop stale smart replies for the conversation,
+    cancel its outdated precompute and, if enabled, start a new one.
+    """
+    conversation = db.conversation_id(sender, recipient)
+    ai_assistant.invalidate_smart_replies(conversation)
+    previous = last_message_content.get(conversation)
+    last_message_content[conversation] = content
+
+    stale = precompute_tasks.pop(conversation, None)
+    # A precompute the recipient is already waiting on is left to finish
+    if stale is not None and not ai_assistant.smart_replies_awaited(conversation):
+        stale.cancel()
+    # Only worth it when the recipient's next request will land on this worker
+    if SMART_REPLY_PRECOMPUTE and connected_clients.get(recipient):
+        precompute_tasks[conversation] = asyncio.create_task(
+            precompute_smart_replies(recipient, sender, conversation, previous, content)
+        )
+
+def make_ack_callback(connection, message_id, client_id=None):
+    """Build a done-callback that tells the sender whether a queued message was stored."""
+    def ack(durable):
+        if durable.cancelled() or durable.exception() is not None:
+            connection.send({
+                'type': 'error',
+                'message': 'Failed to save message',
+                '_id': message_id,
+                'clientId': client_id
+            })
+            return
+        connection.send({
+            'type': 'ack',
+            '_id': message_id,
+            'clientId': client_id
+        })
+    return ack
+
+async def refresh_ai_summary(username, before):
+    """Fold turns that fell out of the context window into the user's AI summary."""
+    try:
+        state = await db.get_ai_summary(username) or {}
+        turns = await db.get_messages_between(username, "AI Assistant", after=state.get('through'), before=before)
+        # Wait until enough turns have piled up to be worth a model call
+        if len(turns) < AI_SUMMARY_MIN_TURNS:
+            return
+        summary = await ai_assistant.summarize(state.get('summary'), turns)
+        if summary:
+            await db.save_ai_summary(username, summary, db.encode_history_cursor(turns[-1]))
+    except Exception as e:
+        logger.error(f"Error refreshing AI summary for {username}: {e}")
+    finally:
+        summary_tasks.pop(username, None)
+
+def schedule_summary_refresh(username, before):
+    """Start a background summary refresh unless one is already running for the user."""
+    if username not in summary_tasks:
+        summary_tasks[username] = asyncio.create_task(refresh_ai_summary(username, before))
+
+async def handle_message_to_ai(connection, user_message_data):
     """Handle messages specifically for AI Assistant"""
     try:
-        # Process AI response
-        ai_response = await ai_assistant.get_response(user_message_data['content'])
+        username = user_message_data['from']
+
+        # Recent turns and the summary of everything older, fetched together
+        history, summary = await asyncio.gather(
+            db.get_messages_page(username, "AI Assistant", limit=AI_CONTEXT_TURNS),
+            db.get_ai_summary(username)
+        )
+        prompt = ai_assistant.build_prompt(
+            user_message_data['content'],
+            history['messages'],
+            summary.get('summary') if summary else None,
+            AI_CONTEXT_TOKEN_BUDGET
+        )
 
         # Save user's message to database
-        user_msg_id = await db.save_message(user_message_data['from'], "AI Assistant", user_message_data['content'])
-        ai_msg_id = await db.save_message("AI Assistant", user_message_data['from'], ai_response)
+        user_msg_id = await db.save_message(username, "AI Assistant", user_message_data['content'])
+
+        # Forward partial AI output as it arrives
+        chunks = []
+        async for chunk in ai_assistant.stream_response(prompt, user=username):
+            chunks.append(chunk)
+            connection.send({
+                'type': 'ai_message_chunk',
+                'from': "AI Assistant",
+                'to': username,
+                'index': len(chunks) - 1,
+                'content': chunk
+            })
+        ai_response = ''.join(chunks)
 
-        # Send AI response with message ID
+        ai_msg_id = await db.save_message("AI Assistant", username, ai_response)
+
+        # Send the complete AI response with its persisted message ID
         ai_message = {
             'type': 'message',
             '_id': str(ai_msg_id),
             'from': "AI Assistant",
-            'to': user_message_data['from'],
+            'to': username,
             'content': ai_response
         }
-        await websocket.send_str(json.dumps(ai_message))
+        connection.send(ai_message)
+        # Suggestions cached for the previous turn no longer apply
+        ai_assistant.invalidate_smart_replies(db.conversation_id(username, "AI Assistant"))
+
+        # Turns older than the window are summarized off the request path
+        if history['has_more']:
+            schedule_summary_refresh(username, history['next_cursor'])
 
     except Exception as e:
         logger.error(f"Error in AI message handling: {e}")
-        await websocket.send_str(json.dumps({
+        connection.send({
             'type': 'error',
             'message': 'Failed to get AI response. Please try again.'
-        }))
+        })
+
+async def handle_reaction(connection, data):
+    try:
+        if not all(key in data for key in ['messageId', 'from', 'emoji']):
+            raise ValueError("Missing required fields for reaction")
+        
+        if not db.is_valid_object_id(data['messageId']):
+            logger.error(f"Invalid message ID format: {data['messageId']}")
+            connection.send({
+                'type': 'error',
+                'message': 'Invalid message ID format'
+            })
+            return
+
+        # One atomic update returns the participants and the per-emoji summary
+        result = await db.add_reaction(
+            data['messageId'],
+            data['from'],
+            data['emoji']
+        )
+        
+        if result is None:
+            connection.send({
+                'type': 'error',
+                'message': f"Message {data['messageId']} not found"
+            })
+            return
+        
+        # Create the reaction update message
+        reaction_update = {
+            'type': 'reaction_update',
+            'messageId': str(data['messageId']),  # Ensure messageId is a string
+            'reactions': result['reactions']
+        }
+        
+        # Broadcast to both participants; a set avoids duplicates
+        participants = {result['from'], result['to']}
+        logger.debug(f"Broadcasting reaction update to participants: {participants}")
+        await asyncio.gather(*[
+            broadcast_to_user(participant, reaction_update)
+            for participant in participants
+        ])
+        
+    except Exception as e:
+        logger.error(f"Error handling reaction: {str(e)}")
+        connection.send({
+            'type': 'error',
+            'message': 'Failed to add reaction'
+        })
+
+# Frame handlers, keyed by frame type; see routing.FrameRouter
+router = FrameRouter(max_concurrency=HANDLER_CONCURRENCY, max_lane_backlog=HANDLER_LANE_BACKLOG)
 
-async def handle_reaction(websocket, data):
-    max_retries = 3
-    retry_delay = 1  # seconds
+# The session username changes here, so later frames must wait for it
+@router.route('register', {'username': str, 'protocol?': str}, inline=True)
+async def handle_register(session, data):
+    connection = session.connection
+    if session.username and session.username != data['username']:
+        await unregister_connection(session.username, connection)
+    session.username = data['username']
+    await register_connection(session.username, connection)
+    # The wire format can also be chosen at register time
+    if data.get('protocol') in protocol.SUPPORTED_PROTOCOLS:
+        connection.protocol = data['protocol']
+    # Clients that handle 'batch' frames get bursts of small frames merged
+    connection.batching = bool(data.get('batch'))
+    # One upsert returns the user's friends and requests
+    user = await db.register_user(session.username)
 
-    for attempt in range(max_retries):
+    # Send initial data including AI Assistant
+    friends = list(user.get('friends', []))
+    friends.append("AI Assistant")
+    requests = {
+        'type': 'friend_requests',
+        'requests': list(user.get('friend_requests', []))
+    }
+
+    connection.send({
+        'type': 'initial_data',
+        'friends': friends,
+        'friend_requests': requests
+    })
+    # Badge counts without loading every conversation
+    connection.send({
+        'type': 'unread_counts',
+        'counts': await db.get_unread_counts(session.username)
+    })
+    # Clients that remember their event log position get what they missed
+    if data.get('last_seq') is not None:
         try:
-            if not all(key in data for key in ['messageId', 'from', 'emoji']):
-                raise ValueError("Missing required fields for reaction")
-            
-            if not db.is_valid_object_id(data['messageId']):
-                logger.error(f"Invalid message ID format: {data['messageId']}")
-                await websocket.send_str(json.dumps({
-                    'type': 'error',
-                    'message': 'Invalid message ID format'
-                }))
-                return
-
-            # Check if the message exists before adding the reaction
-            message = await db.get_message_by_id(data['messageId'])
-            if not message:
-                raise ValueError(f"Message {data['messageId']} not found")
-            
-            result = await db.add_reaction(
-                data['messageId'],
-                data['from'],
-                data['emoji']
-            )
-            
-            if result is None:
-                raise ValueError(f"Failed to add reaction. Message {data['messageId']} not found.")
-            
-            # Create the reaction update message
-            reaction_update = {
-                'type': 'reaction_update',
-                'messageId': str(data['messageId']),  # Ensure messageId is a string
-                'reactions': result['reactions']
-            }
-            
-            # Get both participants
-            participants = set([message['from'], message['to']])  # Use set to avoid duplicates
-            
-            # Broadcast to all relevant participants
-            broadcast_tasks = []
-            logger.info(f"Broadcasting reaction update to participants: {participants}")
-            for participant in participants:
-                if participant in connected_clients:
-                    try:
-                        # Create broadcast task
-                        task = broadcast_to_user(participant, reaction_update)
-                        broadcast_tasks.append(task)
-                    except Exception as e:
-                        logger.error(f"Error preparing broadcast to {participant}: {e}")
-            
-            # Wait for all broadcasts to complete
-            if broadcast_tasks:
-                await asyncio.gather(*broadcast_tasks)
-                
-            return  # Success, exit the function
-            
-        except Exception as e:
-            logger.error(f"Error handling reaction (attempt {attempt + 1}): {str(e)}")
-            if attempt < max_retries - 1:
-                await asyncio.sleep(retry_delay)
-            else:
-                await websocket.send_str(json.dumps({
-                    'type': 'error',
-                    'message': 'Failed to add reaction after multiple attempts'
-                }))
+            last_seq = int(data['last_seq'])
+        except (TypeError, ValueError):
+            last_seq = 0
+        await send_missed_events(connection, session.username, last_seq)
+    # Current status of every friend; later changes arrive batched per tick
+    connection.send({
+        'type': 'presence',
+        'updates': await friend_presence(user.get('friends', []))
+    })
+
+@router.route('presence', {'status': str})
+async def handle_presence(session, data):
+    # Clients report away when their window is hidden and online when it returns
+    if session.username:
+        presence.set_client_status(session.username, data['status'])
+
+@router.route('add_friend', {'from': str, 'to': str})
+async def handle_add_friend(session, data):
+    result = await db.add_friend(data['from'], data['to'])
+
+    if result['status'] == 'success':
+        await broadcast_to_user(data['to'], {
+            'type': 'friend_request',
+            'from': data['from'],
+            'to': data['to']
+        })
+        await broadcast_to_user(data['from'], result)
+
+@router.route('accept_friend_request', {'from': str, 'to': str})
+async def handle_accept_friend_request(session, data):
+    result = await db.accept_friend_request(data['from'], data['to'])
+
+    if result['status'] == 'success':
+        notification = {
+            'type': 'friend_added',
+            'from': data['from'],
+            'to': data['to']
+        }
+        for username in [data['from'], data['to']]:
+            await broadcast_to_user(username, notification)
+
+# Messages in one conversation keep their order; other conversations are not held up
+@router.route('message', {'from': str, 'to': str, 'content': str}, lane=lambda data: data['to'])
+async def handle_message(session, data):
+    connection = session.connection
+    if data['to'] == "AI Assistant":
+        await handle_message_to_ai(connection, data)
+        return
+    message_id, durable = db.queue_message(data['from'], data['to'], data['content'])
+    durable.add_done_callback(make_ack_callback(connection, message_id, data.get('clientId')))
+    message_data = {
+        'type': 'message',
+        '_id': message_id,
+        'from': data['from'],
+        'to': data['to'],
+        'content': data['content']
+    }
+    # Broadcast to recipient and the sender's other devices;
+    # this socket updates its UI optimistically
+    await asyncio.gather(
+        broadcast_to_user(data['to'], message_data),
+        broadcast_to_user(data['from'], message_data, exclude=connection)
+    )
+    on_message_queued(data['from'], data['to'], data['content'])
+
+@router.route('get_smart_replies', {'from': str, 'to': str, 'context?': dict})
+async def handle_get_smart_replies(session, data):
+    try:
+        # Generate smart replies using AI assistant
+        smart_replies = await ai_assistant.generate_smart_replies(
+            data.get('context', {}),
+            conversation=db.conversation_id(data['from'], data['to']),
+            user=data['from']
+        )
+    except Exception as e:
+        logger.error(f"Error generating smart replies: {e}")
+        smart_replies = []
+
+    # Send smart reply suggestions back to the client
+    session.connection.send({
+        'type': 'smart_replies',
+        'suggestions': smart_replies
+    })
+
+@router.route('get_friends', {'username': str})
+async def handle_get_friends(session, data):
+    friends = await db.get_friends(data['username'])
+    friends.append("AI Assistant")
+    session.connection.send({
+        'type': 'friends_list',
+        'friends': friends
+    })
+
+@router.route('message_reaction', {'messageId': str, 'from': str, 'emoji': str})
+async def handle_message_reaction(session, data):
+    await handle_reaction(session.connection, data)
+
+@router.route('get_friend_requests', {'username': str})
+async def handle_get_friend_requests(session, data):
+    requests = await db.get_friend_requests(data['username'])
+    session.connection.send({
+        'type': 'friend_requests',
+        'requests': requests
+    })
+
+@router.route('load_chat_history', {'from': str, 'to': str, 'limit?': (int, str), 'before?': str})
+async def handle_load_chat_history(session, data):
+    connection = session.connection
+    # Clients that send a limit or cursor get one page at a time;
+    # older clients still receive the whole conversation
+    paginated = 'limit' in data or 'before' in data
+    if paginated:
+        try:
+            limit = max(1, min(int(data.get('limit') or HISTORY_PAGE_SIZE), MAX_HISTORY_PAGE_SIZE))
+            page = await db.get_messages_page(data['from'], data['to'], data.get('before'), limit)
+        except ValueError as e:
+            connection.send({
+                'type': 'error',
+                'message': str(e)
+            })
+            return
+        messages = page['messages']
+    else:
+        messages = await db.get_messages(data['from'], data['to'])
+    messages = convert_object_ids_and_datetimes_to_strings(messages)
+
+    formatted_messages = [
+        {
+            'type': 'message',
+            '_id': str(msg['_id']),
+            'from': msg['from'],
+            'to': msg['to'],
+            'content': msg['content'],
+            'timestamp': msg.get('timestamp'),
+            'read':   msg.get('read', False),
+            'readAt': msg.get('readAt'),
+            'reactions': msg.get('reactions', [])  # Include reactions if available
+        }
+        for msg in messages
+    ]
+
+    history = {
+        'type': 'chat_history',
+        'has_more': page['has_more'] if paginated else False
+    }
+    if connection.binary:
+        # Binary clients get a columnar layout without per-message keys
+        history['columns'] = protocol.columnar_history(formatted_messages, data['from'], data['to'])
+    else:
+        history['chat'] = formatted_messages
+    if paginated:
+        history['next_cursor'] = page['next_cursor']
+        history['before'] = data.get('before')
+    connection.send(history)
+
+@router.route('search_messages', {'query': str, 'with?': str, 'limit?': (int, str), 'after?': str})
+async def handle_search_messages(session, data):
+    connection = session.connection
+    # Only the registered user's own conversations are searched
+    query = data['query'].strip()
+    if not session.username or not query:
+        connection.send({
+            'type': 'error',
+            'message': 'Search needs a registered user and a query'
+        })
+        return
+    try:
+        limit = max(1, min(int(data.get('limit') or SEARCH_PAGE_SIZE), MAX_SEARCH_PAGE_SIZE))
+        results = await db.search_messages(session.username, query, data.get('with'), limit, data.get('after'))
+    except ValueError as e:
+        connection.send({
+            'type': 'error',
+            'message': str(e)
+        })
+        return
+    connection.send({
+        'type': 'search_results',
+        'query': query,
+        'with': data.get('with'),
+        'after': data.get('after'),
+        **convert_object_ids_and_datetimes_to_strings(results)
+    })
+
+@router.route('mark_messages_read', {'reader': str, 'sender': str})
+async def handle_mark_messages_read(session, data):
+    schedule_read_receipt(data['reader'], data['sender'])
+
+@router.route('typing_status', {'from': str, 'to': str, 'isTyping': bool}, lane=lambda data: data['to'])
+async def handle_typing_status(session, data):
+    # Broadcast typing status to the recipient
+    typing_status = {
+        'type': 'typing_status',
+        'from': data['from'],
+        'to': data['to'],
+        'isTyping': data['isTyping']
+    }
+    await broadcast_to_user(data['to'], typing_status)
+
 async def ws_handler(request):
-    websocket = web.WebSocketResponse(heartbeat=30)
+    # Clients may ask for binary MessagePack frames with the 'msgpack' subprotocol
+    websocket = web.WebSocketResponse(
+        heartbeat=30,
+        protocols=protocol.SUPPORTED_PROTOCOLS,
+        compress=WS_COMPRESS
+    )
     await websocket.prepare(request)
-    client_username = None
+    connection = ClientConnection(
+        websocket,
+        max_queue=SEND_QUEUE_SIZE,
+        high_water=SEND_QUEUE_HIGH_WATER,
+        slow_consumer_timeout=SLOW_CONSUMER_TIMEOUT,
+        coalesce_window=COALESCE_WINDOW_MS / 1000,
+        coalesce_max_bytes=COALESCE_MAX_BYTES
+    )
+    if websocket.ws_protocol in protocol.SUPPORTED_PROTOCOLS:
+        connection.protocol = websocket.ws_protocol
+    session = router.session(connection)
     try:
         async for msg in websocket:
             try:
-                if msg.type != WSMsgType.TEXT:
+                if msg.type == WSMsgType.TEXT:
+                    data = protocol.decode(msg.data, protocol.JSON)
+                elif msg.type == WSMsgType.BINARY:
+                    data = protocol.decode(msg.data, protocol.MSGPACK)
+                else:
                     continue
-                data = json.loads(msg.data)
-                
-                if data['type'] == 'register':
-                    client_username = data['username']
-                    connected_clients[client_username] = websocket
-                    await db.add_user(client_username)
-                    
-                    # Send initial data including AI Assistant
-                    friends = await db.get_friends(client_username)
-                    friends.append("AI Assistant")
-                    requests = await db.get_friend_requests(client_username)
-
-                    await websocket.send_str(json.dumps({
-                        'type': 'initial_data',
-                        'friends': friends,
-                        'friend_requests': requests
-                    }))
-
-                elif data['type'] == 'add_friend':
-                    result = await db.add_friend(data['from'], data['to'])
-                    
-                    if result['status'] == 'success':
-                        await broadcast_to_user(data['to'], {
-                            'type': 'friend_request',
-                            'from': data['from'],
-                            'to': data['to']
-                        })
-                        await broadcast_to_user(data['from'], result)
-
-                elif data['type'] == 'accept_friend_request':
-                    result = await db.accept_friend_request(data['from'], data['to'])
-                    
-                    if result['status'] == 'success':
-                        notification = {
-                            'type': 'friend_added',
-                            'from': data['from'],
-                            'to': data['to']
-                        }
-                        for username in [data['from'], data['to']]:
-                            await broadcast_to_user(username, notification)
-
-                elif data['type'] == 'message':
-                    if data['to'] == "AI Assistant":
-                        await handle_message_to_ai(websocket, data)
-                    else:
-                        message_id = await db.save_message(data['from'], data['to'], data['content'])
-                        message_data = {
-                            'type': 'message',
-                            '_id': message_id,
-                            'from': data['from'],
-                            'to': data['to'],
-                            'content': data['content']
-                        }
-                        # Broadcast to recipient; sender updates UI optimistically
-                        await broadcast_to_user(data['to'], message_data)
-                elif data['type'] == 'get_smart_replies':
-                    try:
-                        # Extract context from the request
-                        from_user = data['from']
-                        to_user = data['to']
-                        context = data.get('context', {})
-
-                        # Generate smart replies using AI assistant
-                        smart_replies = await ai_assistant.generate_smart_replies(context)
-
-                        # Send smart reply suggestions back to the client
-                        await websocket.send_str(json.dumps({
-                            'type': 'smart_replies',
-                            'suggestions': smart_replies
-                        }))
-
-                    except Exception as e:
-                        logger.error(f"Error generating smart replies: {e}")
-                        await websocket.send_str(json.dumps({
-                            'type': 'smart_replies',
-                            'suggestions': []
-                        }))
-                elif data['type'] == 'get_friends': 
-                    friends = await db.get_friends(data['username'])
-                    friends.append("AI Assistant")
-                    await websocket.send_str(json.dumps({
-                        'type': 'friends_list',
-                        'friends': friends
-                    }))
-
-                elif data['type'] == 'message_reaction':
-                    await handle_reaction(websocket, data)
-
-                elif data['type'] == 'get_friend_requests':
-                    requests = await db.get_friend_requests(data['username'])
-                    await websocket.send_str(json.dumps({
-                        'type': 'friend_requests',
-                        'requests': requests
-                    }))
-
-                elif data['type'] == 'load_chat_history':
-                    messages = await db.get_messages(data['from'], data['to'])
-                    messages = convert_object_ids_and_datetimes_to_strings(messages)
-                    
-                    formatted_messages = [
-                        {
-                            'type': 'message',
-                            '_id': str(msg['_id']),  
-                            'from': msg['from'],
-                            'to': msg['to'],
-                            'content': msg['content'],
-                            'timestamp': msg.get('timestamp'),
-                            'read':   msg.get('read', False),
-                            'readAt': msg.get('readAt'),
-                            'reactions': msg.get('reactions', [])  # Include reactions if available
-                        }
-                        for msg in messages
-                    ]
-                    
-                    await websocket.send_str(json.dumps({
-                        'type': 'chat_history',
-                        'chat': formatted_messages
-                    }))
-
-                elif data['type'] == 'mark_messages_read':
-                    try:
-                        result = await db.mark_messages_read(data['reader'], data['sender'])
-                        if result['modified_count'] > 0:
-                            # Notify the sender that their messages were read
-                            read_receipt = {
-                                'type': 'messages_read',
-                                'reader': data['reader'],
-                                'sender': data['sender'],
-                                'timestamp': result['timestamp']  # result['timestamp'] is already an ISO string
-                            }
-                            await broadcast_to_user(data['sender'], read_receipt)
-                    except Exception as e:
-                        logger.error(f"Error handling mark_messages_read: {e}")
-
-                elif data['type'] == 'typing_status':
-                    # Broadcast typing status to the recipient
-                    typing_status = {
-                        'type': 'typing_status',
-                        'from': data['from'],
-                        'to': data['to'],
-                        'isTyping': data['isTyping']
-                    }
-                    await broadcast_to_user(data['to'], typing_status)
-
-            except json.JSONDecodeError:
-                logger.error("Invalid JSON received") 
-
-    except Exception:
-        logger.info("Client connection closed")
+            except protocol.FrameDecodeError as e:
+                logger.error(f"Invalid frame received: {e}")
+                connection.send({
+                    'type': 'error',
+                    'message': 'Invalid frame'
+                })
+                continue
+            if session.username:
+                presence.touch(session.username)
+            await session.dispatch(data)
+
     except Exception as e:
         logger.error(f"Error in handle_client: {e}")
     finally:
-        if client_username and client_username in connected_clients:
-            del connected_clients[client_username]
-            logger.info(f"User {client_username} disconnected")
+        await session.close()
+        await connection.close()
+        if session.username:
+            await unregister_connection(session.username, connection)
 
     return websocket
 
+async def report_handler_latency(interval):
+    """Log the handler latency histogram of every frame type once per interval."""
+    while True:
+        await asyncio.sleep(interval)
+        for frame_type, histogram in sorted(router.latency.items()):
+            stats = histogram.snapshot()
+            logger.info(
+                f"Handler latency {frame_type}: {stats['count']} frames, "
+                f"p50 <= {stats['p50']}s, p99 <= {stats['p99']}s"
+            )
+
+def log_background_failure(task):
+    """Done-callback that logs the exception of a failed background task."""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Background task {task.get_name()} failed: {task.exception()}")
+
 async def health_handler(request):
+    """
+    Liveness by default. With ?ready=1 the database is pinged too, off the
+    event loop, and a failure returns 503 so load balancers stop routing here.
+    """
+    if request.query.get('ready') not in ('1', 'true'):
+        return web.Response(text='OK')
+    try:
+        await db.ping(timeout=HEALTH_PING_TIMEOUT)
+    except Exception as e:
+        logger.warning(f"Readiness check failed: {e!r}")
+        return web.Response(status=503, text='MongoDB unavailable')
     return web.Response(text='OK')
 
+async def metrics_handler(request):
+    """Counters, gauges and histograms in the Prometheus text format."""
+    out = PrometheusWriter(prefix='chat_')
+
+    outbound = outbound_snapshot()
+    out.gauge('connected_sockets', 'Open WebSocket connections', outbound['connections'])
+    out.gauge('connected_users', 'Users with at least one open connection', len(connected_clients))
+    out.counter('frames_in_total', 'Frames received by type', [
+        ({'type': frame_type}, count) for frame_type, count in sorted(router.frames_in.items())
+    ])
+    out.counter('frames_out_total', 'Frames queued for sending by type', [
+        ({'type': str(frame_type)}, count) for frame_type, count in sorted(frames_out.items(), key=str)
+    ])
+    out.counter('frame_errors_total', 'Frames rejected or whose handler failed', [
+        ({'reason': 'invalid'}, router.stats['invalid']),
+        ({'reason': 'failed'}, router.stats['failed'])
+    ])
+    out.histogram('handler_latency_seconds', 'Frame handler latency', router.latency, label='type')
+    out.counter('outbound_total', 'Outbound queue events', [
+        ({'event': event}, outbound[event])
+        for event in ('sent', 'batches', 'batched_frames', 'coalesced', 'dropped', 'evicted')
+    ])
+    out.counter('outbound_bytes_total', 'Bytes written to sockets', outbound['bytes_sent'])
+    out.gauge('outbound_queue_depth', 'Frames waiting in outbound queues', [
+        ({'stat': 'total'}, outbound['queue_depth_total']),
+        ({'stat': 'max'}, outbound['queue_depth_max'])
+    ])
+
+    out.histogram('db_latency_seconds', 'Database method latency', db.latency, label='method')
+    cache = db.message_cache.stats()
+    out.counter('message_cache_lookups_total', 'Message cache lookups', [
+        ({'result': 'hit'}, cache['hits']),
+        ({'result': 'miss'}, cache['misses'])
+    ])
+    out.gauge('message_cache_hit_ratio', 'Message cache hit ratio', cache['hit_rate'])
+    out.counter('message_cache_evictions_total', 'Message cache evictions', cache['evictions'])
+    out.gauge('message_cache_bytes', 'Estimated message cache size', cache['bytes'])
+    out.counter('user_cache_lookups_total', 'User cache lookups', [
+        ({'result': 'hit'}, db.cache_stats['user_hits']),
+        ({'result': 'miss'}, db.cache_stats['user_misses'])
+    ])
+
+    gateway = ai_assistant.gateway.snapshot()
+    out.histogram('ai_queue_wait_seconds', 'Time model calls waited for a slot', ai_assistant.gateway.queue_wait)
+    out.histogram('ai_call_latency_seconds', 'Model call latency', ai_assistant.gateway.latency)
+    out.histogram('ai_time_to_first_token_seconds', 'Time to the first streamed chunk of an AI reply',
+                  ai_assistant.time_to_first_token)
+    out.counter('ai_calls_total', 'Model calls admitted', gateway['calls'])
+    out.counter('ai_errors_total', 'Failed model calls', [
+        ({'reason': 'timeout'}, gateway['timeouts']),
+        ({'reason': 'error'}, gateway['failures'] - gateway['timeouts'])
+    ])
+    out.counter('ai_rejected_total', 'Model calls rejected before running', [
+        ({'reason': 'circuit_open'}, gateway['rejected_open']),
+        ({'reason': 'rate_limited'}, gateway['rate_limited'])
+    ])
+    out.counter('ai_fallbacks_total', 'Canned answers served instead of the model', [
+        ({'kind': kind}, count) for kind, count in ai_assistant.fallback_stats.items()
+    ])
+    out.gauge('ai_in_flight', 'Model calls running', gateway['in_flight'])
+    out.gauge('ai_queued', 'Model calls waiting for a slot', gateway['queued'])
+    out.gauge('ai_breaker_state', 'Model circuit breaker state: 1 for the current one', [
+        ({'state': state}, int(gateway['breaker_state'] == state)) for state in ('closed', 'half_open', 'open')
+    ])
+    smart = ai_assistant.smart_reply_stats
+    out.counter('smart_replies_total', 'Smart reply requests by how they were answered', [
+        ({'source': 'cache'}, smart['hits']),
+        ({'source': 'local'}, smart['local']),
+        ({'source': 'shared'}, smart['shared']),
+        ({'source': 'model'}, smart['misses'])
+    ])
+
+    out.counter('presence_frames_total', 'Presence frames fanned out', presence.stats['frames'])
+    out.histogram('event_loop_lag_seconds', 'Event loop wake-up delay', loop_lag.histogram)
+    out.gauge('event_loop_lag_last_seconds', 'Most recent event loop lag sample', loop_lag.last)
+
+    return web.Response(text=out.render(), content_type='text/plain', charset='utf-8')
+
+def create_app():
+    app = web.Application()
+    app.router.add_get('/', health_handler)
+    app.router.add_get('/health', health_handler)
+    app.router.add_get('/metrics', metrics_handler)
+    app.router.add_get('/ws', ws_handler)
+    return app
+
+async def start_background_tasks():
+    """
+    Start the broker and the background loops the server relies on.
+    Returns the tasks to hand to stop_background_tasks.
+    """
+    await broker.start(deliver_to_local_user)
+    tasks = {
+        'writer': asyncio.create_task(db.run_message_writer(WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL)),
+        'event_writer': asyncio.create_task(db.run_event_writer(on_logged=announce_event_positions)),
+        # Backfill conversation_id in the background; queries switch over when it finishes
+        'migration': asyncio.create_task(db.migrate_conversation_ids()),
+        # Count messages that were unread before the counters existed
+        'unread_backfill': asyncio.create_task(db.migrate_unread_counts()),
+        'presence': asyncio.create_task(presence.run()),
+        'loop_lag': asyncio.create_task(loop_lag.run()),
+        'handler_latency': asyncio.create_task(report_handler_latency(HANDLER_STATS_INTERVAL)),
+    }
+    # With several workers, other processes' friend list changes must evict cached users
+    if USER_CACHE_CHANGE_STREAM:
+        tasks['user_watch'] = asyncio.create_task(db.watch_user_changes(fallback_ttl=USER_CACHE_TTL))
+    if broker.distributed:
+        tasks['shared_presence'] = asyncio.create_task(renew_shared_presence(PRESENCE_SHARED_TTL / 3))
+    for task in tasks.values():
+        task.add_done_callback(log_background_failure)
+    return tasks
+
+async def stop_background_tasks(tasks):
+    """
+    Persist everything still buffered and release the broker and database.
+    Call after the sockets are closed.
+    """
+    # Stop the loops and migrations before the executor they run queries on shuts down;
+    # the migrations checkpoint their progress and resume on the next start
+    stopped = [
+        tasks[name] for name in (
+            'presence', 'loop_lag', 'handler_latency', 'shared_presence',
+            'migration', 'unread_backfill', 'user_watch'
+        )
+        if name in tasks
+    ]
+    for task in stopped:
+        task.cancel()
+    await asyncio.gather(*stopped, return_exceptions=True)
+    # Closed sockets recorded their last-seen times; write them before exiting
+    await presence.flush_last_seen()
+    # Flush every queued message before the process exits
+    await db.stop_message_writer()
+    await tasks['writer']
+    await db.stop_event_writer()
+    await tasks['event_writer']
+    await broker.close()
+    db.close()
+
 async def main():
     try:
-        db.client.server_info()
+        await db.ping()
         logger.info("Successfully connected to MongoDB")
     except Exception as e:
         logger.error(f"Error connecting to MongoDB: {e}")
         return
 
+    tasks = await start_background_tasks()
+
     port = int(os.getenv("PORT", "8765"))
     host = "0.0.0.0"
 
-    app = web.Application()
-    app.router.add_get('/', health_handler)
-    app.router.add_get('/health', health_handler)
-    app.router.add_get('/ws', ws_handler)
-
-    runner = web.AppRunner(app)
+    runner = web.AppRunner(create_app())
     await runner.setup()
     site = web.TCPSite(runner, host, port)
     await site.start()
     logger.info(f"HTTP server started on http://{host}:{port} (WebSocket at /ws)")
-    while True:
-        await asyncio.sleep(3600)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            # Not available on Windows; Ctrl+C still cancels main() and runs the finally block
+            pass
+
+    try:
+        await stop.wait()
+    finally:
+        logger.info("Shutting down")
+        await runner.cleanup()
+        await stop_background_tasks(tasks)
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+import asyncio
+import bisect
+
+# Upper bounds in seconds, from sub-millisecond cache hits to slow model calls
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram:
+    """
+    Fixed-bucket histogram, laid out like a Prometheus histogram: observing
+    a value is one bisect and two additions.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """(upper bound, observations at or below it) pairs, ending with +Inf."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile, or None if
+        nothing was observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99)
+        }
+
+class LoopLagMonitor:
+    """
+    Measures event loop lag: how much later than scheduled a short sleep
+    wakes up. Sustained lag means something is blocking the loop.
+    """
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.histogram = Histogram()
+        self.last = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last = max(0.0, loop.time() - started - self.interval)
+            self.histogram.observe(self.last)
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape_label(value)}"' for name, value in labels.items()) + '}'
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(int(value))
+
+class PrometheusWriter:
+    """Builds a response in the Prometheus text exposition format."""
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.lines = []
+
+    def _header(self, name, kind, help_text):
+        self.lines.append(f"# HELP {name} {help_text}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name, kind, help_text, samples):
+        """
+        Add a counter or gauge. samples is a number, or a list of
+        (labels dict, number) pairs.
+        """
+        name = self.prefix + name
+        self._header(name, kind, help_text)
+        if not isinstance(samples, list):
+            samples = [({}, samples)]
+        for labels, value in samples:
+            self.lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+    def counter(self, name, help_text, samples):
+        self.sample(name, 'counter', help_text, samples)
+
+    def gauge(self, name, help_text, samples):
+        self.sample(name, 'gauge', help_text, samples)
+
+    def histogram(self, name, help_text, histograms, label=None):
+        """
+        Add histograms: a single Histogram, or a dict of them keyed by the
+        value of label.
+        """
+        name = self.prefix + name
+        self._header(name, 'histogram', help_text)
+        if isinstance(histograms, Histogram):
+            histograms = {None: histograms}
+        for key, histogram in sorted(histograms.items(), key=lambda item: str(item[0])):
+            labels = {label: key} if label else {}
+            for bound, total in histogram.cumulative():
+                bucket_labels = _format_labels({**labels, 'le': _format_value(bound)})
+                self.lines.append(f"{name}_bucket{bucket_labels} {total}")
+            self.lines.append(f"{name}_sum{_format_labels(labels)} {_format_value(histogram.sum)}")
+            self.lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+    def render(self):
+        return '\n'.join(self.lines) + '\n'
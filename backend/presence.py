@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+ONLINE = 'online'
+AWAY = 'away'
+OFFLINE = 'offline'
+
+# States a client may set for itself with a 'presence' frame
+CLIENT_STATUSES = {ONLINE, AWAY}
+
+class PresenceTracker:
+    """
+    Online/away/offline state of the users connected to this worker.
+
+    Changes are not sent as they happen. They collect until the next tick, and
+    then every online friend gets a single 'presence' frame listing all the
+    changes relevant to them. A reconnect storm of N users therefore costs at
+    most one frame per online recipient per tick, instead of one per
+    (user, friend) pair. A user's last-seen time is written to the database in
+    batches, not on every disconnect.
+
+    With several workers, each tracks only its own sockets. A user leaving
+    this worker is announced as offline only if online_elsewhere does not
+    report a socket on another worker. Away is still decided per worker.
+    """
+    def __init__(self, deliver, get_friends, save_last_seen, is_online=None,
+                 online_elsewhere=None, tick=1.0, away_after=300.0, persist_interval=60.0):
+        """
+        Args:
+            deliver: Coroutine deliver(username, frame) that sends a frame to a user
+            get_friends: Coroutine returning a user's friend list
+            save_last_seen: Coroutine persisting a {username: datetime} mapping
+            is_online: Whether a friend should get frames; defaults to users
+                this tracker knows to be online
+            online_elsewhere: Coroutine returning which of the given users
+                are connected to another worker; None if there is one worker
+            tick (float): Seconds between presence fan-outs
+            away_after (float): Seconds without activity before a user is away
+            persist_interval (float): Seconds between last-seen writes
+        """
+        self.deliver = deliver
+        self.get_friends = get_friends
+        self.save_last_seen = save_last_seen
+        self.is_online = is_online or (lambda username: username in self.status)
+        self.online_elsewhere = online_elsewhere
+        self.tick = tick
+        self.away_after = away_after
+        self.persist_interval = persist_interval
+
+        self.status = {}  # username -> ONLINE or AWAY, for connected users only
+        self.last_active = {}  # username -> monotonic time of the last frame
+        self._away_by_client = set()  # users who set themselves away; activity does not undo it
+        self._changed = {}  # username -> (status, last_seen) awaiting the next fan-out
+        self._last_seen = {}  # username -> datetime awaiting persistence
+        self.stats = {'changes': 0, 'fanouts': 0, 'frames': 0, 'updates': 0}
+
+    def get(self, username):
+        return self.status.get(username, OFFLINE)
+
+    def connected(self, username):
+        """The user's first socket on this worker registered."""
+        self.last_active[username] = time.monotonic()
+        self._away_by_client.discard(username)
+        self._set(username, ONLINE)
+
+    def disconnected(self, username):
+        """The user's last socket on this worker closed."""
+        self.last_active.pop(username, None)
+        self._away_by_client.discard(username)
+        now = datetime.utcnow()
+        self._last_seen[username] = now
+        self._set(username, OFFLINE, now)
+
+    def touch(self, username):
+        """
+        Record activity from a connected user. Called for every frame, so it
+        only updates a timestamp unless the user comes back from idle.
+        """
+        if username not in self.status:
+            return
+        self.last_active[username] = time.monotonic()
+        if self.status[username] == AWAY and username not in self._away_by_client:
+            self._set(username, ONLINE)
+
+    def set_client_status(self, username, status):
+        """Apply a status the client chose, e.g. away when its window is hidden."""
+        if username not in self.status or status not in CLIENT_STATUSES:
+            return
+        self.last_active[username] = time.monotonic()
+        if status == AWAY:
+            self._away_by_client.add(username)
+        else:
+            self._away_by_client.discard(username)
+        self._set(username, status)
+
+    def _set(self, username, status, last_seen=None):
+        if status == OFFLINE:
+            if self.status.pop(username, None) is None:
+                return
+        elif self.status.get(username) == status:
+            return
+        else:
+            self.status[username] = status
+        self._changed[username] = (status, last_seen)
+        self.stats['changes'] += 1
+
+    def _mark_idle_users_away(self):
+        cutoff = time.monotonic() - self.away_after
+        for username, last_active in self.last_active.items():
+            if last_active < cutoff and self.status.get(username) == ONLINE:
+                self._set(username, AWAY)
+
+    async def fan_out(self):
+        """
+        Send the changes collected since the last tick: one frame per online
+        friend, listing every change that friend should see.
+        """
+        changed, self._changed = self._changed, {}
+        left = [username for username, (status, _) in changed.items() if status == OFFLINE]
+        if left and self.online_elsewhere is not None:
+            try:
+                # Still connected to another worker, whose tracker speaks for them
+                for username in await self.online_elsewhere(left):
+                    changed.pop(username, None)
+            except Exception as e:
+                logger.error(f"Error checking presence on other workers: {e}")
+        if not changed:
+            return 0
+
+        usernames = list(changed)
+        friend_lists = await asyncio.gather(
+            *(self.get_friends(username) for username in usernames),
+            return_exceptions=True
+        )
+        updates = defaultdict(list)
+        for username, friends in zip(usernames, friend_lists):
+            if isinstance(friends, Exception):
+                logger.error(f"Error loading friends for presence of {username}: {friends}")
+                continue
+            status, last_seen = changed[username]
+            update = {'username': username, 'status': status}
+            if last_seen is not None:
+                update['last_seen'] = last_seen.isoformat()
+            for friend in friends:
+                if self.is_online(friend):
+                    updates[friend].append(update)
+
+        await asyncio.gather(*(
+            self.deliver(recipient, {'type': 'presence', 'updates': recipient_updates})
+            for recipient, recipient_updates in updates.items()
+        ))
+        self.stats['fanouts'] += 1
+        self.stats['frames'] += len(updates)
+        self.stats['updates'] += sum(len(recipient_updates) for recipient_updates in updates.values())
+        return len(updates)
+
+    async def flush_last_seen(self):
+        """Persist the last-seen times collected since the previous flush."""
+        pending, self._last_seen = self._last_seen, {}
+        if not pending:
+            return
+        try:
+            await self.save_last_seen(pending)
+        except Exception as e:
+            logger.error(f"Error saving last-seen times: {e}")
+            # Keep them for the next flush unless a newer time arrived meanwhile
+            for username, seen in pending.items():
+                self._last_seen.setdefault(username, seen)
+
+    async def run(self):
+        """Tick forever: mark idle users away, fan out changes, persist last-seen."""
+        next_persist = time.monotonic() + self.persist_interval
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self._mark_idle_users_away()
+                await self.fan_out()
+                if time.monotonic() >= next_persist:
+                    next_persist = time.monotonic() + self.persist_interval
+                    await self.flush_last_seen()
+            except Exception as e:
+                logger.error(f"Error in presence tick: {e}")
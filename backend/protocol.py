@@ -0,0 +1,62 @@
+import json
+
+try:
+    import msgpack
+except ImportError:  # Binary frames are only offered when msgpack is installed
+    msgpack = None
+
+JSON = 'json'
+MSGPACK = 'msgpack'
+
+# WebSocket subprotocols the server accepts, in order of preference
+SUPPORTED_PROTOCOLS = (MSGPACK, JSON) if msgpack else (JSON,)
+
+class FrameDecodeError(ValueError):
+    """Raised when an incoming frame cannot be decoded."""
+
+def encode(message, protocol=JSON):
+    """
+    Serialize an outgoing frame: a str for JSON, bytes for MessagePack.
+    """
+    if protocol == MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message)
+
+def decode(data, protocol=JSON):
+    """
+    Parse an incoming frame into a dict.
+    Raises FrameDecodeError for malformed payloads.
+    """
+    try:
+        if protocol == MSGPACK:
+            if msgpack is None:
+                raise FrameDecodeError("Binary frames are not supported")
+            message = msgpack.unpackb(data, raw=False)
+        else:
+            message = json.loads(data)
+    except FrameDecodeError:
+        raise
+    except Exception as e:
+        raise FrameDecodeError(str(e)) from e
+    if not isinstance(message, dict):
+        raise FrameDecodeError("Frame must be an object")
+    return message
+
+def columnar_history(messages, user1, user2):
+    """
+    Lay out chat history column by column for binary clients.
+
+    Each field becomes one array instead of repeating keys per message, and
+    sender is an index into participants; the recipient is the other participant.
+    """
+    participants = [user1, user2]
+    return {
+        'participants': participants,
+        '_id': [msg['_id'] for msg in messages],
+        'from': [0 if msg['from'] == user1 else 1 for msg in messages],
+        'content': [msg['content'] for msg in messages],
+        'timestamp': [msg['timestamp'] for msg in messages],
+        'read': [msg['read'] for msg in messages],
+        'readAt': [msg['readAt'] for msg in messages],
+        'reactions': [msg['reactions'] for msg in messages]
+    }
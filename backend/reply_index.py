@@ -0,0 +1,213 @@
+"""
+Local smart-reply suggester.
+
+An offline step mines (message -> reply) pairs from the messages collection
+into a SQLite file: each distinct normalized message keeps its most frequent
+replies, plus a TF-IDF inverted index over its tokens. The corpus is every
+user's private messages, so a reply is only kept once enough different
+people have sent it. At runtime the file is
+opened read-only and memory-mapped, and common exchanges are answered in well
+under a millisecond without calling the model.
+
+Build the index with:
+
+    python reply_index.py --out reply_index.db
+"""
+import argparse
+import logging
+import math
+import os
+import re
+import sqlite3
+from collections import Counter, defaultdict
+
+logger = logging.getLogger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9']+")
+MAX_PROMPT_TOKENS = 12
+MAX_REPLY_LENGTH = 50  # Same limit the model suggestions are held to
+QUERY_TOKENS = 4  # Only the rarest query tokens are looked up, to keep posting scans short
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(str(text).lower())[:MAX_PROMPT_TOKENS]
+
+def normalize(text):
+    return ' '.join(tokenize(text))
+
+def mine_reply_pairs(collection):
+    """
+    Yield (message, reply, replier) triples: consecutive messages in a
+    conversation where the second comes from the other participant, who is
+    the replier. Expects the conversation_id backfill to be complete.
+    """
+    # The exact reverse of the (conversation_id 1, timestamp -1, _id -1) index,
+    # so Mongo walks it backwards instead of sorting the whole collection
+    cursor = collection.find(
+        {'conversation_id': {'$exists': True}},
+        {'conversation_id': 1, 'from': 1, 'content': 1}
+    ).sort([('conversation_id', -1), ('timestamp', 1), ('_id', 1)])
+
+    previous = None
+    for message in cursor:
+        if (previous is not None
+                and previous['conversation_id'] == message['conversation_id']
+                and previous['from'] != message['from']):
+            yield previous.get('content', ''), message.get('content', ''), message['from']
+        previous = message
+
+def build_reply_index(pairs, path, min_support=3, min_reply_support=3, min_repliers=3, replies_per_prompt=3):
+    """
+    Write a reply index for the given (message, reply, replier) triples to path.
+
+    A reply to a message is kept only if it was seen at least
+    min_reply_support times, from at least min_repliers different senders,
+    so nobody's one-off private reply is offered to other users. Messages
+    are kept if their kept replies add up to min_support. The file is
+    written next to path and renamed into place, so readers never see a
+    partial index.
+    """
+    replies = defaultdict(Counter)
+    repliers = defaultdict(lambda: defaultdict(set))  # key -> reply -> senders, up to min_repliers
+    for prompt, reply, replier in pairs:
+        key = normalize(prompt)
+        reply = str(reply).strip()
+        if key and reply and len(reply) <= MAX_REPLY_LENGTH:
+            replies[key][reply] += 1
+            senders = repliers[key][reply]
+            if len(senders) < min_repliers:
+                senders.add(replier)
+
+    prompts = {}
+    for key, counts in replies.items():
+        supported = Counter({
+            reply: count for reply, count in counts.items()
+            if count >= min_reply_support and len(repliers[key][reply]) >= min_repliers
+        })
+        if supported and sum(supported.values()) >= min_support:
+            prompts[key] = supported
+    document_frequency = Counter(token for key in prompts for token in set(key.split()))
+    idf = {
+        token: math.log((1 + len(prompts)) / (1 + frequency)) + 1
+        for token, frequency in document_frequency.items()
+    }
+
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript("""
+            CREATE TABLE prompts (id INTEGER PRIMARY KEY, key TEXT UNIQUE, total INTEGER, norm REAL);
+            CREATE TABLE replies (prompt_id INTEGER, rank INTEGER, reply TEXT, count INTEGER);
+            CREATE TABLE tokens (token TEXT PRIMARY KEY, idf REAL);
+            CREATE TABLE postings (token TEXT, prompt_id INTEGER, weight REAL);
+        """)
+        conn.executemany("INSERT INTO tokens VALUES (?, ?)", idf.items())
+        for prompt_id, (key, counts) in enumerate(prompts.items()):
+            term_frequency = Counter(key.split())
+            weights = {token: count * idf[token] for token, count in term_frequency.items()}
+            norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+            conn.execute("INSERT INTO prompts VALUES (?, ?, ?, ?)", (prompt_id, key, sum(counts.values()), norm))
+            conn.executemany(
+                "INSERT INTO replies VALUES (?, ?, ?, ?)",
+                [(prompt_id, rank, reply, count)
+                 for rank, (reply, count) in enumerate(counts.most_common(replies_per_prompt))]
+            )
+            conn.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                [(token, prompt_id, weight) for token, weight in weights.items()]
+            )
+        conn.executescript("""
+            CREATE INDEX postings_token ON postings (token, prompt_id, weight);
+            CREATE INDEX replies_prompt ON replies (prompt_id, rank);
+        """)
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    logger.info(f"Reply index written to {path} ({len(prompts)} messages)")
+    return len(prompts)
+
+class LocalReplySuggester:
+    """
+    Read-only, memory-mapped view of a reply index built by build_reply_index.
+    """
+    def __init__(self, path, min_similarity=0.8, mmap_bytes=256 * 1024 * 1024):
+        self.path = path
+        self.min_similarity = min_similarity
+        self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        self.conn.execute(f"PRAGMA mmap_size = {int(mmap_bytes)}")
+
+    def suggest(self, message, num_suggestions=2):
+        """
+        Suggest replies to a message from past conversations.
+
+        Returns:
+            tuple: (suggestions, confidence), where confidence is the cosine
+            similarity of the matched message, or ([], 0.0) without a match
+        """
+        key = normalize(message)
+        if not key:
+            return [], 0.0
+
+        row = self.conn.execute("SELECT id FROM prompts WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return self._replies(row[0], num_suggestions), 1.0
+
+        tokens = set(key.split())
+        placeholders = ','.join('?' * len(tokens))
+        idf = dict(self.conn.execute(
+            f"SELECT token, idf FROM tokens WHERE token IN ({placeholders})", tuple(tokens)
+        ).fetchall())
+        if not idf:
+            return [], 0.0
+        # Tokens missing from the index still count towards the query's norm
+        max_idf = max(idf.values())
+        query_norm = math.sqrt(sum(idf.get(token, max_idf) ** 2 for token in tokens))
+        rarest = sorted(idf, key=idf.get, reverse=True)[:QUERY_TOKENS]
+        placeholders = ','.join('?' * len(rarest))
+        best = self.conn.execute(
+            f"""SELECT p.prompt_id, SUM(p.weight * t.idf) / (pr.norm * ?) AS similarity
+                FROM postings p
+                JOIN tokens t ON t.token = p.token
+                JOIN prompts pr ON pr.id = p.prompt_id
+                WHERE p.token IN ({placeholders})
+                GROUP BY p.prompt_id
+                ORDER BY similarity DESC
+                LIMIT 1""",
+            (query_norm, *rarest)
+        ).fetchone()
+        if best is None or best[1] < self.min_similarity:
+            return [], best[1] if best else 0.0
+        return self._replies(best[0], num_suggestions), best[1]
+
+    def _replies(self, prompt_id, num_suggestions):
+        rows = self.conn.execute(
+            "SELECT reply FROM replies WHERE prompt_id = ? ORDER BY rank LIMIT ?",
+            (prompt_id, num_suggestions)
+        ).fetchall()
+        return [reply for (reply,) in rows]
+
+    def close(self):
+        self.conn.close()
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+    from pymongo import MongoClient
+    import certifi
+
+    parser = argparse.ArgumentParser(description="Build the local smart-reply index from chat history")
+    parser.add_argument('--out', default=os.getenv('REPLY_INDEX_PATH', 'reply_index.db'))
+    parser.add_argument('--min-support', type=int, default=3)
+    parser.add_argument('--min-reply-support', type=int, default=3, help='times a reply must have been sent')
+    parser.add_argument('--min-repliers', type=int, default=3, help='different senders a reply must come from')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    load_dotenv(override=True)
+    client = MongoClient(os.getenv('MONGODB_URI'), tlsCAFile=certifi.where())
+    messages = client[os.getenv('MONGODB_DB', 'messenger_app')]['messages']
+    build_reply_index(
+        mine_reply_pairs(messages), args.out, min_support=args.min_support,
+        min_reply_support=args.min_reply_support, min_repliers=args.min_repliers
+    )
@@ -0,0 +1,168 @@
+import asyncio
+import logging
+import time
+from collections import Counter, defaultdict
+from metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+class FrameValidationError(ValueError):
+    """Raised when an incoming frame does not match its type's schema."""
+
+def compile_schema(schema):
+    """
+    Turn a {field: type or tuple of types} schema into a validator function.
+    Fields whose name ends in '?' are optional; None counts as absent.
+    """
+    fields = []
+    for name, types in schema.items():
+        required = not name.endswith('?')
+        types = types if isinstance(types, tuple) else (types,)
+        expected = ' or '.join(t.__name__ for t in types)
+        fields.append((name.rstrip('?'), types, required, expected))
+
+    def validate(data):
+        for name, types, required, expected in fields:
+            value = data.get(name)
+            if value is None:
+                if required:
+                    raise FrameValidationError(f"missing '{name}'")
+            elif not isinstance(value, types):
+                raise FrameValidationError(f"'{name}' must be {expected}")
+    return validate
+
+class Route:
+    def __init__(self, handler, validate, inline, lane):
+        self.handler = handler
+        self.validate = validate
+        self.inline = inline
+        self.lane = lane
+
+class FrameRouter:
+    """
+    Table of WebSocket frame handlers keyed by frame type.
+
+    Each frame is checked against its type's schema before its handler runs.
+    Handlers run as separate tasks, up to a per-connection limit, so one slow
+    request does not hold up the rest of a client's frames. Some handlers
+    must keep their order: inline ones run before the next frame is read,
+    and handlers that share a lane run one at a time, in arrival order.
+    Frames waiting for their lane do not take a handler slot, so a busy lane
+    only holds up its own frames, up to max_lane_backlog of them.
+    """
+    def __init__(self, max_concurrency=8, max_lane_backlog=32):
+        self.max_concurrency = max_concurrency
+        self.max_lane_backlog = max_lane_backlog
+        self.routes = {}
+        self.latency = defaultdict(Histogram)  # frame type -> handler latency in seconds
+        self.stats = {'frames': 0, 'invalid': 0, 'failed': 0}
+        self.frames_in = Counter()  # frame type -> frames received, valid or not
+
+    def route(self, frame_type, schema=None, inline=False, lane=None):
+        """
+        Decorator registering handler(session, data) for a frame type.
+
+        Args:
+            schema (dict): Field types, see compile_schema
+            inline (bool): Run before reading the next frame
+            lane: Function of the frame returning a key; frames with the same
+                key are handled one at a time, in arrival order
+        """
+        validate = compile_schema(schema or {})
+        def register(handler):
+            self.routes[frame_type] = Route(handler, validate, inline, lane)
+            return handler
+        return register
+
+    def session(self, connection):
+        return RouterSession(self, connection)
+
+class RouterSession:
+    """Dispatch state for one connection."""
+    def __init__(self, router, connection):
+        self.router = router
+        self.connection = connection
+        self.username = None  # set once the client registers
+        self._slots = asyncio.Semaphore(router.max_concurrency)
+        self._lanes = {}  # lane key -> (lock, semaphore bounding its queued frames)
+        self._tasks = set()
+
+    async def dispatch(self, data):
+        """
+        Validate a decoded frame and run its handler. Invalid frames are
+        answered with an error frame and never end the connection.
+        """
+        router = self.router
+        router.stats['frames'] += 1
+        frame_type = data.get('type')
+        route = router.routes.get(frame_type) if isinstance(frame_type, str) else None
+        # Unknown types share one label so clients cannot grow the counter without bound
+        router.frames_in[frame_type if route is not None else 'unknown'] += 1
+        if route is None:
+            router.stats['invalid'] += 1
+            self.connection.send({'type': 'error', 'message': f"Unknown frame type: {frame_type}"})
+            return
+        try:
+            route.validate(data)
+        except FrameValidationError as e:
+            router.stats['invalid'] += 1
+            self.connection.send({'type': 'error', 'message': f"Invalid {frame_type} frame: {e}"})
+            return
+
+        if route.inline:
+            await self._run(frame_type, route, data)
+            return
+        # Waiting for a slot or for room in a full lane stops reading from
+        # the socket, which pushes back on the client
+        if route.lane is None:
+            await self._slots.acquire()
+            task = asyncio.create_task(self._run_task(frame_type, route, data))
+        else:
+            key = (frame_type, route.lane(data))
+            lane = self._lanes.get(key)
+            if lane is None:
+                lane = self._lanes[key] = (asyncio.Lock(), asyncio.Semaphore(router.max_lane_backlog))
+            await lane[1].acquire()
+            task = asyncio.create_task(self._run_lane_task(frame_type, route, data, lane))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def close(self):
+        """
+        Cancel the handlers still running or queued for this connection and
+        wait for them to finish unwinding.
+        """
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run_task(self, frame_type, route, data):
+        try:
+            await self._run(frame_type, route, data)
+        finally:
+            self._slots.release()
+
+    async def _run_lane_task(self, frame_type, route, data, lane):
+        lock, room = lane
+        try:
+            # Lock waiters are woken in order, and tasks start in creation order.
+            # The slot is taken only once it is this frame's turn in the lane.
+            async with lock:
+                async with self._slots:
+                    await self._run(frame_type, route, data)
+        finally:
+            room.release()
+
+    async def _run(self, frame_type, route, data):
+        started = time.perf_counter()
+        try:
+            await route.handler(self, data)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.router.stats['failed'] += 1
+            logger.error(f"Error handling {frame_type} frame: {e}")
+            self.connection.send({'type': 'error', 'message': f"Failed to handle {frame_type}"})
+        finally:
+            self.router.latency[frame_type].observe(time.perf_counter() - started)
@@ -0,0 +1,38 @@
+import pytest
+
+from benchmarks.common import patch_mongomock
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class RecordingModel:
+    """Stub model that answers with fixed text and records every prompt it is sent."""
+    def __init__(self, text='A summary.'):
+        self.text = text
+        self.prompts = []
+
+    def generate_content(self, prompt, stream=False):
+        self.prompts.append(prompt)
+        return FakeResponse(self.text)
+
+@pytest.fixture
+def recording_model():
+    return RecordingModel()
+
+@pytest.fixture(scope='session')
+def app():
+    """main.py, imported against an in-memory mongomock database and without .env."""
+    mongomock = pytest.importorskip('mongomock')
+    import dotenv
+    import database
+
+    patch_mongomock()
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv('MONGODB_URI', 'mongodb://localhost')
+        patch.setenv('MONGODB_DB', 'messenger_test')
+        patch.delenv('BROKER_URL', raising=False)
+        patch.setattr(dotenv, 'load_dotenv', lambda *args, **kwargs: False)
+        patch.setattr(database, 'MongoClient', mongomock.MongoClient)
+        import main
+    return main
@@ -0,0 +1,305 @@
+import asyncio
+import time
+
+import pytest
+
+from ai_assistant import (
+    AIAssistant, CircuitOpenError, FALLBACK_RESPONSE, FALLBACK_SMART_REPLIES, ModelGateway,
+    PRIORITY_BACKGROUND, PRIORITY_CHAT, PRIORITY_SMART_REPLY
+)
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+class FakeStreamingModel:
+    """
+    Yields the given chunks with a delay before each, like a streaming model
+    call. An Exception in chunks is raised at that point instead.
+    """
+    def __init__(self, chunks, delay=0.0):
+        self.chunks = chunks
+        self.delay = delay
+
+    def generate_content(self, prompt, stream=False):
+        assert stream
+        for chunk in self.chunks:
+            time.sleep(self.delay)
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield FakeChunk(chunk)
+
+def collect(assistant, message='hi'):
+    async def run():
+        return [chunk async for chunk in assistant.stream_response(message, user='alice')]
+    return asyncio.run(run())
+
+def test_stream_response_yields_chunks_in_order():
+    assistant = AIAssistant(None, model=FakeStreamingModel(['Hello', ', ', 'world', '!'], delay=0.01))
+
+    assert collect(assistant) == ['Hello', ', ', 'world', '!']
+    assert assistant.fallback_stats['chat'] == 0
+
+def test_stream_response_falls_back_when_the_first_chunk_fails():
+    assistant = AIAssistant(None, model=FakeStreamingModel([RuntimeError('model down')]))
+
+    assert collect(assistant) == [FALLBACK_RESPONSE]
+    assert assistant.fallback_stats['chat'] == 1
+    assert assistant.time_to_first_token.count == 0
+
+def test_stream_response_keeps_partial_output_when_a_later_chunk_fails():
+    assistant = AIAssistant(None, model=FakeStreamingModel(['Hello', RuntimeError('stream cut')]))
+
+    assert collect(assistant) == ['Hello']
+    assert assistant.fallback_stats['chat'] == 0
+
+def test_stream_response_falls_back_on_timeout():
+    gateway = ModelGateway(call_timeout=0.05)
+    assistant = AIAssistant(None, gateway=gateway, model=FakeStreamingModel(['late'], delay=0.2))
+
+    assert collect(assistant) == [FALLBACK_RESPONSE]
+    assert gateway.stats['timeouts'] == 1
+
+def test_time_to_first_token_is_measured_before_the_stream_ends():
+    assistant = AIAssistant(None, model=FakeStreamingModel(['a', 'b', 'c', 'd'], delay=0.05))
+
+    started = time.perf_counter()
+    collect(assistant)
+    total = time.perf_counter() - started
+
+    histogram = assistant.time_to_first_token
+    assert histogram.count == 1
+    assert 0.05 <= histogram.sum < total - 0.1
+
+def test_stream_response_does_not_block_the_event_loop():
+    assistant = AIAssistant(None, model=FakeStreamingModel(['a', 'b'], delay=0.1))
+
+    async def run():
+        ticks = 0
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+        task = asyncio.create_task(ticker())
+        chunks = [chunk async for chunk in assistant.stream_response('hi')]
+        task.cancel()
+        return chunks, ticks
+
+    chunks, ticks = asyncio.run(run())
+    assert chunks == ['a', 'b']
+    # The loop kept running while the model blocked its worker thread for 0.2s
+    assert ticks >= 10
+
+def turns(count, words=40):
+    return [
+        {'from': 'AI Assistant' if index % 2 else 'alice', 'content': f'turn {index} ' + 'word ' * words}
+        for index in range(count)
+    ]
+
+def test_build_prompt_without_history_is_the_message():
+    assistant = AIAssistant(None, model=object())
+
+    assert assistant.build_prompt('hello', []) == 'hello'
+
+def test_build_prompt_stays_within_the_token_budget(recording_model):
+    assistant = AIAssistant(None, model=recording_model)
+
+    # Prompt size must not grow with the length of the history
+    for count in (5, 50, 500):
+        prompt = assistant.build_prompt('What next?', turns(count), summary='We talked.', token_budget=500)
+        asyncio.run(assistant.get_response(prompt))
+
+    sizes = [assistant.estimate_tokens(prompt) for prompt in recording_model.prompts]
+    assert all(size <= 500 for size in sizes)
+    # Same number of turns kept; only the digits in 'turn N' differ
+    assert abs(sizes[1] - sizes[2]) <= 5
+
+def test_build_prompt_keeps_the_most_recent_turns():
+    assistant = AIAssistant(None, model=object())
+    history = turns(50)
+
+    prompt = assistant.build_prompt('What next?', history, token_budget=300)
+
+    assert 'turn 49 ' in prompt
+    assert 'turn 0 ' not in prompt
+    assert prompt.endswith('User: What next?\nAssistant:')
+    # Kept turns stay in conversation order
+    assert prompt.index('turn 48 ') < prompt.index('turn 49 ')
+
+def test_build_prompt_caps_the_summary_at_half_the_remaining_budget():
+    assistant = AIAssistant(None, model=object())
+
+    prompt = assistant.build_prompt('What next?', turns(50), summary='x' * 100000, token_budget=400)
+
+    summary_line = next(line for line in prompt.split('\n\n') if line.startswith('Summary'))
+    assert assistant.estimate_tokens(summary_line) <= 200
+    assert assistant.estimate_tokens(prompt) <= 400
+    # Recent turns still get their share
+    assert 'turn 49 ' in prompt
+
+class JsonRepliesModel:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, prompt, stream=False):
+        self.calls += 1
+        return FakeChunk('["Sure", "Later"]')
+
+def test_smart_reply_conversation_keys_stay_bounded():
+    model = JsonRepliesModel()
+    assistant = AIAssistant(None, smart_reply_cache_size=8, model=model)
+
+    async def run():
+        for index in range(100):
+            context = {'messages': [{'content': f'message {index}'}]}
+            await assistant.generate_smart_replies(context, conversation=f'conversation {index % 20}')
+    asyncio.run(run())
+
+    assert len(assistant._smart_reply_keys) <= 8
+    # Every cached suggestion can still be invalidated through its conversation
+    tracked = set().union(*assistant._smart_reply_keys.values())
+    assert set(assistant.smart_reply_cache) <= tracked
+
+class SlowRepliesModel(JsonRepliesModel):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def generate_content(self, prompt, stream=False):
+        time.sleep(self.delay)
+        return super().generate_content(prompt, stream)
+
+def test_cancelled_smart_reply_call_is_taken_over_by_a_waiting_caller():
+    model = SlowRepliesModel(0.1)
+    assistant = AIAssistant(None, model=model)
+    context = {'messages': [{'content': 'Lunch tomorrow?'}]}
+
+    async def run():
+        precompute = asyncio.create_task(assistant.generate_smart_replies(context, conversation='c'))
+        await asyncio.sleep(0.02)
+        on_demand = asyncio.create_task(assistant.generate_smart_replies(context, conversation='c'))
+        await asyncio.sleep(0.02)
+        awaited = assistant.smart_replies_awaited('c')
+        precompute.cancel()
+        return awaited, await on_demand
+
+    awaited, suggestions = asyncio.run(run())
+    assert awaited
+    assert suggestions == ['Sure', 'Later']
+    assert model.calls == 2
+
+def test_waiting_callers_share_a_successful_smart_reply_call():
+    model = SlowRepliesModel(0.05)
+    assistant = AIAssistant(None, model=model)
+    context = {'messages': [{'content': 'Lunch tomorrow?'}]}
+
+    async def run():
+        return await asyncio.gather(*(assistant.generate_smart_replies(context) for _ in range(3)))
+
+    assert asyncio.run(run()) == [['Sure', 'Later']] * 3
+    assert model.calls == 1
+    assert assistant.smart_reply_stats['shared'] == 2
+    assert not assistant.smart_replies_awaited(None)
+
+def test_gateway_hands_free_slots_to_chat_calls_before_smart_replies():
+    gateway = ModelGateway(max_concurrency=1)
+    order = []
+
+    async def run():
+        release = asyncio.Event()
+        async def hold_slot():
+            async with gateway.admit(PRIORITY_BACKGROUND):
+                await release.wait()
+        holder = asyncio.create_task(hold_slot())
+        await asyncio.sleep(0)
+        # The smart reply call queues first, yet the chat call gets the slot first
+        calls = [
+            asyncio.create_task(gateway.call(order.append, 'smart_replies', priority=PRIORITY_SMART_REPLY)),
+            asyncio.create_task(gateway.call(order.append, 'chat', priority=PRIORITY_CHAT)),
+        ]
+        await asyncio.sleep(0.05)
+        assert gateway.snapshot()['queued'] == 2
+        release.set()
+        await asyncio.gather(holder, *calls)
+
+    asyncio.run(run())
+    assert order == ['chat', 'smart_replies']
+    assert gateway.queue_wait.count == 3
+    assert gateway.queue_wait.sum >= 0.05
+
+def test_gateway_rate_limits_each_user(recording_model):
+    gateway = ModelGateway(rate_limit=2, rate_window=60)
+    assistant = AIAssistant(None, gateway=gateway, model=recording_model)
+
+    async def run():
+        return [await assistant.get_response(f'question {index}', user='alice') for index in range(3)] + [
+            await assistant.get_response('question', user='bob')
+        ]
+
+    answers = asyncio.run(run())
+    assert answers == ['A summary.', 'A summary.', FALLBACK_RESPONSE, 'A summary.']
+    assert len(recording_model.prompts) == 3
+    assert gateway.stats['rate_limited'] == 1
+    assert assistant.fallback_stats['chat'] == 1
+
+def fail():
+    raise RuntimeError('model down')
+
+def succeed():
+    return 'ok'
+
+def test_breaker_opens_probes_with_one_trial_and_closes():
+    gateway = ModelGateway(failure_threshold=2, reset_timeout=0.05)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await gateway.call(fail)
+        assert gateway.breaker_state == 'open'
+        with pytest.raises(CircuitOpenError):
+            await gateway.call(succeed)
+
+        # A failed trial call opens the breaker again for a full reset_timeout
+        await asyncio.sleep(0.06)
+        with pytest.raises(RuntimeError):
+            await gateway.call(fail)
+        assert gateway.breaker_state == 'open'
+        with pytest.raises(CircuitOpenError):
+            await gateway.call(succeed)
+
+        # Only one trial runs while half open; its success closes the breaker
+        await asyncio.sleep(0.06)
+        trial = asyncio.create_task(gateway.call(time.sleep, 0.05))
+        await asyncio.sleep(0.01)
+        assert gateway.breaker_state == 'half_open'
+        with pytest.raises(CircuitOpenError):
+            await gateway.call(succeed)
+        await trial
+        assert gateway.breaker_state == 'closed'
+        assert await gateway.call(succeed) == 'ok'
+
+    asyncio.run(run())
+    assert gateway.stats['rejected_open'] == 3
+    assert gateway.stats['failures'] == 3
+
+def test_open_breaker_falls_back_without_calling_the_model(recording_model):
+    gateway = ModelGateway(failure_threshold=1, reset_timeout=60)
+    assistant = AIAssistant(None, gateway=gateway, model=FakeStreamingModel([RuntimeError('model down')]))
+
+    assert collect(assistant) == [FALLBACK_RESPONSE]
+    assert gateway.breaker_state == 'open'
+    assistant.model = recording_model
+
+    async def run():
+        started = time.perf_counter()
+        answer = await assistant.get_response('hi', user='alice')
+        suggestions = await assistant.generate_smart_replies({'messages': [{'content': 'Lunch?'}]})
+        return answer, suggestions, time.perf_counter() - started
+
+    answer, suggestions, elapsed = asyncio.run(run())
+    assert answer == FALLBACK_RESPONSE
+    assert suggestions == FALLBACK_SMART_REPLIES
+    assert recording_model.prompts == []
+    assert elapsed < 0.05
+    assert gateway.stats['rejected_open'] == 2
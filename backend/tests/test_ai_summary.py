@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+AI = "AI Assistant"
+
+@pytest.fixture
+def summary_app(app, recording_model, monkeypatch):
+    monkeypatch.setattr(app.ai_assistant, 'model', recording_model)
+    monkeypatch.setattr(app, 'AI_SUMMARY_MIN_TURNS', 4)
+    for collection in (app.db.ai_messages, app.db.ai_summaries):
+        collection.delete_many({})
+    return app
+
+def add_turns(app, username, count, start=0):
+    docs = []
+    for index in range(start, start + count):
+        sender, recipient = (username, AI) if index % 2 == 0 else (AI, username)
+        doc = app.db._new_message_doc(sender, recipient, f'turn {index}')
+        doc['timestamp'] = f'2026-01-01T00:00:{index:02d}'
+        docs.append(doc)
+    app.db.ai_messages.insert_many(docs)
+
+def test_refresh_waits_for_enough_turns(summary_app, recording_model):
+    add_turns(summary_app, 'alice', 3)
+
+    asyncio.run(summary_app.refresh_ai_summary('alice', None))
+
+    assert recording_model.prompts == []
+    assert summary_app.db.ai_summaries.find_one({'_id': 'alice'}) is None
+
+def test_refresh_summarizes_older_turns_and_records_the_cursor(summary_app, recording_model):
+    add_turns(summary_app, 'alice', 6)
+    # Turns from this one on are still in the context window
+    newest = summary_app.db.ai_messages.find_one({'content': 'turn 5'})
+    before = summary_app.db.encode_history_cursor(newest)
+
+    asyncio.run(summary_app.refresh_ai_summary('alice', before))
+
+    assert len(recording_model.prompts) == 1
+    prompt = recording_model.prompts[0]
+    assert 'turn 0' in prompt and 'turn 4' in prompt and 'turn 5' not in prompt
+    state = summary_app.db.ai_summaries.find_one({'_id': 'alice'})
+    assert state['summary'] == 'A summary.'
+    assert state['through'].startswith('2026-01-01T00:00:04|')
+
+def test_refresh_only_sends_turns_after_the_previous_summary(summary_app, recording_model):
+    add_turns(summary_app, 'alice', 5)
+    asyncio.run(summary_app.refresh_ai_summary('alice', None))
+    add_turns(summary_app, 'alice', 5, start=5)
+
+    asyncio.run(summary_app.refresh_ai_summary('alice', None))
+
+    assert len(recording_model.prompts) == 2
+    second = recording_model.prompts[1]
+    assert 'Current summary: A summary.' in second
+    assert 'turn 4' not in second and 'turn 5' in second and 'turn 9' in second
+    # The prompt carries the new turns only, not the whole history
+    assert len(second) < len(recording_model.prompts[0]) * 2
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+@pytest.fixture
+def db(app):
+    app.db.events.delete_many({})
+    app.db.event_counters.delete_many({})
+    return app.db
+
+def log(db, username, seqs, latest):
+    db.events.insert_many([{'user': username, 'seq': seq, 'event': {'n': seq}} for seq in seqs])
+    db.event_counters.insert_one({'_id': username, 'seq': latest})
+
+def test_contiguous_events_are_returned_in_pages(db):
+    log(db, 'alice', range(1, 6), 5)
+
+    page = asyncio.run(db.get_events_since('alice', 1, limit=3))
+
+    assert page == {'events': [{'n': 2}, {'n': 3}, {'n': 4}], 'seq': 4, 'has_more': True, 'reset': False}
+
+def test_hole_after_the_first_event_resets_the_client(db):
+    # Events 3 and 4 were reserved by a batch that failed to write
+    log(db, 'alice', [1, 2, 5, 6], 6)
+
+    page = asyncio.run(db.get_events_since('alice', 0))
+
+    assert page == {'events': [], 'seq': 6, 'has_more': False, 'reset': True}
+
+def test_hole_at_the_start_resets_the_client(db):
+    log(db, 'alice', [3, 4], 4)
+
+    assert asyncio.run(db.get_events_since('alice', 1))['reset']
+
+def test_caught_up_client_gets_no_events(db):
+    log(db, 'alice', [1, 2], 2)
+
+    assert asyncio.run(db.get_events_since('alice', 2)) == {'events': [], 'seq': 2, 'has_more': False, 'reset': False}
@@ -0,0 +1,55 @@
+import asyncio
+
+from presence import PresenceTracker, ONLINE, OFFLINE
+
+def tracker(online_elsewhere=None):
+    frames = []
+    async def deliver(username, frame):
+        frames.append((username, frame))
+    async def get_friends(username):
+        return ['carol']
+    async def save_last_seen(last_seen):
+        pass
+    presence = PresenceTracker(deliver, get_friends, save_last_seen, is_online=lambda username: True,
+                               online_elsewhere=online_elsewhere)
+    return presence, frames
+
+def test_leaving_the_last_worker_is_announced_as_offline():
+    async def nowhere(usernames):
+        return set()
+    presence, frames = tracker(nowhere)
+    presence.connected('alice')
+    asyncio.run(presence.fan_out())
+    presence.disconnected('alice')
+    asyncio.run(presence.fan_out())
+
+    statuses = [update['status'] for _, frame in frames for update in frame['updates']]
+    assert statuses == [ONLINE, OFFLINE]
+
+def test_user_still_on_another_worker_is_not_announced_as_offline():
+    async def elsewhere(usernames):
+        return {'alice'} & set(usernames)
+    presence, frames = tracker(elsewhere)
+    presence.connected('alice')
+    presence.connected('bob')
+    asyncio.run(presence.fan_out())
+    frames.clear()
+    presence.disconnected('alice')
+    presence.disconnected('bob')
+    asyncio.run(presence.fan_out())
+
+    assert frames == [('carol', {'type': 'presence', 'updates': [
+        {'username': 'bob', 'status': OFFLINE, 'last_seen': frames[0][1]['updates'][0]['last_seen']}
+    ]})]
+    # The last-seen time is still recorded for this worker's disconnect
+    assert set(presence._last_seen) == {'alice', 'bob'}
+
+def test_failed_lookup_announces_the_disconnect():
+    async def broken(usernames):
+        raise ConnectionError('broker down')
+    presence, frames = tracker(broken)
+    presence.connected('alice')
+    presence.disconnected('alice')
+    asyncio.run(presence.fan_out())
+
+    assert frames[0][1]['updates'][0]['status'] == OFFLINE
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frame):
+        self.sent.append(frame)
+        return True
+
+@pytest.fixture
+def db(app):
+    app.db.messages.delete_many({})
+    app.db.message_cache.clear()
+    return app.db
+
+def add_message(db):
+    return str(db.messages.insert_one(db._new_message_doc('alice', 'bob', 'Lunch?')).inserted_id)
+
+def react(db, message_id, user, emoji):
+    return asyncio.run(db.add_reaction(message_id, user, emoji))['reactions']
+
+def groups(reactions):
+    return {group['emoji']: (group['count'], group['users']) for group in reactions}
+
+def test_reactions_are_grouped_by_emoji(db):
+    message_id = add_message(db)
+
+    react(db, message_id, 'alice', '👍')
+    reactions = react(db, message_id, 'bob', '👍')
+
+    assert groups(reactions) == {'👍': (2, ['alice', 'bob'])}
+
+def test_switching_emoji_moves_the_user_and_drops_emptied_groups(db):
+    message_id = add_message(db)
+    react(db, message_id, 'alice', '👍')
+    react(db, message_id, 'bob', '👍')
+
+    # Alice's thumbs up goes off as her heart goes on
+    assert groups(react(db, message_id, 'alice', '❤️')) == {'👍': (1, ['bob']), '❤️': (1, ['alice'])}
+    assert groups(react(db, message_id, 'bob', '❤️')) == {'❤️': (2, ['alice', 'bob'])}
+
+def test_repeating_a_reaction_counts_it_once(db):
+    message_id = add_message(db)
+
+    react(db, message_id, 'alice', '👍')
+    reactions = react(db, message_id, 'alice', '👍')
+
+    assert groups(reactions) == {'👍': (1, ['alice'])}
+    stored = db.messages.find_one({'reactions.user': 'alice'})
+    assert [reaction['emoji'] for reaction in stored['reactions']] == ['👍']
+
+def test_reaction_update_reaches_both_participants_with_counts(app, db, monkeypatch):
+    monkeypatch.setattr(app.db, 'log_event', lambda username, event: None)
+    connections = {'alice': FakeConnection(), 'bob': FakeConnection()}
+    for username, connection in connections.items():
+        monkeypatch.setitem(app.connected_clients, username, {connection})
+    message_id = add_message(db)
+
+    asyncio.run(app.handle_reaction(connections['bob'], {'messageId': message_id, 'from': 'bob', 'emoji': '😂'}))
+
+    for connection in connections.values():
+        assert connection.sent == [{
+            'type': 'reaction_update',
+            'messageId': message_id,
+            'reactions': [{'emoji': '😂', 'count': 1, 'users': ['bob']}]
+        }]
+
+def test_reaction_to_a_missing_message_is_an_error(app, db):
+    connection = FakeConnection()
+
+    asyncio.run(app.handle_reaction(connection, {'messageId': '0' * 24, 'from': 'bob', 'emoji': '😂'}))
+
+    assert connection.sent[0]['type'] == 'error'
@@ -0,0 +1,43 @@
+import pytest
+
+from reply_index import LocalReplySuggester, build_reply_index, mine_reply_pairs
+
+def suggester(tmp_path, pairs, **kwargs):
+    path = str(tmp_path / 'reply_index.db')
+    build_reply_index(pairs, path, **kwargs)
+    return LocalReplySuggester(path)
+
+def test_common_replies_from_several_people_are_suggested(tmp_path):
+    pairs = [('Lunch tomorrow?', 'Sure!', f'user{index}') for index in range(3)]
+    pairs += [('Lunch tomorrow?', 'Sounds good', f'user{index}') for index in range(3, 7)]
+
+    index = suggester(tmp_path, pairs)
+
+    assert index.suggest('lunch tomorrow', 2) == (['Sounds good', 'Sure!'], 1.0)
+
+def test_a_reply_seen_once_is_never_suggested(tmp_path):
+    pairs = [('hi?', 'hey', f'user{index}') for index in range(10)]
+    pairs.append(('hi?', 'my pin is 4821', 'alice'))
+
+    index = suggester(tmp_path, pairs)
+
+    assert index.suggest('hi?', 5) == (['hey'], 1.0)
+
+def test_a_reply_only_one_person_sends_is_never_suggested(tmp_path):
+    # Frequent, but always from the same sender
+    pairs = [('Where are you?', 'At the Elm St flat', 'alice')] * 20
+
+    index = suggester(tmp_path, pairs)
+
+    assert index.suggest('Where are you?', 2) == ([], 0.0)
+
+def test_mined_pairs_name_the_replier():
+    mongomock = pytest.importorskip('mongomock')
+    collection = mongomock.MongoClient().db.messages
+    collection.insert_many([
+        {'conversation_id': 'alice|bob', 'from': 'alice', 'content': 'Lunch?', 'timestamp': '1'},
+        {'conversation_id': 'alice|bob', 'from': 'bob', 'content': 'Sure!', 'timestamp': '2'},
+        {'conversation_id': 'alice|bob', 'from': 'bob', 'content': 'Noon?', 'timestamp': '3'},
+    ])
+
+    assert list(mine_reply_pairs(collection)) == [('Lunch?', 'Sure!', 'bob')]
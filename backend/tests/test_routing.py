@@ -0,0 +1,79 @@
+import asyncio
+
+from routing import FrameRouter
+
+class FakeConnection:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, frame):
+        self.sent.append(frame)
+
+def slow_lane_router(max_concurrency=2, max_lane_backlog=32):
+    router = FrameRouter(max_concurrency=max_concurrency, max_lane_backlog=max_lane_backlog)
+    release = asyncio.Event()
+    handled = []
+
+    @router.route('message', {'to': str, 'n': int}, lane=lambda data: data['to'])
+    async def message(session, data):
+        await release.wait()
+        handled.append(('message', data['n']))
+
+    @router.route('typing_status', {'to': str})
+    async def typing(session, data):
+        handled.append(('typing', data['to']))
+
+    return router, release, handled
+
+def test_frames_queued_behind_a_lane_do_not_hold_handler_slots():
+    async def run():
+        router, release, handled = slow_lane_router(max_concurrency=2)
+        session = router.session(FakeConnection())
+        for n in range(10):
+            await asyncio.wait_for(session.dispatch({'type': 'message', 'to': 'AI Assistant', 'n': n}), 1)
+        # Only the head of the lane holds a slot, so other frames still run
+        await asyncio.wait_for(session.dispatch({'type': 'typing_status', 'to': 'bob'}), 1)
+        await asyncio.sleep(0)
+        assert handled == [('typing', 'bob')]
+
+        release.set()
+        await asyncio.gather(*session._tasks)
+        return handled
+
+    handled = asyncio.run(run())
+    assert handled[1:] == [('message', n) for n in range(10)]
+
+def test_a_full_lane_stops_reading_frames():
+    async def run():
+        router, release, handled = slow_lane_router(max_lane_backlog=3)
+        session = router.session(FakeConnection())
+        for n in range(3):
+            await session.dispatch({'type': 'message', 'to': 'AI Assistant', 'n': n})
+        fourth = asyncio.create_task(session.dispatch({'type': 'message', 'to': 'AI Assistant', 'n': 3}))
+        await asyncio.sleep(0.05)
+        blocked = not fourth.done()
+
+        release.set()
+        await fourth
+        await asyncio.gather(*session._tasks)
+        return blocked, handled
+
+    blocked, handled = asyncio.run(run())
+    assert blocked
+    assert handled == [('message', n) for n in range(4)]
+
+def test_closing_a_session_cancels_its_handlers():
+    async def run():
+        router, release, handled = slow_lane_router()
+        session = router.session(FakeConnection())
+        for n in range(5):
+            await session.dispatch({'type': 'message', 'to': 'AI Assistant', 'n': n})
+
+        await asyncio.wait_for(session.close(), 1)
+        release.set()
+        await asyncio.sleep(0)
+        return session, handled
+
+    session, handled = asyncio.run(run())
+    assert handled == []
+    assert not session._tasks
@@ -0,0 +1,14 @@
+import pytest
+from bson import ObjectId
+
+def test_search_cursor_round_trips_score_and_id(app):
+    hit = {'score': 1.0833333333333333, '_id': ObjectId()}
+
+    cursor = app.db.encode_search_cursor(hit)
+
+    assert app.db.decode_search_cursor(cursor) == (hit['score'], hit['_id'])
+
+@pytest.mark.parametrize('cursor', ['', 'abc', '1.5', 'nan-ish|' + str(ObjectId()), '1.5|not-an-id'])
+def test_malformed_search_cursor_is_rejected(app, cursor):
+    with pytest.raises(ValueError):
+        app.db.decode_search_cursor(cursor)
@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+@pytest.fixture
+def db(app):
+    for name in ('users', 'messages', 'ai_messages', 'unread', 'migrations'):
+        app.db.db[name].delete_many({})
+    app.db.unread_counts_ready = False
+    yield app.db
+    app.db.unread_counts_ready = True
+
+def unread_message(db, sender, reader):
+    return db._new_message_doc(sender, reader, 'hello')
+
+def test_backfill_counts_existing_unread_messages(db):
+    db.users.insert_many([{'username': name, 'friends': []} for name in ('alice', 'bob')])
+    db.messages.insert_many([unread_message(db, 'bob', 'alice') for _ in range(3)])
+
+    asyncio.run(db.migrate_unread_counts(batch_size=1, pause=0))
+
+    assert db.unread_counts_ready
+    assert asyncio.run(db.get_unread_counts('alice')) == {'bob': 3}
+
+def test_messages_stored_during_the_backfill_are_counted_once(db, monkeypatch):
+    count_unread = db._count_unread
+    async def slow_count_unread(readers):
+        counts = await count_unread(readers)
+        # Live writes get the chance to land between the count and the counter write
+        await asyncio.sleep(0.01)
+        return counts
+    monkeypatch.setattr(db, '_count_unread', slow_count_unread)
+    db.users.insert_many([{'username': f'user{index}', 'friends': []} for index in range(20)])
+    db.messages.insert_many([unread_message(db, 'bob', f'user{index}') for index in range(20)])
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        batch = []
+        for index in range(20):
+            durable = loop.create_future()
+            batch.append((unread_message(db, 'bob', f'user{index}'), durable))
+        async def store_later(item, delay):
+            await asyncio.sleep(delay)
+            await db._flush_messages([item])
+        # Spread live writes over the whole backfill
+        await asyncio.gather(
+            db.migrate_unread_counts(batch_size=2, pause=0),
+            *(store_later(item, index * 0.005) for index, item in enumerate(batch))
+        )
+    asyncio.run(run())
+
+    for index in range(20):
+        assert asyncio.run(db.get_unread_counts(f'user{index}')) == {'bob': 2}
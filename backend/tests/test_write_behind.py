@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+from bson import ObjectId
+
+@pytest.fixture
+def db(app):
+    for name in ('messages', 'unread'):
+        app.db.db[name].delete_many({})
+    return app.db
+
+def flaky_insert(monkeypatch, collection, failures, store_before_failing):
+    """Make the next insert_many calls fail, optionally after storing the documents."""
+    insert_many = collection.insert_many
+    calls = []
+    def insert(docs, **kwargs):
+        calls.append([doc['_id'] for doc in docs])
+        if len(calls) <= failures:
+            if store_before_failing:
+                insert_many(docs, **kwargs)
+            raise TimeoutError('timed out')
+        return insert_many(docs, **kwargs)
+    monkeypatch.setattr(collection, 'insert_many', insert)
+    return calls
+
+def flush(db, count):
+    async def run():
+        loop = asyncio.get_running_loop()
+        batch = [({**db._new_message_doc('bob', 'alice', f'message {index}'), '_id': ObjectId()}, loop.create_future())
+                 for index in range(count)]
+        await db._flush_messages(batch)
+        return [durable.result() if not durable.exception() else durable.exception() for _, durable in batch], batch
+    return asyncio.run(run())
+
+def test_batch_stored_despite_a_timeout_is_retried_with_the_same_ids(db, monkeypatch):
+    calls = flaky_insert(monkeypatch, db.messages, failures=1, store_before_failing=True)
+
+    results, batch = flush(db, 3)
+
+    assert results == [str(doc['_id']) for doc, _ in batch]
+    assert calls[0] == calls[1]
+    assert db.messages.count_documents({}) == 3
+    # Counted once, even though the write that stored them reported an error
+    assert asyncio.run(db.get_unread_counts('alice')) == {'bob': 3}
+
+def test_failed_batch_is_retried_before_failing(db, monkeypatch):
+    calls = flaky_insert(monkeypatch, db.messages, failures=1, store_before_failing=False)
+
+    results, _ = flush(db, 2)
+
+    assert len(calls) == 2
+    assert all(isinstance(result, str) for result in results)
+    assert db.messages.count_documents({}) == 2
+
+def test_messages_fail_once_the_retries_run_out(db, monkeypatch):
+    calls = flaky_insert(monkeypatch, db.messages, failures=db.write_retries + 1, store_before_failing=False)
+
+    results, _ = flush(db, 2)
+
+    assert len(calls) == db.write_retries + 1
+    assert all(isinstance(result, TimeoutError) for result in results)
+    assert db.messages.count_documents({}) == 0